@@ -18,13 +18,17 @@ from torch import cuda
 from torch.autograd import Variable
 
 import data
+import distributed_utils
+from actor_learner import RolloutActor
 import utils
+from discriminator_server import DiscriminatorClient, discriminator_loss_acc, score_pairs
 from meters import AverageMeter
 from discriminator import Discriminator, AttDiscriminator
 from generator import LSTMModel, VarLSTMModel
 # from train_generator import train_g
 # from train_discriminator import train_d
 from PGLoss import PGLoss
+from replay_buffer import ReplayBuffer
 
 
 class ModelTrainer:
@@ -45,11 +49,20 @@ class ModelTrainer:
         self.load_dataset(args)
         self.create_meters()
         self.create_models(args)
+        self.sync_models(args)
         self.create_output_path(args)
         self.create_losses()
         self.handicap_discriminator()
         self.create_optimizers(args)
-        self.summary_writer = SummaryWriter(self.checkpoints_path)
+        self.create_amp(args)
+        self.create_discriminator_server(args)
+        self.create_actor(args)
+        self.create_replay_buffer(args)
+        self.accumulated = {}  # per optimizer, the sizes of the micro-batches accumulated so far, see optimizer_step
+        self.g_objective = None  # objective of the generator update being accumulated, see generator_step
+        self.positive_scores = None  # discriminator scores of the references during validation, see score_pairs
+        # only the master worker writes summaries and checkpoints
+        self.summary_writer = SummaryWriter(self.checkpoints_path) if distributed_utils.is_master(args) else None
 
         import datasets
         self.bleu_metric = datasets.load_metric('sacrebleu')
@@ -143,6 +156,13 @@ class ModelTrainer:
                 self.discriminator.cpu()
             self.generator.cpu()
 
+    def sync_models(self, args):
+        # data parallel training: all the workers start from the models of the master
+        if args.distributed_world_size > 1:
+            distributed_utils.broadcast_module(self.generator)
+            if hasattr(self, "discriminator"):
+                distributed_utils.broadcast_module(self.discriminator)
+
     def create_output_path(self, args):
         # adversarial training checkpoints saving path
         if args.note is None:
@@ -150,7 +170,7 @@ class ModelTrainer:
         else:
             name = self.__class__.__name__ + " " + args.note
         path = os.path.join(args.model_file, name.replace(" ","_").replace(":","-"))
-        if not os.path.exists(path):
+        if distributed_utils.is_master(args) and not os.path.exists(path):
             os.makedirs(path)
         self.checkpoints_path = path
 
@@ -158,17 +178,20 @@ class ModelTrainer:
         # define loss function
         self._g_criterion = torch.nn.NLLLoss(reduction='mean')
         self.d_criterion = torch.nn.BCELoss()  #torch.nn.SoftMarginLoss() #
-        self._pg_criterion = PGLoss(ignore_index=self.dataset.dst_dict.pad(), size_average=True, reduce=True)
+        self._pg_criterion = PGLoss(ignore_index=self.dataset.dst_dict.pad(), size_average=True, reduce=True,
+                                    clip=self.args.ppo_clip)
         self._logsoftmax = torch.nn.LogSoftmax(dim=-1)
 
-        self.g_criterion = lambda pred, true: self._g_criterion(self._logsoftmax(pred), true)
-        self.pg_criterion = lambda pred, true, reward, modified_logits, predicted_tokens: \
+        # the losses are computed in float32, also under autocast
+        self.g_criterion = lambda pred, true: self._g_criterion(self._logsoftmax(pred.float()), true)
+        self.pg_criterion = lambda pred, true, reward, modified_logits, predicted_tokens, sample_logprobs=None: \
             self._pg_criterion(
-                self._logsoftmax(pred),
+                self._logsoftmax(pred.float()),
                 true,
-                reward,
-                self._logsoftmax(modified_logits) if modified_logits is not None else None,
+                reward.float(),
+                self._logsoftmax(modified_logits.float()) if modified_logits is not None else None,
                 predicted_tokens,
+                sample_logprobs,
             )
 
     def handicap_discriminator(self):
@@ -186,14 +209,98 @@ class ModelTrainer:
                                                                      self.generator.parameters()),
                                                               args.g_learning_rate)
 
-        if hasattr(self, "discriminator"):
+        if hasattr(self, "discriminator") and not args.discriminator_server:
             self.d_optimizer = eval("torch.optim." + args.d_optimizer)(filter(lambda x: x.requires_grad,
                                                                          self.discriminator.parameters()),
                                                                   args.d_learning_rate,)
                                                                   # momentum=args.momentum,
                                                                   # nesterov=True)
 
+    def create_amp(self, args):
+        # mixed precision: the forward passes run under autocast, float16 gradients are scaled
+        self.amp_device = 'cuda' if self.use_cuda else 'cpu'
+        self.amp_dtype = {'none': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}[args.amp]
+        if self.amp_dtype is torch.float16 and not self.use_cuda:
+            raise ValueError("--amp fp16 needs a GPU, use --amp bf16 on CPU")
+
+        scale = self.amp_dtype is torch.float16
+        self.g_scaler = torch.amp.GradScaler(self.amp_device, enabled=scale)
+        self.d_scaler = torch.amp.GradScaler(self.amp_device, enabled=scale)
+
+    def create_discriminator_server(self, args):
+        # the discriminator and its optimizer live in their own process, see discriminator_server.py
+        if not args.discriminator_server or not hasattr(self, "discriminator"):
+            return
+        if args.distributed_world_size > 1:
+            raise ValueError("--discriminator-server is not supported in distributed training")
+        device = next(self.discriminator.parameters(), torch.empty(0)).device
+        print(f"Serving the discriminator on {device} with staleness {args.discriminator_staleness}")
+        self.discriminator = DiscriminatorClient(self.discriminator, args, device)
+
+    def create_actor(self, args):
+        # actor-learner policy gradient: the rollouts are sampled ahead by a background actor, see actor_learner.py
+        self.actor = None
+        if args.actor_learner:
+            self.actor = RolloutActor(self.generator, buffer_size=args.rollout_buffer_size,
+                                      sync_every=args.actor_sync_every)
+
+    def create_replay_buffer(self, args):
+        # PPO-style epochs: the policy gradient rollouts are replayed for more updates
+        self.replay_buffer = None
+        if args.ppo_epochs > 1:
+            self.replay_buffer = ReplayBuffer(args.replay_buffer_size, eviction=args.replay_eviction, seed=args.seed)
+
+    def autocast(self):
+        return torch.amp.autocast(self.amp_device, dtype=self.amp_dtype, enabled=self.amp_dtype is not None)
+
+    def optimizer_step(self, loss_sum, sample_size, ntokens, optimizer, scaler, update_tokens=0, clip_params=None):
+        """
+        Backward pass of loss_sum, summed over the sample_size items of a micro-batch of ntokens target tokens,
+        through the grad scaler. The gradients of the micro-batches are accumulated until update_tokens tokens
+        were seen (every call if 0), then divided by the accumulated sample_size and applied by optimizer;
+        the gradients of clip_params, if given, are clipped to clip_norm first.
+        In distributed training, the sizes and the gradients are summed over all the workers, which all call this
+        for each batch (loss_sum is None for the empty batches of the last shards).
+        Returns True if the parameters were updated.
+        """
+        if optimizer not in self.accumulated:
+            optimizer.zero_grad()
+            self.accumulated[optimizer] = {"sample_size": 0, "ntokens": 0}
+        accumulated = self.accumulated[optimizer]
+        if loss_sum is not None:
+            scaler.scale(loss_sum).backward()
+        if self.args.distributed_world_size > 1:
+            # the workers decide to update together
+            sample_size, ntokens = distributed_utils.all_reduce_sum([sample_size, ntokens])
+        accumulated["sample_size"] += sample_size
+        accumulated["ntokens"] += ntokens
+        if accumulated["ntokens"] < update_tokens:
+            return False
+
+        params = [p for group in optimizer.param_groups for p in group["params"]]
+        if self.args.distributed_world_size > 1:
+            # reduced before unscaling, so that all the workers see the same overflows
+            distributed_utils.all_reduce_and_rescale_gradients(params, accumulated["sample_size"])
+        else:
+            for p in params:
+                if p.grad is not None:
+                    p.grad.div_(accumulated["sample_size"])
+        scaler.unscale_(optimizer)
+        if clip_params is not None:
+            torch.nn.utils.clip_grad_norm_(clip_params, self.args.clip_norm)
+        scaler.step(optimizer)
+        scaler.update()
+        del self.accumulated[optimizer]
+        return True
+
+    def generator_sample_size(self, sample, output):
+        # the MLE losses are averaged over the target tokens up to eos
+        ntokens = output["mask"].sum().item()
+        return sample['target'].size(0) if self.args.sentence_avg else ntokens, ntokens
+
     def write_summary(self, scores, batch_step, write_sents=False):
+        if self.summary_writer is None:
+            return
         # main_name = os.path.basename(self.model_base_path)
         for var, val in scores.items():
             # self.summary_writer.add_scalar(f"{main_name}/{var}", val, batch_step)
@@ -204,26 +311,67 @@ class ModelTrainer:
                     self.summary_writer.add_text(f"gen/{ind}", sent, global_step=batch_step)
         # self.summary_writer.add_scalars(main_name, scores, batch_step)
 
-    def sequential_generation(self, sample, decoding_style="rl", top_k=0, top_p=1.0, temp=1., ss_prob=0.):
-        return self.teacher_forcing_generation(sample)
+    def sequential_generation(self, sample, decoding_style="rl", top_k=0, top_p=1.0, temp=1., ss_prob=0., generator=None):
+        if decoding_style != "rl":
+            return self.teacher_forcing_generation(sample)
+
+        generator = generator if generator is not None else self.generator
+        logits, output_tokens, modified_logits = generator.rollout(
+            sample, temperature=temp, top_k=top_k, top_p=top_p, epsilon=self.args.imp_smpl_epsilon
+        )
+        return self.wrap_for_output(sample, logits, modified_logits=modified_logits, output_tokens=output_tokens)
+
+    def policy_logits(self, sample, prediction):
+        """Logits of the generator for the tokens of prediction, sampled one after the other as in rollout"""
+        prev_output_tokens = torch.cat([
+            prediction.new_full((prediction.size(0), 1), self.dataset.dst_dict.eos()), prediction[:, :-1]
+        ], dim=1)
+        return self.generator(dict(sample, net_input=dict(sample['net_input'], prev_output_tokens=prev_output_tokens)))
+
+    def rollout_logprobs(self, output):
+        # log-probabilities of the sampled tokens under the distribution they were sampled from
+        logits = output["modified_logits"] if output["modified_logits"] is not None else output["logits"]
+        return self._pg_criterion.select(self._logsoftmax(logits.float()), output["prediction"])[0]
+
+    def actor_rollout(self, sample, generator):
+        if self.sequential_decoding_style != "rl":
+            raise ValueError(f"--actor-learner needs sampled rollouts, not {self.sequential_decoding_style} decoding")
+        with torch.no_grad(), self.autocast():
+            output = self.sequential_generation(sample, decoding_style=self.sequential_decoding_style, top_k=0, top_p=0.6,
+                                                generator=generator)
+            return {"prediction": output["prediction"], "logprobs": self.rollout_logprobs(output)}
+
+    def replay_generation(self, sample, rollout):
+        # the rollout sampled by the actor, with the logits of the generator being trained
+        output = self.wrap_for_output(sample, self.policy_logits(sample, rollout["prediction"]))
+        output["prediction"] = rollout["prediction"]
+        output["sample_logprobs"] = rollout["logprobs"]
+        return output
 
     def pg_step(self, sample, batch_i, epoch, loader_len):
         print("Policy Gradient Training")
 
-        output = self.sequential_generation(sample, decoding_style=self.sequential_decoding_style, top_k=0, top_p=0.6)
+        with self.autocast():
+            if "rollout" in sample:
+                output = self.replay_generation(sample, sample["rollout"])
+            else:
+                output = self.sequential_generation(sample, decoding_style=self.sequential_decoding_style, top_k=0, top_p=0.6)
 
-        with torch.no_grad():
-            # if self.sequential_decoding_style == "gumbel":
-            #     reward = self.discriminator(output['input_onehot'], output["output_onehot"])
-            # else:
-            # reward = self.discriminator(sample['net_input']['src_tokens'], output["prediction"])
-            reward = self.discriminator(sample["net_input"]["src_tokens"], output["prediction"])
-            # reward = self.discriminator(output["prediction"], output["prediction"])
-            # gen_reward = (output["prediction"] == sample['target']).float()
+            with torch.no_grad():
+                # if self.sequential_decoding_style == "gumbel":
+                #     reward = self.discriminator(output['input_onehot'], output["output_onehot"])
+                # else:
+                # reward = self.discriminator(sample['net_input']['src_tokens'], output["prediction"])
+                reward = self.discriminator(sample["net_input"]["src_tokens"], output["prediction"])
+                # reward = self.discriminator(output["prediction"], output["prediction"])
+                # gen_reward = (output["prediction"] == sample['target']).float()
+
+            pg_loss = self.pg_criterion(output["logits"], sample['target'], reward, output.get("modified_logits", None), output.get("prediction", None),
+                                        output.get("sample_logprobs", None))# + \
+                      # self.pg_criterion(output["logits"], sample['target'], gen_reward, output.get("modified_logits", None),
+                      #                   output.get("prediction", None))
 
-        pg_loss = self.pg_criterion(output["logits"], sample['target'], reward, output.get("modified_logits", None), output.get("prediction", None))# + \
-                  # self.pg_criterion(output["logits"], sample['target'], gen_reward, output.get("modified_logits", None),
-                  #                   output.get("prediction", None))
+        self.add_to_replay_buffer(sample, output, reward)
 
         with torch.no_grad():
             if (batch_i + (epoch - 1) * loader_len) % min(self.args.train_bleu_every, loader_len) == 0:
@@ -232,10 +380,38 @@ class ModelTrainer:
                     sample['ntokens'], batch_i=batch_i, epoch_i=epoch, num_batches=loader_len, partition="train", strategy="rl"
                 )
 
-        self.g_optimizer.zero_grad()
-        pg_loss.backward()
-        torch.nn.utils.clip_grad_norm_(self.generator.parameters(), self.args.clip_norm)
-        self.g_optimizer.step()
+        # the policy gradient loss is averaged over the sentences
+        bsz = sample['target'].size(0)
+        return self.optimizer_step(pg_loss * bsz, bsz, sample['ntokens'], self.g_optimizer, self.g_scaler,
+                                   self.args.g_update_tokens, self.generator.parameters())
+
+    def add_to_replay_buffer(self, sample, output, reward):
+        if self.replay_buffer is None:
+            return
+        if "sample_logprobs" in output:
+            logprobs = output["sample_logprobs"]
+        else:
+            with torch.no_grad():
+                logprobs = self.rollout_logprobs(output)
+        self.replay_buffer.add(sample, output["prediction"], logprobs, reward)
+
+    def replay_step(self):
+        """Policy gradient step on a rollout of the replay buffer, with its cached rewards"""
+        entry = self.replay_buffer.sample()
+        if entry is None:
+            # nothing to replay yet (e.g. only empty batches in distributed training), only take part in the update
+            return self.optimizer_step(None, 0, 0, self.g_optimizer, self.g_scaler, self.args.g_update_tokens,
+                                       self.generator.parameters())
+
+        sample = entry["sample"]
+        with self.autocast():
+            output = self.replay_generation(sample, entry)
+            pg_loss = self.pg_criterion(output["logits"], sample['target'], entry["reward"], None, output["prediction"],
+                                        output["sample_logprobs"])
+
+        bsz = sample['target'].size(0)
+        return self.optimizer_step(pg_loss * bsz, bsz, sample['ntokens'], self.g_optimizer, self.g_scaler,
+                                   self.args.g_update_tokens, self.generator.parameters())
 
     def get_target_lens(self, target):
         target_lens = (torch.ones(target.size(0), dtype=torch.long) * target.size(1)).to(target.device)
@@ -249,12 +425,13 @@ class ModelTrainer:
         mask = torch.arange(target.size(1)).to(target.device)[None, :] < lens[:, None]
         return mask
 
-    def wrap_for_output(self, sample, logits):
+    def wrap_for_output(self, sample, logits, modified_logits=None, output_tokens=None):
         output = {
             "logits": logits,
             "target": sample["target"],
             "mask": self.get_length_mask(sample["target"]),
-            "prediction": logits.argmax(-1)
+            "prediction": output_tokens if output_tokens is not None else logits.argmax(-1),
+            "modified_logits": modified_logits,
         }
 
         output["loss"] = self.g_criterion(output["logits"][output["mask"], :], output["target"][output["mask"]])
@@ -271,13 +448,15 @@ class ModelTrainer:
             print("Scheduled Sampling Training")
             ss_prob = epoch / self.args.epochs * 0.5
             print("ss_prob (probability of scheduled sampling)", ss_prob)
-            output = self.sequential_generation(sample, decoding_style="ss", top_k=0, top_p=0.6, ss_prob=ss_prob)
+            with self.autocast():
+                output = self.sequential_generation(sample, decoding_style="ss", top_k=0, top_p=0.6, ss_prob=ss_prob)
         else:
             print("MLE Training")
-            output = self.teacher_forcing_generation(sample)
+            with self.autocast():
+                output = self.teacher_forcing_generation(sample)
 
         loss = output["loss"]
-        # sample_size = sample['target'].size(0) if self.args.sentence_avg else sample['ntokens']
+        sample_size, ntokens = self.generator_sample_size(sample, output)
 
         with torch.no_grad():
             if (batch_i + (epoch - 1) * loader_len) % self.args.train_bleu_every == 0:
@@ -286,29 +465,16 @@ class ModelTrainer:
                     sample['ntokens'], batch_i=batch_i, epoch_i=epoch, num_batches=loader_len, partition="train", strategy="mle"
                 )
 
-        self.g_optimizer.zero_grad()
-        loss.backward()
-        # all-reduce grads and rescale by grad_denom
-        # for p in self.generator.parameters():
-        #     if p.requires_grad:
-        #         p.grad.data.div_(sample_size)
-        torch.nn.utils.clip_grad_norm_(self.generator.parameters(), self.args.clip_norm)
-        self.g_optimizer.step()
+        # the gradients are rescaled by the accumulated sample_size in optimizer_step
+        return self.optimizer_step(loss * ntokens, sample_size, sample['ntokens'], self.g_optimizer, self.g_scaler,
+                                   self.args.g_update_tokens, self.generator.parameters())
 
-    def discrimnator_loss_acc(self, sample):
-        bsz = sample['target'].size(0)  # batch_size = 64
-        src_sentence = sample['net_input']['src_tokens']  # 64 x max-len i.e 64 X 50
+    def negative_samples(self, sample):
+        if "rollout" in sample:
+            return sample["rollout"]["prediction"]  # sampled by the actor, as below
 
         # now train with machine translation output i.e generator output
-        true_sentence = sample['target']  # 64*50 = 3200
-        true_labels = Variable(torch.ones(sample['target'].size(0)).float()).unsqueeze(1).repeat(1, sample['target'].size(1))
-        # true_labels = Variable(torch.ones(sample['target'].size(0)).float())
-
-        if self.use_cuda:
-            true_sentence = true_sentence.cuda()
-            true_labels = true_labels.cuda()
-
-        with torch.no_grad():
+        with torch.no_grad(), self.autocast():
             gen_output = self.sequential_generation(sample, decoding_style=self.sequential_decoding_style, top_k=0, top_p=0.6)  # 64 X 50 X 6632
 
         # if self.sequential_decoding_style == "gumbel":
@@ -316,27 +482,31 @@ class ModelTrainer:
         #     fake_sentence = gen_output["output_onehot"]
         #     src_sentence = gen_output["input_onehot"]
         # else:
-        fake_sentence = gen_output["prediction"]
-
-        fake_labels = Variable(torch.zeros(sample['target'].size(0)).float()).unsqueeze(1).repeat(1, sample['target'].size(1))
-        # fake_labels = Variable(torch.zeros(sample['target'].size(0)).float())
+        return gen_output["prediction"]
 
+    def discrimnator_loss_acc(self, sample):
+        src_sentence = sample['net_input']['src_tokens']  # 64 x max-len i.e 64 X 50
+        true_sentence = sample['target']  # 64*50 = 3200
         if self.use_cuda:
-            fake_labels = fake_labels.cuda()
-
-        disc_out_neg = self.discriminator(src_sentence, fake_sentence)
-        disc_out_pos = self.discriminator(src_sentence, true_sentence)
-        # disc_out_neg = self.discriminator(fake_sentence, fake_sentence)
-        # disc_out_pos = self.discriminator(true_sentence, true_sentence)
-        disc_out = torch.cat([disc_out_neg.squeeze(1), disc_out_pos.squeeze(1)], dim=0)
+            true_sentence = true_sentence.cuda()
 
-        labels = torch.cat([fake_labels, true_labels], dim=0)
+        fake_sentence = self.negative_samples(sample)
 
-        d_loss = self.d_criterion(disc_out, labels)
-        acc = torch.sum(torch.round(disc_out) == labels).float() / torch.numel(labels) * 100
-        return d_loss, acc
+        return discriminator_loss_acc(self.discriminator, self.d_criterion, src_sentence, fake_sentence, true_sentence,
+                                      autocast=self.autocast, positive_cache=self.positive_scores)
 
     def discriminator_step(self, sample, batch_i, epoch, loader_len):
+        if not sample:
+            # empty batch of the last shards in distributed training, only take part in the update
+            return self.optimizer_step(None, 0, 0, self.d_optimizer, self.d_scaler, self.args.d_update_tokens)
+
+        if self.args.discriminator_server:
+            # trained by the server process while the generator goes on with the next batches
+            self.discriminator.train_step(sample['net_input']['src_tokens'], self.negative_samples(sample),
+                                          sample['target'], sample['ntokens'], meta=(batch_i, epoch, loader_len))
+            self.evaluate_served_discriminator()
+            return False
+
         d_loss, acc = self.discrimnator_loss_acc(sample)
 
         with torch.no_grad():
@@ -345,9 +515,18 @@ class ModelTrainer:
                     d_loss, acc, batch_i=batch_i, epoch_i=epoch, num_batches=loader_len, partition="train"
                 )
 
-        self.d_optimizer.zero_grad()
-        d_loss.backward()
-        self.d_optimizer.step()
+        # the discriminator loss is averaged over the positive and negative sentences
+        bsz = 2 * sample['target'].size(0)
+        return self.optimizer_step(d_loss * bsz, bsz, sample['ntokens'], self.d_optimizer, self.d_scaler,
+                                   self.args.d_update_tokens)
+
+    def evaluate_served_discriminator(self, block=False):
+        # training losses of the discriminator server, as they come back (all of them if block)
+        for (batch_i, epoch, loader_len), d_loss, acc, _ in self.discriminator.trained(block=block):
+            if (batch_i + (epoch - 1) * loader_len) % self.args.train_bleu_every == 0:
+                self.evaluate_discriminator(
+                    d_loss, acc, batch_i=batch_i, epoch_i=epoch, num_batches=loader_len, partition="train"
+                )
 
     def format_sample(self, sample, extra_tokens=10):
         sample = copy(sample)
@@ -360,46 +539,81 @@ class ModelTrainer:
         sample["attention_mask"] = self.get_length_mask(sample["net_input"]["src_tokens"], sample["net_input"]['src_lengths'])
         return sample
 
-    def train_loop(self, trainloader, epoch_i, num_update):
-        for i, sample in enumerate(trainloader):
-
+    def generator_step(self, sample, batch_i, epoch, loader_len, mle_frac):
+        """
+        MLE or policy gradient step of the generator, following training_strategy. With gradient accumulation,
+        all the micro-batches of an update use the objective drawn for the first one.
+        Returns True if the generator was updated.
+        """
+        if not hasattr(self, "discriminator") or self.training_strategy == "mle":
+            self.g_objective = "mle"
+        elif self.training_strategy == "rl":
+            self.g_objective = "rl"
+        elif self.training_strategy == "alternate":
+            if self.g_objective is None:
+                self.g_objective = "mle" if random.random() <= mle_frac else "rl"
+        else:
+            raise ValueError(
+                f"Invalid training strategy: {self.training_strategy}. Valid options are: alternate|mle|rl.")
+
+        if not sample:
+            # empty batch of the last shards in distributed training, only take part in the update
+            updated = self.optimizer_step(None, 0, 0, self.g_optimizer, self.g_scaler, self.args.g_update_tokens,
+                                          self.generator.parameters())
+        elif self.g_objective == "mle":
+            updated = self.mle_step(sample, batch_i, epoch, loader_len)
+        else:
+            # if random.random() > 0.5:
+            #     self.mle_step(sample, batch_i, epoch, loader_len, seq_decoding=True)
+            # else:
+            updated = self.pg_step(sample, batch_i, epoch, loader_len)
+        if self.g_objective == "rl":
+            # PPO-style epochs over the rollouts, the workers of distributed training replay as many
+            for _ in range(self.args.ppo_epochs - 1):
+                updated = self.replay_step() or updated
+        if updated:
+            self.g_objective = None
+            if self.actor is not None:
+                self.actor.sync(self.generator)
+        return updated
+
+    def prepare_sample(self, sample):
+        if sample:
             sample = self.format_sample(sample)
 
-            if self.use_cuda:
-                # wrap input tensors in cuda tensors
-                sample = utils.make_variable(sample, cuda=cuda)
+        if self.use_cuda:
+            # wrap input tensors in cuda tensors
+            sample = utils.make_variable(sample, cuda=cuda)
+        return sample
 
-            if self.args.reduce_tf_frac:
-                mle_frac = max(self.args.epochs - epoch_i, 1) / self.args.epochs
-            else:
-                mle_frac = 0.5
+    def train_loop(self, trainloader, epoch_i, num_update):
+        if self.actor is not None:
+            # the actor prepares the batches and samples their rollouts ahead of the updates
+            batches = self.actor.rollouts(trainloader, self.prepare_sample, self.actor_rollout)
+        else:
+            batches = map(self.prepare_sample, trainloader)
 
-            if epoch_i > self.args.discriminator_pretraining or not hasattr(self, "discriminator"):
-                if hasattr(self, "discriminator"):
-                    if self.training_strategy == "alternate":
-                        if random.random() <= mle_frac:
-                            self.mle_step(sample, i, epoch_i, len(trainloader))
-                        else:
-                            # if random.random() > 0.5:
-                            #     self.mle_step(sample, i, epoch_i, len(trainloader), seq_decoding=True)
-                            # else:
-                            self.pg_step(sample, i, epoch_i, len(trainloader))
-                    elif self.training_strategy == "mle":
-                        self.mle_step(sample, i, epoch_i, len(trainloader))
-                    elif self.training_strategy == "rl":
-                        self.pg_step(sample, i, epoch_i, len(trainloader))
-                    else:
-                        raise ValueError(
-                            f"Invalid training strategy: {self.training_strategy}. Valid options are: alternate|mle|rl.")
+        try:
+            for i, sample in enumerate(batches):
+
+                if self.args.reduce_tf_frac:
+                    mle_frac = max(self.args.epochs - epoch_i, 1) / self.args.epochs
                 else:
-                    self.mle_step(sample, i, epoch_i, len(trainloader))
-                num_update += 1
-            else:
-                if i == 0 and epoch_i == 1:
-                    print(f"Pretraining discriminator for {self.args.discriminator_pretraining} epochs")
+                    mle_frac = 0.5
 
-            if hasattr(self, "discriminator"):
-                self.discriminator_step(sample, i, epoch_i, len(trainloader))
+                if epoch_i > self.args.discriminator_pretraining or not hasattr(self, "discriminator"):
+                    if self.generator_step(sample, i, epoch_i, len(trainloader), mle_frac):
+                        num_update += 1
+                else:
+                    if i == 0 and epoch_i == 1:
+                        print(f"Pretraining discriminator for {self.args.discriminator_pretraining} epochs")
+
+                if hasattr(self, "discriminator"):
+                    self.discriminator_step(sample, i, epoch_i, len(trainloader))
+        finally:
+            if self.actor is not None:
+                # stops the actor thread also if the learner failed
+                batches.close()
 
         return num_update
 
@@ -460,8 +674,9 @@ class ModelTrainer:
 
         if hasattr(self, "discriminator"):
             with torch.no_grad():
-                discr_score_neg = self.discriminator(original, predictions).mean()
-                discr_score_pos = self.discriminator(original, targets).mean()
+                discr_score_neg, discr_score_pos = score_pairs(self.discriminator, original, predictions, original, targets,
+                                                               self.positive_scores)
+                discr_score_neg, discr_score_pos = discr_score_neg.mean(), discr_score_pos.mean()
         else:
             discr_score_neg = 0.
             discr_score_pos = 0.
@@ -523,6 +738,8 @@ class ModelTrainer:
 
     def eval_loop(self, valloader, epoch_i, force=False):
         for i, sample in enumerate(valloader):
+            if not sample:
+                continue  # empty batch of the last shards in distributed training
 
             sample = self.format_sample(sample, extra_tokens=50)
 
@@ -533,7 +750,8 @@ class ModelTrainer:
 
                 if epoch_i > self.args.discriminator_pretraining or not hasattr(self, "discriminator") or force is True:
                     # generator validation
-                    output = self.eval_generation(sample)
+                    with self.autocast():
+                        output = self.eval_generation(sample)
                     self.evaluate_generator(
                         sample["net_input"]["src_tokens"], output["prediction"], output["target"], output["mask"], output["loss"], ntokens=sample["ntokens"],
                         batch_i=i, epoch_i=epoch_i, num_batches=len(valloader), partition="valid", strategy="mle", accumulate=i<len(valloader)-1, write_sents=True
@@ -577,7 +795,14 @@ class ModelTrainer:
 
         print(f"Validation batches: {len(valloader)}")
 
+        # the references are scored with the same discriminator weights during the whole pass
+        self.positive_scores = {}
         self.eval_loop(valloader, epoch_i, force=force)
+        self.positive_scores = None
+
+        if args.distributed_world_size > 1:
+            distributed_utils.all_reduce_meters(self.g_logging_meters)
+            distributed_utils.all_reduce_meters(self.d_logging_meters)
 
     def train(self):
         args = self.args
@@ -594,6 +819,7 @@ class ModelTrainer:
 
             seed = args.seed + epoch_i
             torch.manual_seed(seed)
+            random.seed(seed)  # the workers draw the same training objectives
 
             max_positions_train = (args.fixed_max_len, args.fixed_max_len)
 
@@ -628,21 +854,30 @@ class ModelTrainer:
             print(f"Training batches: {len(trainloader)}")
 
             num_update = self.train_loop(trainloader, epoch_i, num_update)
+            if args.discriminator_server and hasattr(self, "discriminator"):
+                self.evaluate_served_discriminator(block=True)
 
             self.validate(args, epoch_i)
 
+            if not distributed_utils.is_master(args):
+                continue
+
             self.save_models(epoch_i)
 
             if self.g_logging_meters['valid_loss'].avg < best_dev_loss:
                 best_dev_loss = self.g_logging_meters['valid_loss'].avg
                 self.save_generator(os.path.join(self.checkpoints_path, "best_gmodel.pt"))
 
+        if args.discriminator_server and hasattr(self, "discriminator"):
+            self.discriminator.close()
+
     def save_generator(self, path):
         torch.save(self.generator, open(path, 'wb'), pickle_module=dill)
 
     def save_discriminator(self, path):
         if hasattr(self, "discriminator"):
-            torch.save(self.discriminator, open(path, 'wb'), pickle_module=dill)
+            discriminator = self.discriminator.module() if self.args.discriminator_server else self.discriminator
+            torch.save(discriminator, open(path, 'wb'), pickle_module=dill)
 
     def save_models(self, epoch_i):
         self.save_generator(os.path.join(self.checkpoints_path, f"joint_{self.g_logging_meters['valid_loss'].avg:.3f}.epoch_{epoch_i}_gen.pt"))
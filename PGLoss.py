@@ -5,38 +5,66 @@ import torch.nn.functional as F
 import numpy as np
 import math
 
+import utils
+
 
 class PGLoss(torch.nn.Module):
     
-    def __init__(self, ignore_index=None, size_average=False, reduce=True):
+    def __init__(self, ignore_index=None, size_average=False, reduce=True, from_logits=False, chunk_size=None, clip=None):
         super(PGLoss, self).__init__()
         self.size_average = size_average
         self.ignore_index = ignore_index
         self.reduce = reduce
+        # take unnormalized logits instead of log-probabilities, and only
+        # normalize the selected tokens (see utils.chunked_logsumexp)
+        self.from_logits = from_logits
+        self.chunk_size = chunk_size
+        # PPO-style clipping of the importance sampling coefficients to [1 - clip, 1 + clip]
+        self.clip = clip
+
+    def select(self, logprobs, tokens, normalizer=None):
+        """The log-probabilities of tokens: bsz x seqlen"""
+        selected = logprobs.gather(2, tokens.unsqueeze(2)).squeeze(2).float()
+        if self.from_logits:
+            if normalizer is None:
+                normalizer = utils.chunked_logsumexp(logprobs, self.chunk_size)
+            selected = selected - normalizer
+        return selected, normalizer
 
-    def forward(self, logprobs, label, reward, modified_logprobs=None, predicted_tokens=None):
+    def forward(self, logprobs, label, reward, modified_logprobs=None, predicted_tokens=None, sample_logprobs=None):
+        """
+        The predicted tokens were sampled from modified_logprobs, or, if given, with the selected
+        log-probabilities sample_logprobs (bsz x seqlen), e.g. by an older copy of the model.
+        """
         bsz, seqlen, _ = logprobs.size()
 
-        logprobs = logprobs.clone()
+        # only the log-probabilities of the selected tokens are needed
+        label_logprobs, normalizer = self.select(logprobs, label)
+        weights = reward
 
-        def create_mask(l_probs, lbl):
+        if modified_logprobs is not None or sample_logprobs is not None:
             with torch.no_grad():
-                mask = torch.zeros_like(l_probs)
-                mask = torch.scatter(mask, 2, lbl.unsqueeze(2), 1.)
-            return mask
+                if sample_logprobs is None:
+                    sample_logprobs = self.select(modified_logprobs, predicted_tokens)[0]
+                modified_logprobs_sum = torch.sum(sample_logprobs.float(), dim=-1)
+                logprobs_sum = torch.sum(self.select(logprobs, predicted_tokens, normalizer)[0], dim=-1)
+                importance_sampling_correct_coef = torch.exp(logprobs_sum - modified_logprobs_sum).unsqueeze(1)
+                weights = importance_sampling_correct_coef * reward
+                if self.clip is not None:
+                    # pessimistic bound of PPO, min(r * A, clip(r) * A) with the rewards as advantages A: the
+                    # clipped term is the smaller one, and has no gradient, for r > 1 + clip with A > 0 and
+                    # for r < 1 - clip with A < 0
+                    clipped = ((importance_sampling_correct_coef > 1. + self.clip) & (reward > 0)) | \
+                              ((importance_sampling_correct_coef < 1. - self.clip) & (reward < 0))
+                    clipped_weights = importance_sampling_correct_coef.clamp(1. - self.clip, 1. + self.clip) * reward
+
+            if self.clip is not None:
+                label_logprobs = torch.where(clipped, label_logprobs.detach(), label_logprobs)
+                weights = torch.where(clipped, clipped_weights, weights)
 
-        logprobs_mask = create_mask(logprobs, label)
-        loss = -torch.sum(torch.sum(logprobs * reward.unsqueeze(2) * logprobs_mask, dim=-1), dim=-1)
+        loss = -torch.sum(label_logprobs * weights, dim=-1)
 
         if self.size_average:
             loss = loss/bsz
 
-        if modified_logprobs is not None:
-            modified_logprobs_mask = create_mask(modified_logprobs, predicted_tokens)
-            with torch.no_grad():
-                modified_logprobs_sum = torch.sum(torch.log(torch.sum(torch.exp(modified_logprobs) * modified_logprobs_mask, dim=-1)), dim=-1)
-                logprobs_sum = torch.sum(torch.log(torch.sum(torch.exp(logprobs) * modified_logprobs_mask, dim=-1)), dim=-1)
-                importance_sampling_correct_coef = torch.exp(logprobs_sum - modified_logprobs_sum)
-            loss = importance_sampling_correct_coef * loss
-
         return loss.sum()
@@ -10,7 +10,6 @@ import torch
 import torch.nn.functional as F
 from torch import nn
 from torch.distributions import Gumbel
-from torch.nn import CrossEntropyLoss
 from torch.utils import checkpoint
 from transformers import T5ForConditionalGeneration, T5PreTrainedModel, top_k_top_p_filtering
 
@@ -34,6 +33,8 @@ from transformers.utils import logging
 from transformers.utils.model_parallel_utils import assert_device_map, get_device_map
 from transformers.models.t5.configuration_t5 import T5Config
 
+import utils
+
 
 logger = logging.get_logger(__name__)
 
@@ -497,7 +498,7 @@ class SeqT5(T5ForConditionalGeneration):
         self.model_parallel = False
         self.device_map = None
 
-    def compute_logits(self, decoder_output):
+    def lm_head_input(self, decoder_output):
         sequence_output = decoder_output[0]
 
         # Set device for model parallelism
@@ -511,10 +512,22 @@ class SeqT5(T5ForConditionalGeneration):
             # See https://github.com/tensorflow/mesh/blob/fa19d69eafc9a482aff0b59ddd96b025c0cb207d/mesh_tensorflow/transformer/transformer.py#L586
             sequence_output = sequence_output * (self.model_dim ** -0.5)
 
-        lm_logits = self.lm_head(sequence_output)
+        return sequence_output
+
+    def compute_logits(self, decoder_output):
+        lm_logits = self.lm_head(self.lm_head_input(decoder_output))
 
         return lm_logits
 
+    def compute_chunked_loss(self, decoder_output, labels, chunk_size):
+        """
+        Loss and argmax tokens of the lm_head projection, computed chunk_size positions at a time, without
+        materializing the full logits (see utils.linear_cross_entropy)
+        """
+        return utils.linear_cross_entropy(
+            self.lm_head_input(decoder_output), self.lm_head.weight, labels, ignore_index=-100, chunk_size=chunk_size
+        )
+
     def create_gumbel_distribution(self):
         gumbel_loc = 0.
         gumbel_scale = 1.
@@ -590,7 +603,7 @@ class SeqT5(T5ForConditionalGeneration):
             lm_logits = checkpoint.checkpoint(self.seq_make_step(return_dict=True, use_cache=use_cache), decoder_attention_mask, decoder_inputs_embeds, past_key_values, hidden_states, attention_mask,
                          decoder_head_mask, head_mask, output_attentions, output_hidden_states, dummy_tensor)
 
-            last_token_logits = lm_logits[:, -1, :] / temperature
+            last_token_logits = lm_logits[:, -1, :].float() / temperature  # sampling distribution in float32 under autocast
             last_token_logits_filtered = top_k_top_p_filtering(last_token_logits, top_k=top_k, top_p=top_p)
 
             last_token_logits = torch.log(torch.nn.functional.softmax(last_token_logits, dim=-1) * epsilon + torch.nn.functional.softmax(last_token_logits_filtered, dim=-1) * (1. - epsilon))
@@ -603,7 +616,8 @@ class SeqT5(T5ForConditionalGeneration):
                 last_token_logits, tau=0.0001, hard=True
             )
 
-            output_onehot.append(one_hot_softmax.unsqueeze(1))
+            # kept in the precision of the logits, bfloat16/float16 under autocast
+            output_onehot.append(one_hot_softmax.to(lm_logits.dtype).unsqueeze(1))
 
         with torch.no_grad():
             decoder_outputs = self.decoder(
@@ -630,7 +644,7 @@ class SeqT5(T5ForConditionalGeneration):
     def teacher_forcing_decode(
             self, decoder_input_ids, decoder_attention_mask, decoder_inputs_embeds, past_key_values,
             hidden_states, attention_mask, decoder_head_mask, head_mask, use_cache, output_attentions,
-            output_hidden_states, return_dict, top_k=0, top_p=1.
+            output_hidden_states, return_dict, top_k=0, top_p=1., compute_logits=True
     ):
         decoder_outputs = self.decoder(
             input_ids=decoder_input_ids,
@@ -647,7 +661,7 @@ class SeqT5(T5ForConditionalGeneration):
             return_dict=return_dict,
         )
 
-        lm_logits = self.compute_logits(decoder_outputs)
+        lm_logits = self.compute_logits(decoder_outputs) if compute_logits else None
         # lm_logits = top_k_top_p_filtering(lm_logits.permute(0,2,1), top_k=top_k, top_p=top_p).permute(0,2,1)  # this is implemented in method generate
 
         return decoder_outputs, lm_logits
@@ -697,7 +711,7 @@ class SeqT5(T5ForConditionalGeneration):
                                               decoder_head_mask, head_mask, output_attentions, output_hidden_states,
                                               dummy_tensor)
 
-            last_token_logits = lm_logits[:, -1, :] / temperature
+            last_token_logits = lm_logits[:, -1, :].float() / temperature  # sampling distribution in float32 under autocast
             last_token_logits_filtered = top_k_top_p_filtering(last_token_logits, top_k=top_k, top_p=top_p)
 
             last_token_logits = torch.log(torch.nn.functional.softmax(last_token_logits, dim=-1) * epsilon + torch.nn.functional.softmax(last_token_logits_filtered, dim=-1) * (1. - epsilon))
@@ -761,7 +775,7 @@ class SeqT5(T5ForConditionalGeneration):
                                               decoder_head_mask, head_mask, output_attentions, output_hidden_states,
                                               dummy_tensor)
 
-            last_token_logits = lm_logits[:, -1, :] / temperature
+            last_token_logits = lm_logits[:, -1, :].float() / temperature  # sampling distribution in float32 under autocast
             last_token_logits_filtered = top_k_top_p_filtering(last_token_logits, top_k=top_k, top_p=top_p)
 
             last_token_logits = torch.log(torch.nn.functional.softmax(last_token_logits, dim=-1) * epsilon + torch.nn.functional.softmax(last_token_logits_filtered, dim=-1) * (1. - epsilon))
@@ -823,7 +837,9 @@ class SeqT5(T5ForConditionalGeneration):
         top_k=0,
         top_p=1.,
         epsilon=0.,
-        ss_prob=0.
+        ss_prob=0.,
+        loss_chunk_size=None,  # compute the loss over chunks of the vocabulary, see utils.cross_entropy
+        logits_chunk_size=None,  # teacher forcing with labels: project chunks of positions, no logits are returned
     ):
         r"""
         labels (:obj:`torch.LongTensor` of shape :obj:`(batch_size,)`, `optional`):
@@ -915,13 +931,15 @@ class SeqT5(T5ForConditionalGeneration):
                 output_hidden_states, return_dict
             )
 
+        chunked_loss = decoding_style == "tf" and labels is not None and logits_chunk_size is not None
+
         if decoding_style == "tf":
-            decoder_outputs, lm_logits = self.teacher_forcing_decode(*decode_args, top_k=top_k, top_p=top_p)
+            decoder_outputs, lm_logits = self.teacher_forcing_decode(*decode_args, top_k=top_k, top_p=top_p, compute_logits=not chunked_loss)
             input_onehot = output_onehot = target_onehot = modified_logits = output_tokens = None
         elif decoding_style == "gumbel":
-            input_onehot = nn.functional.one_hot(input_ids, num_classes=self.decoder.embed_tokens.num_embeddings).float()
-            target_onehot = nn.functional.one_hot(decoder_input_ids, num_classes=self.decoder.embed_tokens.num_embeddings).float()
             decoder_outputs, lm_logits, output_onehot, modified_logits = self.gumbel_decode(*decode_args, temperature=temperature, top_k=top_k, top_p=top_p, epsilon=epsilon)
+            input_onehot = nn.functional.one_hot(input_ids, num_classes=self.decoder.embed_tokens.num_embeddings).to(output_onehot.dtype)
+            target_onehot = nn.functional.one_hot(decoder_input_ids, num_classes=self.decoder.embed_tokens.num_embeddings).to(output_onehot.dtype)
             output_tokens = None
         elif decoding_style == "rl":
             decoder_outputs, lm_logits, output_tokens, modified_logits = self.top_p_decode(*decode_args, temperature=temperature, top_k=top_k, top_p=top_p, epsilon=epsilon)
@@ -933,9 +951,10 @@ class SeqT5(T5ForConditionalGeneration):
             raise ValueError(f"`decoding_style` is {decoding_style} but supported values are: tf|gumbel|rl")
 
         loss = None
-        if labels is not None:
-            loss_fct = CrossEntropyLoss(ignore_index=-100)
-            loss = loss_fct(lm_logits.view(-1, lm_logits.size(-1)), labels.view(-1))  # TODO need to set temperature here?
+        if chunked_loss:
+            loss, output_tokens = self.compute_chunked_loss(decoder_outputs, labels, logits_chunk_size)
+        elif labels is not None:
+            loss = utils.cross_entropy(lm_logits, labels, ignore_index=-100, chunk_size=loss_chunk_size)  # TODO need to set temperature here?
             # TODO(thom): Add z_loss https://github.com/tensorflow/mesh/blob/fa19d69eafc9a482aff0b59ddd96b025c0cb207d/mesh_tensorflow/layers.py#L666
 
         if not return_dict:
@@ -5,7 +5,9 @@ from torch import cuda
 from torch.autograd import Variable
 
 import utils
+from discriminator_server import score_pairs
 from ModelTrainer import ModelTrainer, update_learning_rate
+from PGLoss import PGLoss
 import torch
 from discriminator import Discriminator, AttDiscriminator, GumbelDiscriminator, T5Discriminator, T5SemanticDiscriminator, BleurtDiscriminator
 import os
@@ -75,13 +77,18 @@ class SeqT5Trainer(ModelTrainer):
     def create_losses(self):
         # define loss function
         super(SeqT5Trainer, self).create_losses()
-        self.pg_criterion = lambda pred, true, reward, modified_logits, predicted_tokens: \
+        # both losses work on the logits, normalizing only the selected tokens
+        self._pg_criterion = PGLoss(ignore_index=self.dataset.dst_dict.pad(), size_average=True, reduce=True,
+                                    from_logits=True, chunk_size=self.args.vocab_chunk_size, clip=self.args.ppo_clip)
+        self.g_criterion = lambda pred, true: utils.cross_entropy(pred, true, chunk_size=self.args.vocab_chunk_size)
+        self.pg_criterion = lambda pred, true, reward, modified_logits, predicted_tokens, sample_logprobs=None: \
             self._pg_criterion(
-                self._logsoftmax(pred),
+                pred,
                 self.transform_for_t5(true),
-                reward,
-                self._logsoftmax(modified_logits) if modified_logits is not None else None,
-                self.transform_for_t5(predicted_tokens) if predicted_tokens is not None else None
+                reward.float(),
+                modified_logits,
+                self.transform_for_t5(predicted_tokens) if predicted_tokens is not None else None,
+                sample_logprobs,
             )
 
     def transform_for_t5(self, tensor):
@@ -90,7 +97,11 @@ class SeqT5Trainer(ModelTrainer):
     def transform_from_t5(self, tensor):
         return tensor + 1
 
-    def wrap_for_output(self, sample, logits, modified_logits=None, output_tokens=None, input_onehot=None, output_onehot=None, target_onehot=None):
+    def get_labels(self, target):
+        """T5 labels of the target, ignored by the loss (-100) after the first eos"""
+        return self.transform_for_t5(target).masked_fill(~self.get_length_mask(target), -100)
+
+    def wrap_for_output(self, sample, logits, modified_logits=None, output_tokens=None, input_onehot=None, output_onehot=None, target_onehot=None, loss=None):
         if input_onehot is not None: # add zeros to use indexing from 1
             zeros = torch.zeros((input_onehot.shape[0], input_onehot.shape[1], 1)).to(input_onehot.device)
             input_onehot = torch.cat([zeros, input_onehot], dim=2)
@@ -117,37 +128,56 @@ class SeqT5Trainer(ModelTrainer):
             "modified_logits": modified_logits,
         }
 
-        output["loss"] = self.g_criterion(
-            output["logits"][output["mask"], :],
-            self.transform_for_t5(output["target"])[output["mask"]]
-        )
+        # the loss computed by the model over the same logits, if given
+        if loss is None:
+            loss = self.g_criterion(output["logits"], self.get_labels(output["target"]))
+        output["loss"] = loss
         return output
 
-    def sequential_generation(self, sample, decoding_style="rl", top_k=0, top_p=1.0, temp=.2, ss_prob=0.):
-        t5out = self.generator(
+    def sequential_generation(self, sample, decoding_style="rl", top_k=0, top_p=1.0, temp=.2, ss_prob=0., generator=None):
+        generator = generator if generator is not None else self.generator
+        t5out = generator(
             self.transform_for_t5(sample['net_input']['src_tokens']), attention_mask=sample["attention_mask"],
-            labels=self.transform_for_t5(sample['target']), decoding_style=decoding_style, top_k=top_k, top_p=top_p,
-            temperature=temp, epsilon=self.args.imp_smpl_epsilon, ss_prob=ss_prob
+            labels=self.get_labels(sample['target']), decoding_style=decoding_style, top_k=top_k, top_p=top_p,
+            temperature=temp, epsilon=self.args.imp_smpl_epsilon, ss_prob=ss_prob,
+            loss_chunk_size=self.args.vocab_chunk_size
         )
 
         # if decoding_style == "gumbel":
         #     return self.wrap_for_output(sample, t5out.logits, input_onehot=t5out.input_onehot, output_onehot=t5out.output_onehot, target_onehot=t5out.target_onehot)
         return self.wrap_for_output(
             sample, t5out.logits, modified_logits=t5out.modified_logits, output_tokens=t5out.output_tokens,
-            input_onehot=t5out.input_onehot, output_onehot=t5out.output_onehot, target_onehot=t5out.target_onehot
+            input_onehot=t5out.input_onehot, output_onehot=t5out.output_onehot, target_onehot=t5out.target_onehot,
+            loss=t5out.loss
         )
 
     def teacher_forcing_generation(self, sample):
         t5out = self.generator(
             self.transform_for_t5(sample['net_input']['src_tokens']), attention_mask=sample["attention_mask"],
-            labels=self.transform_for_t5(sample['target']), decoding_style="tf"
+            labels=self.get_labels(sample['target']), decoding_style="tf",
+            loss_chunk_size=self.args.vocab_chunk_size, logits_chunk_size=self.args.logits_chunk_size
         )
 
         return self.wrap_for_output(
             sample, t5out.logits, modified_logits=t5out.modified_logits, output_tokens=t5out.output_tokens,
-            input_onehot=t5out.input_onehot, output_onehot=t5out.output_onehot, target_onehot=t5out.target_onehot
+            input_onehot=t5out.input_onehot, output_onehot=t5out.output_onehot, target_onehot=t5out.target_onehot,
+            loss=t5out.loss
         )
 
+    def policy_logits(self, sample, prediction):
+        # decoder inputs of top_p_decode: the start token, then the sampled tokens
+        tokens = self.transform_for_t5(prediction)
+        decoder_input_ids = torch.cat([tokens.new_zeros(tokens.size(0), 1), tokens[:, :-1]], dim=1)
+        t5out = self.generator(
+            self.transform_for_t5(sample['net_input']['src_tokens']), attention_mask=sample["attention_mask"],
+            decoder_input_ids=decoder_input_ids, decoding_style="tf"
+        )
+        return t5out.logits
+
+    def rollout_logprobs(self, output):
+        logits = output["modified_logits"] if output["modified_logits"] is not None else output["logits"]
+        return self._pg_criterion.select(logits, self.transform_for_t5(output["prediction"]))[0]
+
     def eval_generation(self, sample):
         return self.sequential_generation(sample, decoding_style=self.sequential_decoding_style, top_k=1, temp=.5)
 
@@ -204,48 +234,47 @@ class SeqT5Bleurt(SeqT5Trainer):
                                                                    args.g_learning_rate)
         self.d_optimizer = None
 
+    def prepare_sample(self, sample):
+        if sample:
+            sample = self.format_sample(sample)
+
+        if self.use_cuda:
+            # wrap input tensors in cuda tensors
+            sample = utils.make_variable(sample, cuda=cuda, gpu_id=f'cuda:{self.args.gpuid[0]}')
+        return sample
+
     def train_loop(self, trainloader, epoch_i, num_update):
-        for i, sample in enumerate(trainloader):
+        if self.actor is not None:
+            # the actor prepares the batches and samples their rollouts ahead of the updates
+            batches = self.actor.rollouts(trainloader, self.prepare_sample, self.actor_rollout)
+        else:
+            batches = map(self.prepare_sample, trainloader)
 
-            sample = self.format_sample(sample)
+        try:
+            for i, sample in enumerate(batches):
 
-            if self.use_cuda:
-                # wrap input tensors in cuda tensors
-                sample = utils.make_variable(sample, cuda=cuda, gpu_id=f'cuda:{self.args.gpuid[0]}')
+                if self.args.reduce_tf_frac:
+                    mle_frac = max(self.args.epochs - epoch_i, 1) / self.args.epochs
+                else:
+                    mle_frac = 0.5
 
-            if self.args.reduce_tf_frac:
-                mle_frac = max(self.args.epochs - epoch_i, 1) / self.args.epochs
-            else:
-                mle_frac = 0.5
-
-            if epoch_i > self.args.discriminator_pretraining or not hasattr(self, "discriminator"):
-                if hasattr(self, "discriminator"):
-                    if self.training_strategy == "alternate":
-                        if random.random() <= mle_frac:
-                            self.mle_step(sample, i, epoch_i, len(trainloader))
-                        else:
-                            # if random.random() > 0.5:
-                            #     self.mle_step(sample, i, epoch_i, len(trainloader), seq_decoding=True)
-                            # else:
-                            self.pg_step(sample, i, epoch_i, len(trainloader))
-                    elif self.training_strategy == "mle":
-                        self.mle_step(sample, i, epoch_i, len(trainloader))
-                    elif self.training_strategy == "rl":
-                        self.pg_step(sample, i, epoch_i, len(trainloader))
-                    else:
-                        raise ValueError(
-                            f"Invalid training strategy: {self.training_strategy}. Valid options are: alternate|mle|rl.")
+                if epoch_i > self.args.discriminator_pretraining or not hasattr(self, "discriminator"):
+                    if self.generator_step(sample, i, epoch_i, len(trainloader), mle_frac):
+                        num_update += 1
                 else:
-                    self.mle_step(sample, i, epoch_i, len(trainloader))
-                num_update += 1
-            else:
-                if i == 0 and epoch_i == 1:
-                    print(f"Pretraining discriminator for {self.args.discriminator_pretraining} epochs")
+                    if i == 0 and epoch_i == 1:
+                        print(f"Pretraining discriminator for {self.args.discriminator_pretraining} epochs")
+        finally:
+            if self.actor is not None:
+                # stops the actor thread also if the learner failed
+                batches.close()
 
         return num_update
 
     def eval_loop(self, valloader, epoch_i, force=False):
         for i, sample in enumerate(valloader):
+            if not sample:
+                continue  # empty batch of the last shards in distributed training
 
             sample = self.format_sample(sample, extra_tokens=50)
 
@@ -256,7 +285,8 @@ class SeqT5Bleurt(SeqT5Trainer):
 
                 if epoch_i > self.args.discriminator_pretraining or not hasattr(self, "discriminator") or force is True:
                     # generator validation
-                    output = self.eval_generation(sample)
+                    with self.autocast():
+                        output = self.eval_generation(sample)
                     self.evaluate_generator(
                         sample["net_input"]["src_tokens"], output["prediction"], output["target"], output["mask"], output["loss"], ntokens=sample["ntokens"],
                         batch_i=i, epoch_i=epoch_i, num_batches=len(valloader), partition="valid", strategy="mle", accumulate=i<len(valloader)-1, write_sents=True
@@ -265,15 +295,22 @@ class SeqT5Bleurt(SeqT5Trainer):
     def pg_step(self, sample, batch_i, epoch, loader_len):
         # print("Policy Gradient Training")
 
-        output = self.sequential_generation(sample, decoding_style=self.sequential_decoding_style, top_k=0, top_p=0.6)
+        with self.autocast():
+            if "rollout" in sample:
+                output = self.replay_generation(sample, sample["rollout"])
+            else:
+                output = self.sequential_generation(sample, decoding_style=self.sequential_decoding_style, top_k=0, top_p=0.6)
 
-        with torch.no_grad():
-            reward = self.discriminator(output["prediction"], sample["target"]) # dim (bsize x 1)
-            reward = reward.cuda(f'cuda:{self.args.gpuid[0]}')
+            with torch.no_grad():
+                reward = self.discriminator(output["prediction"], sample["target"]) # dim (bsize x 1)
+                reward = reward.cuda(f'cuda:{self.args.gpuid[0]}')
+
+            pg_loss = self.pg_criterion(output["logits"], sample['target'], reward, output.get("modified_logits", None), output.get("prediction", None),
+                                        output.get("sample_logprobs", None))# + \
+            # self.pg_criterion(output["logits"], sample['target'], gen_reward, output.get("modified_logits", None),
+            #                   output.get("prediction", None))
 
-        pg_loss = self.pg_criterion(output["logits"], sample['target'], reward, output.get("modified_logits", None), output.get("prediction", None))# + \
-        # self.pg_criterion(output["logits"], sample['target'], gen_reward, output.get("modified_logits", None),
-        #                   output.get("prediction", None))
+        self.add_to_replay_buffer(sample, output, reward)
 
         with torch.no_grad():
             if (batch_i + (epoch - 1) * loader_len) % self.args.train_bleu_every == 0:
@@ -282,10 +319,10 @@ class SeqT5Bleurt(SeqT5Trainer):
                     sample['ntokens'], batch_i=batch_i, epoch_i=epoch, num_batches=loader_len, partition="train", strategy="rl"
                 )
 
-        self.g_optimizer.zero_grad()
-        pg_loss.backward()
-        torch.nn.utils.clip_grad_norm_(self.generator.parameters(), self.args.clip_norm)
-        self.g_optimizer.step()
+        # the policy gradient loss is averaged over the sentences
+        bsz = sample['target'].size(0)
+        return self.optimizer_step(pg_loss * bsz, bsz, sample['ntokens'], self.g_optimizer, self.g_scaler,
+                                   self.args.g_update_tokens, self.generator.parameters())
 
     def evaluate_generator(
             self, original, predictions, targets, target_mask, loss, ntokens, batch_i, epoch_i, num_batches, partition=None,
@@ -299,8 +336,9 @@ class SeqT5Bleurt(SeqT5Trainer):
 
         if hasattr(self, "discriminator"):
             with torch.no_grad():
-                discr_score_neg = self.discriminator(predictions, targets).mean()
-                discr_score_pos = self.discriminator(targets, targets).mean()
+                discr_score_neg, discr_score_pos = score_pairs(self.discriminator, predictions, targets, targets, targets,
+                                                               self.positive_scores)
+                discr_score_neg, discr_score_pos = discr_score_neg.mean(), discr_score_pos.mean()
         else:
             discr_score_neg = 0.
             discr_score_pos = 0.
@@ -386,14 +424,16 @@ class SeqT5Gumbel(SeqT5RL):
 
         if seq_decoding:
             print("Seq MLE Training")
-            output = self.sequential_generation(sample, decoding_style=self.sequential_decoding_style, top_k=0,
-                                                top_p=0.6)
+            with self.autocast():
+                output = self.sequential_generation(sample, decoding_style=self.sequential_decoding_style, top_k=0,
+                                                    top_p=0.6)
         else:
             print("MLE Training")
-            output = self.teacher_forcing_generation(sample)
+            with self.autocast():
+                output = self.teacher_forcing_generation(sample)
 
         loss = output["loss"]
-        # sample_size = sample['target'].size(0) if self.args.sentence_avg else sample['ntokens']
+        sample_size, ntokens = self.generator_sample_size(sample, output)
 
         with torch.no_grad():
             if (batch_i + (epoch - 1) * loader_len) % 20 == 0:
@@ -403,14 +443,9 @@ class SeqT5Gumbel(SeqT5RL):
                     strategy="mle"
                 )
 
-        self.g_optimizer.zero_grad()
-        loss.backward()
-        # all-reduce grads and rescale by grad_denom
-        # for p in self.generator.parameters():
-        #     if p.requires_grad:
-        #         p.grad.data.div_(sample_size)
-        torch.nn.utils.clip_grad_norm_(self.generator.parameters(), self.args.clip_norm)
-        self.g_optimizer.step()
+        # the gradients are rescaled by the accumulated sample_size in optimizer_step
+        return self.optimizer_step(loss * ntokens, sample_size, sample['ntokens'], self.g_optimizer, self.g_scaler,
+                                   self.args.g_update_tokens, self.generator.parameters())
 
     # def create_discriminator(self, args):
     #     self.discriminator = GumbelDiscriminator(args, self.dataset.src_dict, self.dataset.dst_dict,
@@ -0,0 +1,101 @@
+import copy
+import queue
+import threading
+
+import torch
+
+
+class RolloutActor:
+    """
+    Samples the policy gradient rollouts of the training batches in a background thread, with its own copy of
+    the generator, while the learner trains on the rollouts sampled before. The batches come out in the order
+    of the loader, with sample["rollout"] holding the sampled tokens, their log-probabilities under the sampling
+    distribution (for the importance sampling correction of PGLoss) and the number of learner updates the actor
+    weights are from. The learner hands its weights over with sync() after its updates; the actor loads them
+    before its next rollout, every sync_every updates. At most buffer_size batches wait for the learner.
+    """
+
+    _END = object()
+
+    def __init__(self, generator, buffer_size=2, sync_every=1):
+        self.generator = copy.deepcopy(generator)
+        self.buffer_size = buffer_size
+        self.sync_every = sync_every
+        self.updates = 0
+        self.version = 0
+        self.weights = None  # (version, state dict) handed over by the learner, not loaded yet
+        self.lock = threading.Lock()
+
+    def sync(self, generator):
+        """Called by the learner after each update of generator."""
+        self.updates += 1
+        if self.updates % self.sync_every != 0:
+            return
+        state = {k: v.detach().clone() for k, v in generator.state_dict().items()}
+        with self.lock:
+            self.weights = (self.updates, state, generator.training)
+
+    def load_weights(self):
+        with self.lock:
+            weights, self.weights = self.weights, None
+        if weights is not None:
+            self.version, state, training = weights
+            self.generator.load_state_dict(state)
+            self.generator.train(training)
+
+    def rollouts(self, loader, prepare, rollout):
+        """
+        Iterate over the batches of loader, formatted by prepare(sample), with sample["rollout"] set to
+        rollout(sample, generator) for the non-empty ones. The actor thread stops when the iteration ends,
+        also early: the learner should close() the iterator if it stops consuming, e.g. on an exception.
+        """
+        samples = queue.Queue(maxsize=self.buffer_size)
+        stop = threading.Event()
+        device = next(self.generator.parameters()).device
+
+        def put(item):
+            # gives up once the learner stopped consuming, instead of blocking on the full queue
+            while not stop.is_set():
+                try:
+                    samples.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                if device.type == "cuda":
+                    torch.cuda.set_device(device)  # the current device is per thread
+                for sample in loader:
+                    sample = prepare(sample)
+                    if sample:
+                        self.load_weights()
+                        sample["rollout"] = rollout(sample, self.generator)
+                        sample["rollout"]["version"] = self.version
+                    if not put(sample):
+                        return
+            except Exception as e:
+                put(e)
+            finally:
+                put(self._END)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                sample = samples.get()
+                if sample is self._END:
+                    break
+                if isinstance(sample, Exception):
+                    raise sample
+                yield sample
+        finally:
+            stop.set()
+            # release the rollouts sampled ahead
+            try:
+                while True:
+                    samples.get_nowait()
+            except queue.Empty:
+                pass
+            producer.join()
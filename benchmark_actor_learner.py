@@ -0,0 +1,105 @@
+import argparse
+import copy
+import time
+
+import torch
+import torch.nn.functional as F
+
+from actor_learner import RolloutActor
+from benchmark_amp import build_model
+from benchmark_decoder import make_sample
+from dictionary import Dictionary
+from PGLoss import PGLoss
+
+parser = argparse.ArgumentParser(description="Compare the sequential policy gradient updates of the LSTM generator "
+                                             "with the actor-learner ones on CPU.")
+parser.add_argument('--embed-dim', default=256, type=int)
+parser.add_argument('--layers', default=2, type=int)
+parser.add_argument('--vocab', default=10000, type=int)
+parser.add_argument('--src-len', default=30, type=int)
+parser.add_argument('--tgt-len', default=20, type=int)
+parser.add_argument('--bsz', default=32, type=int)
+parser.add_argument('--batches', default=8, type=int)
+parser.add_argument('--buffer-size', default=2, type=int)
+parser.add_argument('--threads', default=None, type=int,
+                    help='number of CPU threads (default: torch default)')
+parser.add_argument("--seed", default=1, type=int)
+
+
+def reward_fn(prediction):
+    # stands in for the discriminator
+    return (prediction % 2 == 0).float()
+
+
+def update(model, optimizer, logits, sample, prediction, modified_logits=None, sample_logprobs=None):
+    """As ModelTrainer.pg_step"""
+    criterion = PGLoss(size_average=True)
+    loss = criterion(F.log_softmax(logits.float(), -1), sample['target'], reward_fn(prediction),
+                     F.log_softmax(modified_logits, -1) if modified_logits is not None else None,
+                     prediction, sample_logprobs)
+    optimizer.zero_grad()
+    loss.backward()
+    torch.nn.utils.clip_grad_norm_(model.parameters(), 5.0)
+    optimizer.step()
+
+
+def sequential(model, samples):
+    optimizer = torch.optim.SGD(model.parameters(), 0.1)
+    for sample in samples:
+        logits, prediction, modified_logits = model.rollout(sample, top_p=0.6, epsilon=0.1)
+        update(model, optimizer, logits, sample, prediction, modified_logits)
+        with torch.no_grad():
+            model.rollout(sample, top_p=0.6, epsilon=0.1)  # negatives of the discriminator step
+
+
+def actor_learner(model, samples, buffer_size):
+    optimizer = torch.optim.SGD(model.parameters(), 0.1)
+    actor = RolloutActor(model, buffer_size=buffer_size)
+
+    def rollout(sample, generator):
+        with torch.no_grad():
+            logits, prediction, modified_logits = generator.rollout(sample, top_p=0.6, epsilon=0.1)
+        logprobs = F.log_softmax(modified_logits, -1).gather(2, prediction.unsqueeze(2)).squeeze(2)
+        return {"prediction": prediction, "logprobs": logprobs}
+
+    for sample in actor.rollouts(samples, lambda sample: dict(sample), rollout):
+        prediction = sample["rollout"]["prediction"]
+        # teacher forcing on the sampled tokens, as ModelTrainer.policy_logits
+        prev_output_tokens = torch.cat([prediction.new_full((prediction.size(0), 1), model.dst_dict.eos()),
+                                        prediction[:, :-1]], dim=1)
+        logits = model(dict(sample, net_input=dict(sample['net_input'], prev_output_tokens=prev_output_tokens)))
+        update(model, optimizer, logits, sample, prediction, sample_logprobs=sample["rollout"]["logprobs"])
+        actor.sync(model)
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    dictionary = Dictionary()
+    for i in range(args.vocab):
+        dictionary.add_symbol('w{}'.format(i))
+    samples = []
+    for _ in range(args.batches):
+        sample = make_sample(dictionary, args.bsz, args.src_len, args.tgt_len)
+        sample['target'] = torch.cat([sample['net_input']['prev_output_tokens'][:, 1:],
+                                      torch.full((args.bsz, 1), dictionary.eos())], dim=1)
+        samples.append(sample)
+
+    model = build_model(args, dictionary)
+    model.train()
+    times = {}
+    for name, fn in (('sequential', lambda m: sequential(m, samples)),
+                     ('actor-learner', lambda m: actor_learner(m, samples, args.buffer_size))):
+        m = copy.deepcopy(model)
+        start = time.time()
+        fn(m)
+        times[name] = time.time() - start
+        print('| {:13s} {:6.2f} s, {:6.0f} target tokens/s'.format(
+            name, times[name], args.batches * args.bsz * args.tgt_len / times[name]))
+    print('| speedup {:.2f}x'.format(times['sequential'] / times['actor-learner']))
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
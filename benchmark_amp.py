@@ -0,0 +1,102 @@
+import argparse
+import copy
+import time
+import types
+
+import torch
+
+import utils
+from benchmark_decoder import make_sample
+from dictionary import Dictionary
+from generator import LSTMModel
+
+parser = argparse.ArgumentParser(description="Compare float32 and bfloat16 autocast training of the LSTM generator on CPU.")
+parser.add_argument('--embed-dim', default=512, type=int)
+parser.add_argument('--layers', default=2, type=int)
+parser.add_argument('--vocab', default=32000, type=int)
+parser.add_argument('--src-len', default=50, type=int)
+parser.add_argument('--tgt-len', default=30, type=int)
+parser.add_argument('--bsz', default=32, type=int)
+parser.add_argument('--iters', default=5, type=int)
+parser.add_argument('--threads', default=None, type=int,
+                    help='number of CPU threads (default: torch default)')
+parser.add_argument("--seed", default=1, type=int)
+
+
+def build_model(args, dictionary):
+    model_args = types.SimpleNamespace(
+        encoder_embed_dim=args.embed_dim, encoder_layers=args.layers,
+        encoder_dropout_in=0.1, encoder_dropout_out=0.1,
+        decoder_embed_dim=args.embed_dim, decoder_out_embed_dim=args.embed_dim,
+        decoder_layers=args.layers, decoder_dropout_in=0.1, decoder_dropout_out=0.1,
+    )
+    return LSTMModel(model_args, dictionary, dictionary, use_cuda=False)
+
+
+def autocast(dtype):
+    return torch.amp.autocast('cpu', dtype=dtype, enabled=dtype is not None)
+
+
+def mle_step(model, optimizer, sample, dtype):
+    """One teacher forcing update, as ModelTrainer.mle_step with --amp"""
+    with autocast(dtype):
+        logits = model(sample)
+        loss = utils.cross_entropy(logits, sample['target'])
+    optimizer.zero_grad()
+    loss.backward()
+    torch.nn.utils.clip_grad_norm_(model.parameters(), 5.0)
+    optimizer.step()
+    return loss.item()
+
+
+def rollout(model, sample, dtype):
+    with torch.no_grad(), autocast(dtype):
+        return model.rollout(sample, top_p=0.6, epsilon=0.1)
+
+
+def tokens_per_sec(fn, ntokens, iters):
+    fn()  # warm up
+    start = time.time()
+    for _ in range(iters):
+        fn()
+    return ntokens * iters / (time.time() - start)
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    dictionary = Dictionary()
+    for i in range(args.vocab):
+        dictionary.add_symbol('w{}'.format(i))
+    sample = make_sample(dictionary, args.bsz, args.src_len, args.tgt_len)
+    sample['target'] = torch.cat([sample['net_input']['prev_output_tokens'][:, 1:],
+                                  torch.full((args.bsz, 1), dictionary.eos())], dim=1)
+    ntokens = sample['target'].numel()
+
+    model = build_model(args, dictionary)
+    tps = {}
+    for name, dtype in (('float32', None), ('bfloat16', torch.bfloat16)):
+        m = copy.deepcopy(model)
+        optimizer = torch.optim.Adam(m.parameters(), 1e-3)
+
+        m.train()
+        losses = [mle_step(m, optimizer, sample, dtype) for _ in range(3)]
+        tps[name, 'train'] = tokens_per_sec(lambda: mle_step(m, optimizer, sample, dtype), ntokens, args.iters)
+
+        m.eval()
+        logits, _, modified_logits = rollout(m, sample, dtype)
+        assert modified_logits.dtype == torch.float32
+        tps[name, 'rollout'] = tokens_per_sec(lambda: rollout(m, sample, dtype), ntokens, args.iters)
+
+        print('| {:8s} losses of the first updates {} (logits {})'.format(
+            name, ' '.join('{:.4f}'.format(l) for l in losses), logits.dtype))
+
+    for mode in ('train', 'rollout'):
+        print('| {:7s} float32 {:8.0f} tok/s, bfloat16 autocast {:8.0f} tok/s ({:.2f}x)'.format(
+            mode, tps['float32', mode], tps['bfloat16', mode], tps['bfloat16', mode] / tps['float32', mode]))
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -0,0 +1,129 @@
+import argparse
+import copy
+import time
+import types
+
+import torch
+
+from dictionary import Dictionary
+from generator import LSTMModel, VarLSTMModel
+
+parser = argparse.ArgumentParser(description="Compare the eager and the TorchScript decoder step of the LSTM models.")
+parser.add_argument('--embed-dim', default=128, type=int)
+parser.add_argument('--layers', default=2, type=int)
+parser.add_argument('--vocab', default=10000, type=int)
+parser.add_argument('--src-len', default=50, type=int)
+parser.add_argument('--tgt-len', default=30, type=int)
+parser.add_argument('--batch-sizes', default=[1, 16, 64], nargs='+', type=int)
+parser.add_argument('--iters', default=10, type=int)
+parser.add_argument('--threads', default=None, type=int,
+                    help='number of CPU threads (default: torch default)')
+parser.add_argument("--seed", default=1, type=int)
+
+
+def build_models(model_cls, args, dictionary):
+    model_args = types.SimpleNamespace(
+        encoder_embed_dim=args.embed_dim, encoder_layers=args.layers,
+        encoder_dropout_in=0.1, encoder_dropout_out=0.1,
+        decoder_embed_dim=args.embed_dim, decoder_out_embed_dim=args.embed_dim,
+        decoder_layers=args.layers, decoder_dropout_in=0.1, decoder_dropout_out=0.1,
+    )
+    eager = model_cls(model_args, dictionary, dictionary, use_cuda=False)
+    scripted = copy.deepcopy(eager)
+    scripted.decoder.script_step()
+    return eager, scripted
+
+
+def make_sample(dictionary, bsz, src_len, tgt_len):
+    src_tokens = torch.randint(dictionary.nspecial, len(dictionary), (bsz, src_len))
+    prev_output_tokens = torch.randint(dictionary.nspecial, len(dictionary), (bsz, tgt_len))
+    prev_output_tokens[:, 0] = dictionary.eos()
+    return {
+        'net_input': {
+            'src_tokens': src_tokens,
+            'src_lengths': torch.LongTensor([src_len] * bsz),
+            'prev_output_tokens': prev_output_tokens,
+        },
+    }
+
+
+def decode(model, sample, incremental=False):
+    encoder_out = model.encoder(sample['net_input']['src_tokens'], sample['net_input']['src_lengths'])
+    prev_output_tokens = sample['net_input']['prev_output_tokens']
+    if not incremental:
+        return model.decoder(prev_output_tokens, encoder_out, inference=True)[:2]
+
+    incremental_state = {}
+    outs, attn = [], []
+    for j in range(prev_output_tokens.size(1)):
+        out = model.decoder(prev_output_tokens[:, :j + 1], encoder_out, incremental_state, inference=True)
+        outs.append(out[0])
+        attn.append(out[1])
+    return torch.cat(outs, dim=1), torch.cat(attn, dim=1)
+
+
+def check_parity(eager, scripted, sample, atol=1e-5):
+    """The scripted step gives the outputs, attention and gradients of the
+    eager one, in full and in incremental decoding."""
+    eager.eval()
+    scripted.eval()
+    with torch.no_grad():
+        for incremental in (False, True):
+            for a, b in zip(decode(eager, sample, incremental), decode(scripted, sample, incremental)):
+                assert torch.allclose(a, b, atol=atol), (a - b).abs().max()
+
+    for model in (eager, scripted):
+        model.zero_grad()
+        decode(model, sample)[0].logsumexp(dim=-1).sum().backward()
+    for (name, p1), p2 in zip(eager.named_parameters(), scripted.parameters()):
+        if p1.grad is not None:
+            assert torch.allclose(p1.grad, p2.grad, atol=atol), name
+
+
+def tokens_per_sec(model, sample, iters, train):
+    model.train(train)
+    ntokens = sample['net_input']['prev_output_tokens'].numel()
+
+    def run():
+        with torch.set_grad_enabled(train):
+            out = model(sample)
+            if isinstance(out, tuple):  # VarLSTMModel also returns the kld
+                out = out[0]
+            if train:
+                model.zero_grad()
+                out.sum().backward()
+
+    run()  # warm up, the scripted step is optimized on its first runs
+    run()
+    start = time.time()
+    for _ in range(iters):
+        run()
+    return ntokens * iters / (time.time() - start)
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    dictionary = Dictionary()
+    for i in range(args.vocab):
+        dictionary.add_symbol('w{}'.format(i))
+
+    for model_cls in (LSTMModel, VarLSTMModel):
+        eager, scripted = build_models(model_cls, args, dictionary)
+        check_parity(eager, scripted, make_sample(dictionary, 8, args.src_len, args.tgt_len))
+        print('| {}: scripted step matches the eager step'.format(model_cls.__name__))
+
+        for bsz in args.batch_sizes:
+            sample = make_sample(dictionary, bsz, args.src_len, args.tgt_len)
+            for train in (True, False):
+                eager_tps = tokens_per_sec(eager, sample, args.iters, train)
+                scripted_tps = tokens_per_sec(scripted, sample, args.iters, train)
+                print('| {} bsz {:4d} {:9s} eager {:10.0f} tok/s, scripted {:10.0f} tok/s ({:.2f}x)'.format(
+                    model_cls.__name__, bsz, 'train' if train else 'inference',
+                    eager_tps, scripted_tps, scripted_tps / eager_tps))
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
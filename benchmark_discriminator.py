@@ -0,0 +1,90 @@
+import argparse
+import time
+import types
+
+import torch
+
+from data import LanguagePairDataset
+from dictionary import Dictionary
+from discriminator import Discriminator
+
+parser = argparse.ArgumentParser(description="Check that the CNN discriminator does not depend on the padding of "
+                                             "the batch, and compare fixed-length and variable-length batches on CPU.")
+parser.add_argument('--vocab', default=1000, type=int)
+parser.add_argument('--fixed-max-len', default=50, type=int)
+parser.add_argument('--min-len', default=1, type=int)
+parser.add_argument('--max-len', default=20, type=int)
+parser.add_argument('--bsz', default=16, type=int)
+parser.add_argument('--iters', default=3, type=int)
+parser.add_argument('--threads', default=None, type=int,
+                    help='number of CPU threads (default: torch default)')
+parser.add_argument("--seed", default=1, type=int)
+
+
+def build_discriminator(args, dictionary):
+    # the first convolution takes 2000 channels, the source and target embeddings
+    model_args = types.SimpleNamespace(encoder_embed_dim=1000, decoder_embed_dim=1000,
+                                       fixed_max_len=args.fixed_max_len)
+    discriminator = Discriminator(model_args, dictionary, dictionary, use_cuda=False)
+    discriminator.eval()
+    return discriminator
+
+
+def make_pairs(args, dictionary):
+    lengths = torch.randint(args.min_len, args.max_len + 1, (args.bsz, 2)).tolist()
+    return [(torch.randint(dictionary.nspecial, len(dictionary), (src_len,)),
+             torch.randint(dictionary.nspecial, len(dictionary), (trg_len,))) for src_len, trg_len in lengths]
+
+
+def collate(pairs, dictionary, maxlen=None):
+    def merge(sentences):
+        return LanguagePairDataset.collate_tokens(sentences, dictionary.pad(), dictionary.eos(), left_pad=False,
+                                                  maxlen=maxlen)
+    src_tokens, trg_tokens = merge([src for src, _ in pairs]), merge([trg for _, trg in pairs])
+    return src_tokens, trg_tokens, src_tokens.ne(dictionary.pad()), trg_tokens.ne(dictionary.pad())
+
+
+def check(discriminator, pairs, dictionary, args):
+    """Each pair on its own, and in batches padded to their longest pair or to fixed_max_len, scores the same."""
+    with torch.no_grad():
+        alone = torch.cat([discriminator(*collate([pair], dictionary)) for pair in pairs])
+        # without masks, as trained on fixed-length batches (shorter inputs are padded to the pooling size)
+        for pair, score in zip(pairs, alone):
+            if min(pair[0].size(0), pair[1].size(0)) >= 4:
+                unmasked = discriminator(pair[0].unsqueeze(0), pair[1].unsqueeze(0))
+                assert torch.allclose(score, unmasked, atol=1e-6), (score - unmasked).abs().max()
+        for maxlen in (None, args.fixed_max_len):
+            batched = discriminator(*collate(pairs, dictionary, maxlen))
+            assert torch.allclose(alone, batched, atol=1e-6), (maxlen, (alone - batched).abs().max())
+    print('| scores do not depend on the padding of the batch')
+
+
+def timed(discriminator, batch, iters):
+    with torch.no_grad():
+        discriminator(*batch)
+        start = time.time()
+        for _ in range(iters):
+            discriminator(*batch)
+    return (time.time() - start) / iters
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    dictionary = Dictionary()
+    for i in range(args.vocab):
+        dictionary.add_symbol('w{}'.format(i))
+    discriminator = build_discriminator(args, dictionary)
+    pairs = make_pairs(args, dictionary)
+    check(discriminator, pairs, dictionary, args)
+
+    fixed = timed(discriminator, collate(pairs, dictionary, args.fixed_max_len), args.iters)
+    variable = timed(discriminator, collate(pairs, dictionary), args.iters)
+    print('| padded to {:3d}:           {:6.3f} s/batch'.format(args.fixed_max_len, fixed))
+    print('| padded to the longest pair: {:6.3f} s/batch ({:.2f}x)'.format(variable, fixed / variable))
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -0,0 +1,141 @@
+import argparse
+import copy
+import time
+import types
+
+import torch
+import torch.nn as nn
+
+from benchmark_amp import build_model
+from benchmark_decoder import make_sample
+from dictionary import Dictionary
+from discriminator_server import DiscriminatorClient, DiscriminatorServer
+
+parser = argparse.ArgumentParser(description="Compare the adversarial training loop with the discriminator in the "
+                                             "trainer process and in a discriminator server process on CPU.")
+parser.add_argument('--embed-dim', default=256, type=int)
+parser.add_argument('--layers', default=2, type=int)
+parser.add_argument('--d-embed-dim', default=256, type=int)
+parser.add_argument('--vocab', default=10000, type=int)
+parser.add_argument('--src-len', default=30, type=int)
+parser.add_argument('--tgt-len', default=20, type=int)
+parser.add_argument('--bsz', default=32, type=int)
+parser.add_argument('--batches', default=8, type=int)
+parser.add_argument('--staleness', default=[0, 1, 2], nargs='+', type=int)
+parser.add_argument('--threads', default=None, type=int,
+                    help='number of CPU threads of each process (default: torch default)')
+parser.add_argument("--seed", default=1, type=int)
+
+
+class TokenDiscriminator(nn.Module):
+    """Probability of each target token to be human written, from a GRU over the target and the mean source."""
+
+    def __init__(self, vocab, embed_dim):
+        super().__init__()
+        self.embed_tokens = nn.Embedding(vocab, embed_dim)
+        self.gru = nn.GRU(embed_dim, embed_dim, batch_first=True)
+        self.fc = nn.Linear(embed_dim, 1)
+
+    def forward(self, src_tokens, trg_tokens):
+        h0 = self.embed_tokens(src_tokens).mean(1).unsqueeze(0).contiguous()
+        out, _ = self.gru(self.embed_tokens(trg_tokens), h0)
+        return torch.sigmoid(self.fc(out).squeeze(2))
+
+
+def train_loop(generator, discriminator, samples):
+    """
+    As ModelTrainer.train_loop with the policy gradient objective, without the generator updates: the rewards
+    of a rollout, then a discriminator step on the negatives of another rollout.
+    """
+    rewards = 0.
+    for sample in samples:
+        src_tokens = sample['net_input']['src_tokens']
+        with torch.no_grad():
+            _, prediction, _ = generator.rollout(sample, top_p=0.6, epsilon=0.1)
+            rewards += discriminator.score(src_tokens, prediction).sum().item()
+            _, negatives, _ = generator.rollout(sample, top_p=0.6, epsilon=0.1)
+        discriminator.train_step(src_tokens, negatives, sample['target'], sample['target'].numel())
+    return rewards
+
+
+class InProcess:
+    """The discriminator of the trainer process, with the same steps as the server."""
+
+    def __init__(self, discriminator, config):
+        self.server = DiscriminatorServer(discriminator, config)
+
+    def score(self, src_tokens, trg_tokens):
+        return self.server.score(src_tokens, trg_tokens)
+
+    def train_step(self, *args):
+        self.server.train_step(*args)
+
+    def module(self):
+        return self.server.discriminator
+
+
+class Served:
+    def __init__(self, discriminator, args, staleness):
+        server_args = types.SimpleNamespace(discriminator_staleness=staleness, d_update_tokens=0, amp='none',
+                                            d_optimizer='SGD', d_learning_rate=0.1)
+        self.client = DiscriminatorClient(discriminator, server_args, 'cpu', num_threads=args.threads)
+        self.client.synchronize()  # the server process has started
+
+    def score(self, src_tokens, trg_tokens):
+        return self.client(src_tokens, trg_tokens)
+
+    def train_step(self, *args):
+        self.client.train_step(*args)
+
+    def module(self):
+        self.client.trained(block=True)
+        return self.client.module()
+
+
+def run(generator, discriminator, samples, seed):
+    torch.manual_seed(seed)
+    start = time.time()
+    rewards = train_loop(generator, discriminator, samples)
+    module = discriminator.module()
+    return time.time() - start, rewards, module
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    dictionary = Dictionary()
+    for i in range(args.vocab):
+        dictionary.add_symbol('w{}'.format(i))
+    samples = []
+    for _ in range(args.batches):
+        sample = make_sample(dictionary, args.bsz, args.src_len, args.tgt_len)
+        sample['target'] = torch.cat([sample['net_input']['prev_output_tokens'][:, 1:],
+                                      torch.full((args.bsz, 1), dictionary.eos())], dim=1)
+        samples.append(sample)
+
+    generator = build_model(args, dictionary)
+    generator.eval()
+    discriminator = TokenDiscriminator(len(dictionary), args.d_embed_dim)
+    config = {"device": "cpu", "staleness": 0, "update_tokens": 0, "amp": 'none', "optimizer": 'SGD', "lr": 0.1}
+
+    serial_time, serial_rewards, serial_module = run(
+        generator, InProcess(copy.deepcopy(discriminator), config), samples, args.seed)
+    print('| in process          {:6.2f} s, mean reward {:.4f}'.format(
+        serial_time, serial_rewards / (args.batches * args.bsz * args.tgt_len)))
+
+    for staleness in args.staleness:
+        served = Served(copy.deepcopy(discriminator), args, staleness)
+        served_time, rewards, module = run(generator, served, samples, args.seed)
+        served.client.close()
+        if staleness == 0:
+            # same updates in the same order
+            for p, q in zip(serial_module.parameters(), module.parameters()):
+                assert torch.allclose(p, q, atol=1e-5), (p - q).abs().max()
+        print('| server, staleness {} {:6.2f} s, mean reward {:.4f} ({:.2f}x)'.format(
+            staleness, served_time, rewards / (args.batches * args.bsz * args.tgt_len), serial_time / served_time))
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -0,0 +1,121 @@
+import argparse
+import os
+import tempfile
+import time
+import types
+
+import torch
+import torch.multiprocessing as mp
+import torch.nn as nn
+import torch.nn.functional as F
+
+import distributed_utils
+from ModelTrainer import ModelTrainer
+
+parser = argparse.ArgumentParser(description="Check the gradients of data parallel training over gloo CPU workers "
+                                             "against the full batch gradients of a single process.")
+parser.add_argument('--world-size', default=[2, 3, 4], nargs='+', type=int)
+parser.add_argument('--bsz', default=24, type=int)
+parser.add_argument('--dim', default=64, type=int)
+parser.add_argument('--buffer-size', default=1000, type=int,
+                    help='elements per all-reduce bucket, small enough to split the gradients in several buckets')
+parser.add_argument("--seed", default=1, type=int)
+
+
+def make_model(args):
+    torch.manual_seed(args.seed)
+    return nn.Sequential(nn.Linear(args.dim, args.dim), nn.Tanh(), nn.Linear(args.dim, 4))
+
+
+def make_data(args):
+    g = torch.Generator().manual_seed(args.seed)
+    return torch.randn(args.bsz, args.dim, generator=g), torch.randint(4, (args.bsz,), generator=g)
+
+
+def loss_sum(model, x, y):
+    """The loss summed over the items of the batch, None for an empty batch"""
+    if x.size(0) == 0:
+        return None
+    return F.cross_entropy(model(x), y, reduction='sum')
+
+
+def full_batch_grads(model, x, y):
+    model.zero_grad()
+    (loss_sum(model, x, y) / x.size(0)).backward()
+    return [p.grad.clone() for p in model.parameters()]
+
+
+def shard(x, y, rank, world_size, empty_rank=None):
+    """The items of worker rank, none for empty_rank"""
+    ranks = [r for r in range(world_size) if r != empty_rank]
+    if rank not in ranks:
+        return x[:0], y[:0]
+    i = ranks.index(rank)
+    return x[i::len(ranks)], y[i::len(ranks)]
+
+
+def assert_close(tensors, expected, what):
+    for t, e in zip(tensors, expected):
+        assert torch.allclose(t, e, atol=1e-6), '{}: {}'.format(what, (t - e).abs().max())
+
+
+def check_all_reduce(args, rank, world_size, empty_rank=None):
+    """all_reduce_and_rescale_gradients of the shard gradients equals the full batch gradients."""
+    model = make_model(args)
+    x, y = make_data(args)
+    expected = full_batch_grads(model, x, y)
+
+    model.zero_grad(set_to_none=True)
+    loss = loss_sum(model, *shard(x, y, rank, world_size, empty_rank))
+    if loss is not None:
+        loss.backward()
+    params = list(model.parameters())
+    distributed_utils.all_reduce_and_rescale_gradients(params, x.size(0), buffer_size=args.buffer_size)
+    assert_close([p.grad for p in params], expected, 'all-reduced gradients')
+
+
+def check_optimizer_step(args, rank, world_size):
+    """
+    ModelTrainer.optimizer_step accumulating two micro-batches per update, with an empty micro-batch on the
+    last worker, takes the SGD step of the full batch gradients.
+    """
+    x, y = make_data(args)
+    reference = make_model(args)
+    expected = full_batch_grads(reference, x, y)
+    expected = [p.detach() - 0.1 * g for p, g in zip(reference.parameters(), expected)]
+
+    model = make_model(args)
+    optimizer = torch.optim.SGD(model.parameters(), 0.1)
+    scaler = torch.amp.GradScaler('cpu', enabled=False)
+    trainer = types.SimpleNamespace(args=types.SimpleNamespace(distributed_world_size=world_size),
+                                    accumulated={})
+    half = args.bsz // 2
+    micro_batches = [(x[:half], y[:half], None), (x[half:], y[half:], world_size - 1)]
+    for i, (mx, my, empty_rank) in enumerate(micro_batches):
+        sx, sy = shard(mx, my, rank, world_size, empty_rank)
+        updated = ModelTrainer.optimizer_step(trainer, loss_sum(model, sx, sy), sx.size(0), sx.size(0), optimizer,
+                                              scaler, update_tokens=args.bsz)
+        assert updated == (i == len(micro_batches) - 1), (i, updated)
+    assert_close([p.detach() for p in model.parameters()], expected, 'parameters after the update')
+
+
+def worker(rank, args, world_size, init_file):
+    torch.set_num_threads(1)
+    torch.distributed.init_process_group('gloo', init_method='file://' + init_file, world_size=world_size, rank=rank)
+    check_all_reduce(args, rank, world_size)
+    check_all_reduce(args, rank, world_size, empty_rank=world_size - 1)
+    check_optimizer_step(args, rank, world_size)
+    torch.distributed.destroy_process_group()
+
+
+def main(args):
+    for world_size in args.world_size:
+        init_file = os.path.join(tempfile.mkdtemp(), 'init')
+        start = time.time()
+        mp.spawn(worker, args=(args, world_size, init_file), nprocs=world_size)
+        print('| {} workers: gradients and updates match the full batch ones ({:.1f} s)'.format(
+            world_size, time.time() - start))
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
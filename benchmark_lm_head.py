@@ -0,0 +1,101 @@
+import argparse
+import multiprocessing
+
+import torch
+import torch.nn.functional as F
+
+import utils
+from benchmark_pg_loss import rss_mb
+
+parser = argparse.ArgumentParser(description="Check the chunked lm_head projection and loss against the dense one "
+                                             "and compare their peak memory.")
+parser.add_argument('--bsz', default=16, type=int)
+parser.add_argument('--seqlen', default=128, type=int)
+parser.add_argument('--d-model', default=512, type=int)
+parser.add_argument('--vocab', default=32128, type=int)
+parser.add_argument('--chunk-size', default=256, type=int,
+                    help='number of positions projected at a time')
+parser.add_argument("--seed", default=1, type=int)
+
+
+def make_inputs(args, device='cpu'):
+    torch.manual_seed(args.seed)
+    hidden = torch.randn(args.bsz, args.seqlen, args.d_model, device=device, requires_grad=True)
+    weight = (torch.randn(args.vocab, args.d_model, device=device) * args.d_model ** -0.5).requires_grad_()
+    labels = torch.randint(args.vocab, (args.bsz, args.seqlen), device=device)
+    labels[:, args.seqlen // 2:] = -100  # padding after eos
+    return hidden, weight, labels
+
+
+def dense_loss(hidden, weight, labels, chunk_size=None):
+    logits = F.linear(hidden, weight)
+    return F.cross_entropy(logits.view(-1, logits.size(-1)), labels.view(-1), ignore_index=-100)
+
+
+def chunked_loss(hidden, weight, labels, chunk_size):
+    return utils.linear_cross_entropy(hidden, weight, labels, chunk_size=chunk_size)[0]
+
+
+LOSSES = {'dense': dense_loss, 'chunked': chunked_loss}
+
+
+def check(args):
+    """Same loss and gradients for the hidden states and the projection."""
+    small = argparse.Namespace(**vars(args))
+    small.bsz, small.seqlen, small.vocab = 4, 16, 1000
+    hidden, weight, labels = make_inputs(small)
+    results = []
+    for name in ('dense', 'chunked'):
+        hidden.grad = weight.grad = None
+        loss = LOSSES[name](hidden, weight, labels, chunk_size=7)
+        loss.backward()
+        results.append((loss.detach(), hidden.grad.clone(), weight.grad.clone()))
+    for a, b in zip(*results):
+        assert torch.allclose(a, b, rtol=1e-4, atol=1e-6), (a - b).abs().max()
+    print('| loss and gradients match the dense implementation')
+
+
+def peak_memory(name, args, device, result):
+    """Peak memory (MB) of one forward/backward above the inputs."""
+    inputs = make_inputs(args, device)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated() / 2 ** 20
+    else:
+        # reset the peak resident set size of the process (linux)
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        base = rss_mb('VmRSS')
+
+    LOSSES[name](*inputs, chunk_size=args.chunk_size).backward()
+
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() / 2 ** 20
+    else:
+        peak = rss_mb('VmHWM')
+    result.put(peak - base)
+
+
+def main(args):
+    check(args)
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    ctx = multiprocessing.get_context('spawn')
+    peaks = {}
+    for name in ('dense', 'chunked'):
+        result = ctx.Queue()
+        p = ctx.Process(target=peak_memory, args=(name, args, device, result))
+        p.start()
+        peaks[name] = result.get()
+        p.join()
+        print('| {:7s} lm_head + loss forward/backward: peak {:8.1f} MB above the inputs ({})'.format(
+            name, peaks[name], device))
+
+    logits_mb = args.bsz * args.seqlen * args.vocab * 4 / 2 ** 20
+    print('| saved {:.1f} MB, the logits are {:.1f} MB'.format(peaks['dense'] - peaks['chunked'], logits_mb))
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -0,0 +1,161 @@
+import argparse
+import multiprocessing
+
+import torch
+import torch.nn.functional as F
+
+from PGLoss import PGLoss
+
+parser = argparse.ArgumentParser(description="Check PGLoss against the dense one-hot formulation and compare their peak memory.")
+parser.add_argument('--bsz', default=16, type=int)
+parser.add_argument('--seqlen', default=64, type=int)
+parser.add_argument('--vocab', default=32128, type=int)
+parser.add_argument("--seed", default=1, type=int)
+
+
+def dense_pg_loss(logprobs, label, reward, modified_logprobs=None, predicted_tokens=None, size_average=True):
+    """The previous PGLoss, with dense one-hot masks over the vocabulary."""
+    bsz, seqlen, _ = logprobs.size()
+
+    logprobs = logprobs.clone()
+
+    def create_mask(l_probs, lbl):
+        with torch.no_grad():
+            mask = torch.zeros_like(l_probs)
+            mask = torch.scatter(mask, 2, lbl.unsqueeze(2), 1.)
+        return mask
+
+    logprobs_mask = create_mask(logprobs, label)
+    loss = -torch.sum(torch.sum(logprobs * reward.unsqueeze(2) * logprobs_mask, dim=-1), dim=-1)
+
+    if size_average:
+        loss = loss/bsz
+
+    if modified_logprobs is not None:
+        modified_logprobs_mask = create_mask(modified_logprobs, predicted_tokens)
+        with torch.no_grad():
+            modified_logprobs_sum = torch.sum(torch.log(torch.sum(torch.exp(modified_logprobs) * modified_logprobs_mask, dim=-1)), dim=-1)
+            logprobs_sum = torch.sum(torch.log(torch.sum(torch.exp(logprobs) * modified_logprobs_mask, dim=-1)), dim=-1)
+            importance_sampling_correct_coef = torch.exp(logprobs_sum - modified_logprobs_sum)
+        loss = importance_sampling_correct_coef * loss
+
+    return loss.sum()
+
+
+def make_inputs(args, device='cpu'):
+    torch.manual_seed(args.seed)
+    logits = torch.randn(args.bsz, args.seqlen, args.vocab, device=device, requires_grad=True)
+    label = torch.randint(args.vocab, (args.bsz, args.seqlen), device=device)
+    reward = torch.rand(args.bsz, args.seqlen, device=device)
+    modified_logprobs = F.log_softmax(torch.randn(args.bsz, args.seqlen, args.vocab, device=device), dim=-1)
+    predicted_tokens = torch.randint(args.vocab, (args.bsz, args.seqlen), device=device)
+    return logits, label, reward, modified_logprobs, predicted_tokens
+
+
+def loss_fn(name):
+    if name == 'dense':
+        return dense_pg_loss
+    return PGLoss(size_average=True, reduce=True)
+
+
+def check(args):
+    """Same loss and gradients, with and without importance sampling."""
+    logits, label, reward, modified_logprobs, predicted_tokens = make_inputs(args)
+    for extra in ((), (modified_logprobs, predicted_tokens)):
+        results = []
+        for name in ('dense', 'gather'):
+            logits.grad = None
+            loss = loss_fn(name)(F.log_softmax(logits, dim=-1), label, reward, *extra)
+            loss.backward()
+            results.append((loss.detach(), logits.grad.clone()))
+        (loss1, grad1), (loss2, grad2) = results
+        assert torch.allclose(loss1, loss2, rtol=1e-5), (loss1, loss2)
+        assert torch.allclose(grad1, grad2, rtol=1e-5, atol=1e-9), (grad1 - grad2).abs().max()
+    print('| loss and gradients match the dense implementation')
+
+
+def check_clip(args, clip=0.2):
+    """
+    With clip, PPO's pessimistic bound: no gradient for ratios above 1 + clip with positive rewards and below
+    1 - clip with negative ones, the unclipped importance sampling gradient otherwise.
+    """
+    torch.manual_seed(args.seed)
+    bsz, seqlen, vocab = 4, 8, 100
+    logits = torch.randn(bsz, seqlen, vocab, requires_grad=True)
+    label = torch.randint(vocab, (bsz, seqlen))
+    selected = F.log_softmax(logits, dim=-1).gather(2, label.unsqueeze(2)).squeeze(2).detach()
+
+    def grad(criterion, ratio, reward):
+        logits.grad = None
+        # the tokens were sampled with probability 1 / ratio of the current one
+        sample_logprobs = selected - torch.tensor(ratio).log() / seqlen
+        criterion(F.log_softmax(logits, dim=-1), label, reward, None, label, sample_logprobs).backward()
+        return logits.grad.clone()
+
+    for sign in (1., -1.):
+        reward = sign * torch.rand(bsz, seqlen)
+        for ratio in (403., 1.1, 0.95, 0.002):
+            clipped = grad(PGLoss(size_average=True, clip=clip), ratio, reward)
+            unclipped = grad(PGLoss(size_average=True), ratio, reward)
+            if (ratio > 1 + clip and sign > 0) or (ratio < 1 - clip and sign < 0):
+                assert clipped.abs().max() == 0, (ratio, sign, clipped.norm())
+            else:
+                assert torch.allclose(clipped, unclipped, rtol=1e-4, atol=1e-9), (ratio, sign, clipped - unclipped)
+    print('| clipped gradients match the pessimistic bound of PPO')
+
+
+def rss_mb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024
+
+
+def peak_memory(name, args, device, result):
+    """Peak memory (MB) of one forward/backward above the inputs."""
+    inputs = make_inputs(args, device)
+    logits, rest = inputs[0], inputs[1:]
+    logprobs = F.log_softmax(logits, dim=-1)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated() / 2 ** 20
+    else:
+        # reset the peak resident set size of the process (linux)
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        base = rss_mb('VmRSS')
+
+    loss_fn(name)(logprobs, *rest).backward()
+
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() / 2 ** 20
+    else:
+        peak = rss_mb('VmHWM')
+    result.put(peak - base)
+
+
+def main(args):
+    check(args)
+    check_clip(args)
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    # a fresh process per run, so that the CPU peak (max RSS) is not shared
+    ctx = multiprocessing.get_context('spawn')
+    peaks = {}
+    for name in ('dense', 'gather'):
+        result = ctx.Queue()
+        p = ctx.Process(target=peak_memory, args=(name, args, device, result))
+        p.start()
+        peaks[name] = result.get()
+        p.join()
+        print('| {:6s} PGLoss forward/backward: peak {:8.1f} MB above the inputs ({})'.format(name, peaks[name], device))
+
+    logprobs_mb = args.bsz * args.seqlen * args.vocab * 4 / 2 ** 20
+    print('| saved {:.1f} MB ({:.1f}x the size of the log-prob tensor, {:.1f} MB)'.format(
+        peaks['dense'] - peaks['gather'], (peaks['dense'] - peaks['gather']) / logprobs_mb, logprobs_mb))
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -1,8 +1,16 @@
 from bleurt import score as bleurt_score
-from bert_score import score as bert_score_score
+from bert_score import BERTScorer
+from bisect import bisect_left
+from collections import Counter
+from itertools import zip_longest
 from statistics import mean
 import argparse
+import json
+import sys
+import time
 import sacrebleu
+from sacrebleu.metrics import BLEU
+from sacrebleu.tokenizers.tokenizer_13a import Tokenizer13a
 import numpy as np
 
 references_dummy = ["Bud Powell was a legendary pianist.",
@@ -23,19 +31,66 @@ true_sents_dummy = ["Piano music is good",
                     ]
 
 
+DEFAULT_BLEURT_CHECKPOINT = "bleurt/bleurt-base-128"
+
+# loaded scorers are expensive to create, keep them for the lifetime of the process
+_scorers = {}
+
+
+def default_device():
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def get_bleurt_scorer(checkpoint=DEFAULT_BLEURT_CHECKPOINT):
+    key = ("bleurt", checkpoint)
+    if key not in _scorers:
+        _scorers[key] = bleurt_score.BleurtScorer(checkpoint)
+    return _scorers[key]
+
+
+def get_bert_scorer(device=None, batch_size=64):
+    key = ("bertscore", device, batch_size)
+    if key not in _scorers:
+        _scorers[key] = BERTScorer(lang='en', batch_size=batch_size, device=device or default_device())
+    return _scorers[key]
+
+
+def read_chunks(path, chunk_size=1000):
+    """Yield lists of at most chunk_size stripped lines from a file"""
+    chunk = []
+    with open(path) as f:
+        for line in f:
+            chunk.append(line.strip())
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def bleurt_sentence_scores(candidates, references, batch_size=None, checkpoint=DEFAULT_BLEURT_CHECKPOINT):
+    scorer = get_bleurt_scorer(checkpoint)
+    return scorer.score(references=references, candidates=candidates, batch_size=batch_size)
+
+
 # BLEURT, automatic relevance metric
-def bleurt_eval(candidates, references, verbose=False):
-    checkpoint = "bleurt/bleurt-base-128"
-    scorer = bleurt_score.BleurtScorer(checkpoint)
-    scores = scorer.score(references=references, candidates=candidates)
+def bleurt_eval(candidates, references, verbose=False, batch_size=None, checkpoint=DEFAULT_BLEURT_CHECKPOINT):
+    scores = bleurt_sentence_scores(candidates, references, batch_size=batch_size, checkpoint=checkpoint)
     if verbose:
         print("BLEURT scores:", scores)
     return mean(scores)
 
 
+def bert_score_sentence_scores(candidates, references, verbose=False, device=None, batch_size=64):
+    scorer = get_bert_scorer(device=device, batch_size=batch_size)
+    P, R, F1 = scorer.score(candidates, references, verbose=verbose)
+    return P.cpu(), R.cpu(), F1.cpu()
+
+
 # BertScore, another automatic relevance metric
-def bert_score_eval(candidates, references, verbose=False):
-    P, R, F1 = bert_score_score(candidates, references, lang='en', verbose=verbose, device='cpu')
+def bert_score_eval(candidates, references, verbose=False, device=None, batch_size=64):
+    P, R, F1 = bert_score_sentence_scores(candidates, references, verbose=verbose, device=device, batch_size=batch_size)
     if verbose:
         print("BertScores:")
         print("P:", P)
@@ -51,61 +106,240 @@ def usual_bleu_eval(candidates, references):
     return usual_bleu
 
 
+def extract_ngrams(tokens, max_ngram_order=4):
+    ngrams = Counter()
+    for n in range(1, max_ngram_order + 1):
+        for i in range(len(tokens) - n + 1):
+            ngrams[tuple(tokens[i: i + n])] += 1
+    return ngrams
+
+
+class NgramIndex(object):
+    """
+    Corpus-wide n-gram count index. For every n-gram it stores the largest and the second largest count
+    among the indexed sentences, which is all that is needed to clip a candidate against the whole corpus
+    used as a multi-reference set, or against the whole corpus with one sentence left out.
+    """
+    def __init__(self, sentences, max_ngram_order=4, tokenizer=None):
+        self.max_ngram_order = max_ngram_order
+        self.tokenizer = tokenizer if tokenizer is not None else Tokenizer13a()
+        self.top_counts = {}
+        self.length_counts = Counter()
+
+        for sent in sentences:
+            tokens = self.tokenize(sent)
+            self.length_counts[len(tokens)] += 1
+            for ngram, count in extract_ngrams(tokens, max_ngram_order).items():
+                top = self.top_counts.get(ngram)
+                if top is None:
+                    self.top_counts[ngram] = [count, 0]
+                elif count > top[0]:
+                    top[1] = top[0]
+                    top[0] = count
+                elif count > top[1]:
+                    top[1] = count
+
+        self.lengths = sorted(self.length_counts)
+        self.num_sentences = sum(self.length_counts.values())
+
+    def tokenize(self, sent):
+        return self.tokenizer(sent.rstrip()).split()
+
+    def closest_ref_len(self, hyp_len, exclude_len=None):
+        """Closest reference length as in sacrebleu, ties are resolved towards the shorter reference"""
+        def available(length):
+            return self.length_counts[length] - (1 if length == exclude_len else 0) > 0
+
+        pos = bisect_left(self.lengths, hyp_len)
+        closest = []
+        for i in range(pos - 1, -1, -1):
+            if available(self.lengths[i]):
+                closest.append(self.lengths[i])
+                break
+        for i in range(pos, len(self.lengths)):
+            if available(self.lengths[i]):
+                closest.append(self.lengths[i])
+                break
+        return min(closest, key=lambda length: (abs(hyp_len - length), length))
+
+    def segment_stats(self, hypothesis, leave_out=False):
+        """
+        Match statistics of the hypothesis against all indexed sentences. With leave_out=True the
+        hypothesis is assumed to be one of the indexed sentences and its own counts are excluded.
+        """
+        tokens = self.tokenize(hypothesis)
+        hyp_len = len(tokens)
+        ref_len = self.closest_ref_len(hyp_len, exclude_len=hyp_len if leave_out else None)
+
+        correct = [0] * self.max_ngram_order
+        total = [0] * self.max_ngram_order
+        for ngram, count in extract_ngrams(tokens, self.max_ngram_order).items():
+            n = len(ngram) - 1
+            total[n] += count
+            top = self.top_counts.get(ngram)
+            if top is None:
+                continue
+            # when leaving out the hypothesis, the best other sentence holds the second largest count
+            # if the hypothesis itself holds the largest one
+            ref_count = top[1] if leave_out and count == top[0] else top[0]
+            correct[n] += min(count, ref_count)
+        return hyp_len, ref_len, correct, total
+
+    def corpus_score(self, candidates, leave_out=False):
+        sys_len = ref_len = 0
+        correct = [0] * self.max_ngram_order
+        total = [0] * self.max_ngram_order
+        for cand in candidates:
+            c_sys_len, c_ref_len, c_correct, c_total = self.segment_stats(cand, leave_out=leave_out)
+            sys_len += c_sys_len
+            ref_len += c_ref_len
+            correct = [a + b for a, b in zip(correct, c_correct)]
+            total = [a + b for a, b in zip(total, c_total)]
+        return BLEU.compute_bleu(correct, total, sys_len, ref_len, smooth_method='exp',
+                                 max_ngram_order=self.max_ngram_order)
+
+
 # CORPUS_BLEU, how similar are translations to some ground true text
 # kinda fluency
 def corpus_bleu_eval(candidates, ground_true_sents):
-    # all true sents for each candidate, NB: won't work properly if there are same sents in candidates and ground_true
-    true_sents_for_each_candidate = [[sent for c in candidates] for sent in ground_true_sents]
-    corpus_bleu = sacrebleu.corpus_bleu(candidates, true_sents_for_each_candidate)
+    # every true sent is a reference for each candidate, n-gram counts are clipped against the
+    # maximum count over the whole true corpus
+    index = NgramIndex(ground_true_sents)
+    corpus_bleu = index.corpus_score(candidates)
     return corpus_bleu
 
 
 # SELF_BLEU, measures diversity
 def self_bleu_eval(candidates):
-    # all OTHER candidates for each candidate, NB: won't work properly if there are duplicates in candidates
-    candidates_for_each_candidate = []
-    n_cands = len(candidates)
-    for i in range(n_cands-1):
-        ith_and_last = [candidates[i] for j in range(n_cands)]
-        ith_and_last[i] = candidates[-1]
-        candidates_for_each_candidate.append(ith_and_last)
-    self_bleu = sacrebleu.corpus_bleu(candidates, candidates_for_each_candidate)
+    # all OTHER candidates for each candidate, the candidate is left out of the shared index
+    assert len(candidates) > 1, "Self-BLEU needs at least two candidates"
+    index = NgramIndex(candidates)
+    self_bleu = index.corpus_score(candidates, leave_out=True)
     return self_bleu
 
+
+def benchmark_bleu_index(sizes=(1000, 10000, 100000), sent_len=20, vocab_size=5000, seed=1):
+    """Time Self-BLEU and corpus BLEU on synthetic corpora of growing size"""
+    rng = np.random.RandomState(seed)
+    vocab = [f"w{i}" for i in range(vocab_size)]
+
+    def make_corpus(size):
+        # zipfian word frequencies, so that higher order n-grams are shared between sentences
+        word_ids = np.minimum(rng.zipf(1.2, size=(size, sent_len)), vocab_size) - 1
+        return [" ".join(vocab[w] for w in sent) for sent in word_ids]
+
+    true_sents = make_corpus(max(sizes) // 10)
+    for size in sizes:
+        candidates = make_corpus(size)
+        start = time.time()
+        self_bleu = self_bleu_eval(candidates)
+        self_bleu_time = time.time() - start
+        start = time.time()
+        corpus_bleu = corpus_bleu_eval(candidates, true_sents)
+        corpus_bleu_time = time.time() - start
+        print(f"{size} candidates: Self-BLEU {self_bleu.score:.2f} in {self_bleu_time:.2f} sec, "
+              f"Corpus BLEU ({len(true_sents)} true sents) {corpus_bleu.score:.2f} in {corpus_bleu_time:.2f} sec")
+
+
+def stream_eval(candidate_chunks, reference_chunks, sink=None, batch_size=64, device=None, verbose=False,
+                bleurt_checkpoint=DEFAULT_BLEURT_CHECKPOINT):
+    """
+    Score candidate/reference pairs chunk by chunk. Scorers are loaded once and reused for every chunk,
+    per-line scores are written to sink as JSON lines. Returns averaged BLEURT and BertScore, and corpus
+    BLEU computed from accumulated n-gram statistics, so only one chunk is held in memory at a time.
+    """
+    totals = {"bleurt": 0., "bertscore_p": 0., "bertscore_r": 0., "bertscore_f1": 0.}
+    bleu_stats = None
+    line_id = 0
+
+    # the files are read in chunks of the same size, a chunk missing or shorter on one side means they have
+    # different numbers of lines
+    for candidates, references in zip_longest(candidate_chunks, reference_chunks):
+        if candidates is None or references is None or len(candidates) != len(references):
+            raise ValueError(f"Candidate and reference files have different number of lines "
+                             f"(from line {line_id})")
+
+        bleurt = bleurt_sentence_scores(candidates, references, batch_size=batch_size, checkpoint=bleurt_checkpoint)
+        P, R, F1 = bert_score_sentence_scores(candidates, references, verbose=verbose, device=device, batch_size=batch_size)
+
+        for cand, ref, bleurt_s, p, r, f1 in zip(candidates, references, bleurt, P.tolist(), R.tolist(), F1.tolist()):
+            sent_bleu = sacrebleu.sentence_bleu(cand, [ref])
+            if bleu_stats is None:
+                bleu_stats = [[0] * len(sent_bleu.counts), [0] * len(sent_bleu.totals), 0, 0]
+            bleu_stats[0] = [c + n for c, n in zip(bleu_stats[0], sent_bleu.counts)]
+            bleu_stats[1] = [t + n for t, n in zip(bleu_stats[1], sent_bleu.totals)]
+            bleu_stats[2] += sent_bleu.sys_len
+            bleu_stats[3] += sent_bleu.ref_len
+
+            scores = {"bleurt": bleurt_s, "bertscore_p": p, "bertscore_r": r, "bertscore_f1": f1}
+            for key, val in scores.items():
+                totals[key] += val
+
+            if sink is not None:
+                sink.write(f"{json.dumps({'id': line_id, 'candidate': cand, 'reference': ref, 'bleu': sent_bleu.score, **scores})}\n")
+            line_id += 1
+
+    assert line_id > 0, "Nothing to evaluate"
+    averages = {key: val / line_id for key, val in totals.items()}
+    averages["bleu"] = BLEU.compute_bleu(*bleu_stats, smooth_method='exp')
+    return averages
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--cand_file", default=None)  # candidate translations (generated)
     parser.add_argument("--ref_file", default=None)  # reference translations (ground truth)
     parser.add_argument("--true_corpus_file", default=None)  # real text, for corpus-bleu.
-    # if real text has 2k sents, it takes 0.3 sec/candidate, if 6k sents, 0.6 sec/candidate
-    parser.add_argument("--verbose", default=0)  # prints scores for each sent (bleurt & bertscore) + some logs
+    parser.add_argument("--verbose", default=0, type=int)  # prints scores for each sent (bleurt & bertscore) + some logs
+    parser.add_argument("--out_file", default=None)  # per-line scores are written here as jsonl
+    parser.add_argument("--chunk_size", default=1000, type=int)  # lines read from the input files at once
+    parser.add_argument("--batch_size", default=64, type=int)  # batch size for bleurt and bertscore
+    parser.add_argument("--device", default=None)  # device for bertscore, cuda if available by default
+    parser.add_argument("--bleurt_checkpoint", default=DEFAULT_BLEURT_CHECKPOINT)
+    parser.add_argument("--benchmark", action='store_true')  # time Self-BLEU and corpus BLEU up to 100k candidates
     args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark_bleu_index()
+        sys.exit()
+
     if args.ref_file is None:
         print("Using dummy files for references and candidates")
-        references = references_dummy
+        candidate_chunks = [candidates_dummy]
+        reference_chunks = [references_dummy]
         candidates = candidates_dummy
     else:
-        with open(args.ref_file) as f:
-            references = [line.strip() for line in f]
-        with open(args.cand_file) as f:
-            candidates = [line.strip() for line in f]
+        candidate_chunks = read_chunks(args.cand_file, args.chunk_size)
+        reference_chunks = read_chunks(args.ref_file, args.chunk_size)
+        candidates = None
 
     if args.true_corpus_file is None:
         print("Using dummy file for true_sents")
         true_sents = true_sents_dummy
     else:
-        with open(args.ref_file) as f:
+        with open(args.true_corpus_file) as f:
             true_sents = [line.strip() for line in f]
 
+    sink = open(args.out_file, "w") if args.out_file is not None else None
+    try:
+        scores = stream_eval(
+            candidate_chunks, reference_chunks, sink=sink, batch_size=args.batch_size, device=args.device,
+            verbose=args.verbose == 1, bleurt_checkpoint=args.bleurt_checkpoint
+        )
+    finally:
+        if sink is not None:
+            sink.close()
+
+    if candidates is None:
+        with open(args.cand_file) as f:
+            candidates = [line.strip() for line in f]
+
     BOLD = '\033[1m'
     END = '\033[0m'
-    bleurt = bleurt_eval(candidates, references, args.verbose == 1)
-    print(BOLD + "BLEURT score:" + END, np.round(bleurt, 4))
-    P_avg, R_avg, F1_avg = bert_score_eval(candidates, references, args.verbose == 1)
-    print(BOLD + "BERTSCORE: P_avg, R_avg, F1_avg:" + END, np.round(P_avg, 4), np.round(R_avg, 4), np.round(F1_avg, 4))
-    usual_bleu = usual_bleu_eval(candidates, references)
-    print(BOLD + "Usual BLEU:" + END, usual_bleu)
+    print(BOLD + "BLEURT score:" + END, np.round(scores["bleurt"], 4))
+    print(BOLD + "BERTSCORE: P_avg, R_avg, F1_avg:" + END, np.round(scores["bertscore_p"], 4),
+          np.round(scores["bertscore_r"], 4), np.round(scores["bertscore_f1"], 4))
+    print(BOLD + "Usual BLEU:" + END, scores["bleu"])
     corpus_bleu = corpus_bleu_eval(candidates, true_sents)
     print(BOLD + "Corpus BLEU (fluency):" + END, corpus_bleu)
     self_bleu = self_bleu_eval(candidates)
-    print(BOLD + "Self-BLEU (diversity):" + END, self_bleu)
\ No newline at end of file
+    print(BOLD + "Self-BLEU (diversity):" + END, self_bleu)
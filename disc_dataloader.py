@@ -1,36 +1,56 @@
 import contextlib
+import hashlib
+import json
+import os
+import queue
+import random
 import sys
+import threading
+import uuid
 
 import torch
 from torch import cuda
-from torch.utils.data.dataset import Dataset
+from torch.utils.data.dataset import Dataset, IterableDataset
 import numpy as np
 
+import search
 import utils
 from batch_generator import BatchGenerator
+from data import LanguagePairDataset
+from indexed_dataset import IndexedDatasetBuilder, IndexedMemmapDataset
 
 
 class DatasetProcessing(Dataset):
-    def __init__(self, data, maxlen):
-        # data['train/valid']: (src_data_temp, trg_data_temp, labels)
-        self.data = data
-        self.data_size = int(data['labels'].size(0))
+    def __init__(self, data, maxlen=None):
+        # data: ids of the samples, the language pair dataset they come from
+        # and the cache holding their generated negatives
+        self.ids = data['ids']
+        self.pairs = data['pairs']
+        self.negatives = data['negatives']
+        # every sample gives a positive (even index) and a negative (odd index)
+        self.data_size = 2 * len(self.ids)
+        # batches are padded to their longest sample, or to maxlen if given
         self.maxlen = maxlen
 
-        assert self.data['src'].size(0) == self.data['trg'].size(0) \
-               and self.data['trg'].size(0) == self.data['labels'].size(0)
-
+        # sizes used to bucket samples of similar length into the same batch
+        self.src_sizes = np.repeat(self.pairs.src.sizes[self.ids], 2)
+        self.trg_sizes = np.empty(self.data_size, dtype=np.int64)
+        self.trg_sizes[0::2] = self.pairs.dst.sizes[self.ids]
+        self.trg_sizes[1::2] = [self.negatives.size(id) for id in self.ids.tolist()]
 
     def __getitem__(self, index):
 
         assert index < self.data_size
 
-        source = self.data['src'][index].long()
-        target = self.data['trg'][index].long()
-        labels = self.data['labels'][index].long()
+        id = int(self.ids[index // 2])
+        pair = self.pairs[id]
+        if index % 2 == 0:
+            target, labels = pair['target'], 1
+        else:
+            target, labels = self.negatives[id], 0
 
         return {
-            'source': source,
+            'source': pair['source'],
             'target': target,
             'labels': labels
         }
@@ -40,15 +60,16 @@ class DatasetProcessing(Dataset):
 
 
     def collater(self, samples):
-        return DatasetProcessing.collate(samples, self.maxlen)
+        return DatasetProcessing.collate(samples, self.pairs.pad_idx, self.pairs.eos_idx, self.maxlen)
 
     @staticmethod
-    def collate(samples, maxlen):
+    def collate(samples, pad_idx, eos_idx, maxlen=None):
         if len(samples) == 0:
             return {}
 
         def merge(key):
-            return DatasetProcessing.collate_tokens([s[key] for s in samples], maxlen)
+            return LanguagePairDataset.collate_tokens(
+                [s[key] for s in samples], pad_idx, eos_idx, left_pad=False, maxlen=maxlen)
 
         labels = torch.LongTensor([s['labels'] for s in samples])
         src_tokens = merge('source')
@@ -57,30 +78,130 @@ class DatasetProcessing(Dataset):
         return {
             'src_tokens': src_tokens,
             'trg_tokens': target,
+            'src_mask': src_tokens.ne(pad_idx),
+            'trg_mask': target.ne(pad_idx),
             'labels': labels
         }
 
-    @staticmethod
-    def collate_tokens(values, maxlen):
-        max_input_size = max(v.size(0) for v in values)
-        assert max_input_size == maxlen
 
-        res = torch.stack(values, dim=0)
+class StreamingDatasetProcessing(IterableDataset):
+    """Streams the samples of DatasetProcessing while their negatives are
+    generated.
+
+    A background thread consumes negatives_itr (see generate_negatives) and
+    puts the (source, target, label) samples into a bounded queue, so that
+    training starts with the first generated batch and at most queue_size
+    (plus shuffle_buffer) samples are held in memory. Can be iterated once. The samples are
+    shuffled through a buffer of shuffle_buffer samples, so that the
+    positive and the negative of a source do not come out one after the
+    other; the order of the generation batches, which are bucketed by
+    source length, is only kept across the buffer.
+    """
 
-        return res
+    _END = object()
+
+    def __init__(self, negatives_itr, pairs, maxlen=None, queue_size=1024, shuffle_buffer=256, seed=None):
+        self.negatives_itr = negatives_itr
+        self.pairs = pairs
+        self.maxlen = maxlen
+        self.queue_size = queue_size
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.producer = None
+
+    collater = DatasetProcessing.collater
+
+    def __iter__(self):
+        samples = self.samples = queue.Queue(maxsize=self.queue_size)
+        stop = self.stop = threading.Event()
+
+        def put(item):
+            # gives up once training stopped consuming, instead of blocking on the full queue
+            while not stop.is_set():
+                try:
+                    samples.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        rng = random.Random(self.seed)
+        buffer = []
+
+        def shuffled_put(item):
+            buffer.append(item)
+            if len(buffer) < self.shuffle_buffer:
+                return True
+            i = rng.randrange(len(buffer))
+            buffer[i], buffer[-1] = buffer[-1], buffer[i]
+            return put(buffer.pop())
+
+        def produce():
+            try:
+                for id, neg in self.negatives_itr:
+                    if neg is None:
+                        continue
+                    pair = self.pairs[id]
+                    if not (shuffled_put({'source': pair['source'], 'target': pair['target'], 'labels': 1})
+                            and shuffled_put({'source': pair['source'], 'target': neg, 'labels': 0})):
+                        return
+                rng.shuffle(buffer)
+                for item in buffer:
+                    if not put(item):
+                        return
+            except Exception as e:
+                put(e)
+            finally:
+                put(self._END)
+
+        self.producer = threading.Thread(target=produce, daemon=True)
+        self.producer.start()
+        try:
+            while True:
+                sample = samples.get()
+                if sample is self._END:
+                    break
+                if isinstance(sample, Exception):
+                    raise sample
+                yield sample
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the generation thread, e.g. when training stops early: the DataLoader does not close the
+        iteration."""
+        if self.producer is None:
+            return
+        self.stop.set()
+        # release the samples generated ahead
+        try:
+            while True:
+                self.samples.get_nowait()
+        except queue.Empty:
+            pass
+        self.producer.join()
+        # finalizes the negatives cache shard (see NegativesCache.writer) if generation stopped early
+        if hasattr(self.negatives_itr, 'close'):
+            self.negatives_itr.close()
+
+
+def stream_dataloader(dataset, batch_size=32):
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, collate_fn=dataset.collater)
 
 
 def train_dataloader(dataset, batch_size=32, seed=None, epoch=1,
                      sample_without_replacement=0, sort_by_source_size=False):
     with numpy_seed(seed):
         batch_sampler = shuffled_batches_by_size(len(dataset), batch_size=batch_size, epoch=epoch,
-            sample=sample_without_replacement, sort_by_source_size=sort_by_source_size)
+            sample=sample_without_replacement, sort_by_source_size=sort_by_source_size,
+            src_sizes=dataset.src_sizes, trg_sizes=dataset.trg_sizes)
 
     return torch.utils.data.DataLoader(dataset, collate_fn=dataset.collater, batch_sampler=batch_sampler)
 
 
 def eval_dataloader(dataset, num_workers=0, batch_size=32):
-    batch_sampler = batches_by_order(len(dataset), batch_size)
+    batch_sampler = batches_by_order(len(dataset), batch_size,
+                                     src_sizes=dataset.src_sizes, trg_sizes=dataset.trg_sizes)
 
     return torch.utils.data.DataLoader(dataset, num_workers=num_workers, collate_fn=dataset.collater, batch_sampler=batch_sampler)
 
@@ -98,16 +219,25 @@ def _make_batches(indices, batch_size):
         yield batch
 
 
-def batches_by_order(data_size, batch_size=32):
-    """Returns batches of indices sorted by size. Sequences with different
-    source lengths are not allowed in the same batch."""
+def _sort_by_size(indices, src_sizes, trg_sizes):
+    if trg_sizes is not None:
+        indices = indices[np.argsort(trg_sizes[indices], kind='mergesort')]
+    if src_sizes is not None:
+        indices = indices[np.argsort(src_sizes[indices], kind='mergesort')]
+    return indices
+
 
-    indices = np.arange(data_size)
+def batches_by_order(data_size, batch_size=32, src_sizes=None, trg_sizes=None):
+    """Returns batches of indices sorted by size. Batches may contain
+    sequences of different lengths."""
+
+    indices = _sort_by_size(np.arange(data_size), src_sizes, trg_sizes)
 
     return list(_make_batches(indices, batch_size))
 
 
-def shuffled_batches_by_size(data_size, batch_size=32, epoch=1, sample=0, sort_by_source_size=False):
+def shuffled_batches_by_size(data_size, batch_size=32, epoch=1, sample=0, sort_by_source_size=False,
+                             src_sizes=None, trg_sizes=None):
     """Returns batches of indices, bucketed by size and then shuffled. Batches
     may contain sequences of different lengths."""
     if sample:
@@ -115,6 +245,8 @@ def shuffled_batches_by_size(data_size, batch_size=32, epoch=1, sample=0, sort_b
     else:
         indices = np.random.permutation(data_size)
 
+    indices = _sort_by_size(indices, src_sizes, trg_sizes)
+
     batches = list(_make_batches(indices, batch_size))
 
     if not sort_by_source_size:
@@ -138,15 +270,115 @@ def numpy_seed(seed):
         np.random.set_state(state)
 
 
-def prepare_training_data(args, dataset, split, generator, epoch_i, use_cuda):
+def negatives_key(checkpoint_path, args):
+    """Hash of the generator checkpoint and of the generation settings the
+    negatives depend on."""
+    md5 = hashlib.md5()
+    with open(checkpoint_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    settings = {
+        name: getattr(args, name) for name in (
+            'search', 'beam', 'nbest', 'max_len_a', 'max_len_b', 'fixed_max_len',
+            'no_early_stop', 'unnormalized', 'lenpen', 'unkpen', 'sampling_topk',
+            'sampling_temperature', 'diverse_beam_groups', 'diverse_beam_strength',
+        )
+    }
+    md5.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    return md5.hexdigest()
+
+
+class NegativesCache(object):
+    """Generated negatives of one split, looked up by sample id.
+
+    Stored in cache_dir as IndexedDataset shards, one per
+    prepare_training_data call that had to generate something. The shard
+    names are unique, so the workers of distributed training can share
+    cache_dir. A shard is only picked up once its ids file is written.
+    Negatives that exceeded the fixed max length are kept as empty items,
+    so they are not generated again.
+    """
+
+    def __init__(self, cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.shards = []
+        self.index = {}  # sample id -> (shard, position in shard)
+        self.lengths = []  # number of tokens of the items, per shard
+        self.too_long = set()
+        for name in sorted(os.listdir(cache_dir)):
+            if name.endswith('.ids.npy'):
+                self.load_shard(os.path.join(cache_dir, name[:-len('.ids.npy')]))
+
+    def load_shard(self, prefix):
+        ids = np.load(prefix + '.ids.npy')
+        shard = IndexedMemmapDataset(prefix)
+        lengths = np.diff(shard.data_offsets)
+        for pos, id in enumerate(ids.tolist()):
+            self.index[id] = (len(self.shards), pos)
+            if lengths[pos] == 0:
+                self.too_long.add(id)
+        self.shards.append(shard)
+        self.lengths.append(lengths)
+
+    def __contains__(self, id):
+        return id in self.index
+
+    def size(self, id):
+        shard, pos = self.index[id]
+        return int(self.lengths[shard][pos])
+
+    def __getitem__(self, id):
+        shard, pos = self.index[id]
+        # subtract 1 for 0-based indexing
+        return self.shards[shard][pos].long() - 1
+
+    @contextlib.contextmanager
+    def writer(self):
+        """Stream (id, tokens) pairs into a new shard, tokens=None marks a
+        negative that exceeded the fixed max length. The pairs added so far
+        are also kept if generation fails or stops early."""
+        # other processes (e.g. the other distributed workers) may write shards into cache_dir too
+        prefix = os.path.join(self.cache_dir, 'shard_{:05d}_{}'.format(len(self.shards), uuid.uuid4().hex))
+        builder = IndexedDatasetBuilder(prefix + '.bin')
+        ids = []
+
+        def add(id, tokens):
+            builder.add_item(tokens.cpu().int() if tokens is not None else torch.IntTensor())
+            ids.append(id)
+
+        try:
+            yield add
+        finally:
+            builder.finalize(prefix + '.idx')
+            if ids:
+                np.save(prefix + '.ids.npy', np.asarray(ids, dtype=np.int64))
+                self.load_shard(prefix)
+            else:
+                os.remove(prefix + '.bin')
+                os.remove(prefix + '.idx')
+
+
+def generate_negatives(args, dataset, split, generator, epoch_i, use_cuda, negatives):
+    """Iterator of (sample id, negative tokens) for the samples of this
+    epoch, batch by batch, generating only the ones that are not cached.
+    The tokens are None for negatives that exceed the fixed max length.
+
+    The batches are drawn here, and sampling uses its own random state, so
+    that iterating in a thread (see StreamingDatasetProcessing) does not
+    touch the random state of training."""
 
     translator = BatchGenerator(
         generator, beam_size=args.beam, stop_early=(not args.no_early_stop),
         normalize_scores=(not args.unnormalized), len_penalty=args.lenpen,
-        unk_penalty=args.unkpen)
+        unk_penalty=args.unkpen, search_strategy=args.search,
+        sampling_topk=args.sampling_topk, sampling_temperature=args.sampling_temperature,
+        diverse_beam_groups=args.diverse_beam_groups, diverse_beam_strength=args.diverse_beam_strength)
 
     seed = args.seed + epoch_i
-    torch.manual_seed(seed)
+    if isinstance(translator.search, search.Sampling):
+        device = torch.device('cuda', torch.cuda.current_device()) if use_cuda else torch.device('cpu')
+        translator.search.generator = torch.Generator(device=device).manual_seed(seed)
 
     # prepare trainng data
     # we must use a fixed max sentence length
@@ -179,59 +411,77 @@ def prepare_training_data(args, dataset, split, generator, epoch_i, use_cuda):
             num_shards=args.distributed_world_size,
         )
 
-    src_data_temp = []
-    trg_data_temp = []
-    labels_temp = []
-    print("preparing discriminator {0} data...".format(split))
+    return _generate_negatives(args, dataset, translator, itr, use_cuda, negatives)
+
 
-    with torch.no_grad():
+def _generate_negatives(args, dataset, translator, itr, use_cuda, negatives):
+    with negatives.writer() as add_negative:
         for i, sample in enumerate(itr):
             sys.stdout.write('\r' + 'Finishing ' + str(i + 1) + '/' + str(len(itr)))
             sys.stdout.flush()
 
+            sample_ids = sample['id'].tolist()
+
+            # only generate the negatives that are not cached yet
+            missing = []
+            for j, id in enumerate(sample_ids):
+                if id not in negatives:
+                    missing.append(j)
+                else:
+                    yield id, (None if id in negatives.too_long else negatives[id])
+            if len(missing) == 0:
+                continue
+            missing = torch.LongTensor(missing)
+            sample = {
+                'net_input': {
+                    'src_tokens': sample['net_input']['src_tokens'][missing],
+                    'src_lengths': sample['net_input']['src_lengths'][missing],
+                },
+            }
+
             if use_cuda:
                 # wrap input tensors in cuda tensors
                 sample = utils.make_variable(sample, cuda=cuda)
 
-            # a tensor with max possible translation length
-            neg_tokens = translator.generate_translation_tokens(args, dataset, sample, beam_size=args.beam, maxlen_a=args.max_len_a,
-                                                                maxlen_b=args.max_len_b, nbest=args.nbest)
-
-            # mask the results that exceeds fixed max length, and truncate at the max length
-            selected_row = (neg_tokens[:, args.fixed_max_len] == dataset.dst_dict.pad()).nonzero().squeeze(1)
-
-            if selected_row.size(0) != neg_tokens.size(0):
-                print('\r' + "Warning, {0} sentences are removed due to exceeding length".format(int(neg_tokens.size(0) - selected_row.size(0))))
-
-            neg_tokens = neg_tokens[selected_row]
-            neg_tokens = neg_tokens[:, : args.fixed_max_len]
-
-            pos_tokens = sample['target'][selected_row]
-
-            src_tokens = sample['net_input']['src_tokens'][selected_row]
-
-            assert neg_tokens.size() == pos_tokens.size()
-            assert src_tokens.size() == pos_tokens.size()
-
-            src_data_temp.append(src_tokens)
-            trg_data_temp.append(pos_tokens)
-            labels_temp.extend([1] * int(pos_tokens.size(0)))
-
-            src_data_temp.append(src_tokens)
-            trg_data_temp.append(neg_tokens)
-            labels_temp.extend([0] * int(neg_tokens.size(0)))
-
-        src_data_temp = torch.cat(src_data_temp, dim=0)
-        trg_data_temp = torch.cat(trg_data_temp, dim=0)
-        src_data_temp = src_data_temp.cpu().int()
-        trg_data_temp = trg_data_temp.cpu().int()
-
-        labels_temp = np.asarray(labels_temp)
-        labels = torch.from_numpy(labels_temp)
-        labels = labels.cpu().int()
-
-        data = {'src': src_data_temp, 'trg': trg_data_temp, 'labels': labels}
+            with torch.no_grad():
+                if args.search in ('greedy', 'sampling'):
+                    # decode straight into a tensor of the fixed max length, rows
+                    # that did not end within it exceed the length
+                    neg_tokens, ended = translator.generate_fixed_length_tokens(
+                        sample, args.fixed_max_len, maxlen_a=args.max_len_a, maxlen_b=args.max_len_b)
+                else:
+                    # a tensor with max possible translation length
+                    neg_tokens = translator.generate_translation_tokens(args, dataset, sample, beam_size=args.beam, maxlen_a=args.max_len_a,
+                                                                        maxlen_b=args.max_len_b, nbest=args.nbest)
+                    ended = neg_tokens[:, args.fixed_max_len] == dataset.dst_dict.pad()
+
+            # the results that exceed the fixed max length are stored empty
+            # and left out of the data
+            for j, neg, keep in zip(missing.tolist(), neg_tokens.cpu(), ended.tolist()):
+                neg = utils.strip_pad(neg, dataset.dst_dict.pad()) if keep else None
+                add_negative(sample_ids[j], neg)
+                yield sample_ids[j], neg
+
+
+def prepare_training_data(args, dataset, split, generator, epoch_i, use_cuda, negatives):
+    print("preparing discriminator {0} data...".format(split))
 
-        print('\n' + "preparing discriminator {0} data done!".format(split))
+    num_cached = len(negatives.index)
+    ids, num_too_long = [], 0
+    for id, neg in generate_negatives(args, dataset, split, generator, epoch_i, use_cuda, negatives):
+        if neg is None:
+            num_too_long += 1
+        else:
+            ids.append(id)
+    if num_too_long > 0:
+        print('\r' + "Warning, {0} sentences are removed due to exceeding length".format(num_too_long))
+
+    data = {
+        'ids': np.asarray(ids, dtype=np.int64),
+        'pairs': dataset.splits[split],
+        'negatives': negatives,
+    }
+
+    print('\n' + "preparing discriminator {0} data done! ({1} new negatives)".format(split, len(negatives.index) - num_cached))
 
     return data
\ No newline at end of file
@@ -306,6 +306,10 @@ class Discriminator(nn.Module):
             nn.MaxPool2d(kernel_size=2, stride=2)
         )
 
+        # brings variable-length inputs to the 12 x 12 grid of the classifier,
+        # a no-op for inputs of length 50
+        self.pool = nn.AdaptiveMaxPool2d(12)
+
         self.classifier = nn.Sequential(
             nn.Dropout(),
             Linear(256 * 12 * 12, 20),
@@ -316,9 +320,13 @@ class Discriminator(nn.Module):
             Linear(20, 1),
         )
 
-    def forward(self, src_sentence, trg_sentence):
+    def forward(self, src_sentence, trg_sentence, src_mask=None, trg_mask=None):
         batch_size = src_sentence.size(0)
 
+        # the two pooling layers need at least 4 positions on each side
+        src_sentence, src_mask = self.pad_to(src_sentence, src_mask, 4)
+        trg_sentence, trg_mask = self.pad_to(trg_sentence, trg_mask, 4)
+
         src_out = self.embed_src_tokens(src_sentence)
         trg_out = self.embed_src_tokens(trg_sentence)
 
@@ -326,11 +334,28 @@ class Discriminator(nn.Module):
         trg_out = torch.stack([trg_out] * src_out.size(1), dim=1)
         
         out = torch.cat([src_out, trg_out], dim=3)
+
+        masked = src_mask is not None and trg_mask is not None
+        if masked:
+            # the padding is on the right, the real cells of the grid are the first src x trg lengths ones
+            src_lengths, trg_lengths = src_mask.sum(1), trg_mask.sum(1)
+            # zero the cells of the grid that involve padding
+            out = out * self.grid_mask(src_lengths, trg_lengths, out.size(1), out.size(2)).unsqueeze(3).type_as(out)
         
         out = out.permute(0,3,1,2)
         
-        out = self.conv1(out)
-        out = self.conv2(out)
+        for conv in (self.conv1, self.conv2):
+            out = conv(out)
+            if masked:
+                # the convolutions and the pooling windows that overlap the padding wrote into the cells
+                # beyond the real ones, zero them again, as the padding of the next convolution
+                src_lengths, trg_lengths = (src_lengths // 2).clamp(min=1), (trg_lengths // 2).clamp(min=1)
+                out = out * self.grid_mask(src_lengths, trg_lengths, out.size(2), out.size(3)).unsqueeze(1).type_as(out)
+
+        if masked:
+            out = self.masked_pool(out, src_lengths, trg_lengths)
+        else:
+            out = self.pool(out)
         
         out = out.permute(0, 2, 3, 1)
         
@@ -340,6 +365,29 @@ class Discriminator(nn.Module):
 
         return out
 
+    @staticmethod
+    def grid_mask(src_lengths, trg_lengths, src_len, trg_len):
+        """bsz x src_len x trg_len mask of the cells within the lengths"""
+        src = torch.arange(src_len, device=src_lengths.device).unsqueeze(0) < src_lengths.unsqueeze(1)
+        trg = torch.arange(trg_len, device=trg_lengths.device).unsqueeze(0) < trg_lengths.unsqueeze(1)
+        return src.unsqueeze(2) & trg.unsqueeze(1)
+
+    def masked_pool(self, out, src_lengths, trg_lengths):
+        """The adaptive pooling of the real cells of each grid, as if the batch was not padded"""
+        pooled = out.new_empty(out.size(0), out.size(1), 12, 12)
+        for src_len, trg_len in torch.stack([src_lengths, trg_lengths], dim=1).unique(dim=0).tolist():
+            rows = ((src_lengths == src_len) & (trg_lengths == trg_len)).nonzero(as_tuple=True)[0]
+            pooled[rows] = self.pool(out[rows, :, :src_len, :trg_len])
+        return pooled
+
+    def pad_to(self, tokens, mask, size):
+        if tokens.size(1) >= size:
+            return tokens, mask
+        tokens = F.pad(tokens, (0, size - tokens.size(1)), value=self.pad_idx)
+        if mask is not None:
+            mask = F.pad(mask, (0, size - mask.size(1)), value=False)
+        return tokens, mask
+
 def Conv1d(in_channels, out_channels, kernel_size, stride=1, padding=0, **kwargs):
     m = nn.Conv1d(in_channels, out_channels, kernel_size, stride, padding, **kwargs)
     for name, param in m.named_parameters():
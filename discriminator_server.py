@@ -0,0 +1,254 @@
+import collections
+import contextlib
+import copy
+import queue
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+
+def pair_key(src_tokens, trg_tokens):
+    return src_tokens.shape, trg_tokens.shape, src_tokens.cpu().numpy().tobytes(), trg_tokens.cpu().numpy().tobytes()
+
+
+def score_pairs(discriminator, src_neg, trg_neg, src_pos, trg_pos, positive_cache=None):
+    """
+    Discriminator scores of the negative and the positive pairs, in one forward pass over their concatenation
+    (two if their lengths differ). positive_cache, if given, maps the positive pairs to their scores, for the
+    references scored several times with the same weights, e.g. within a validation pass.
+    """
+    key = None
+    if positive_cache is not None:
+        key = pair_key(src_pos, trg_pos)
+        if key in positive_cache:
+            return discriminator(src_neg, trg_neg), positive_cache[key]
+
+    if src_neg.shape[1:] == src_pos.shape[1:] and trg_neg.shape[1:] == trg_pos.shape[1:]:
+        scores = discriminator(torch.cat([src_neg, src_pos], dim=0), torch.cat([trg_neg, trg_pos], dim=0))
+        neg_scores, pos_scores = scores.split([src_neg.size(0), src_pos.size(0)], dim=0)
+    else:
+        neg_scores, pos_scores = discriminator(src_neg, trg_neg), discriminator(src_pos, trg_pos)
+
+    if key is not None:
+        positive_cache[key] = pos_scores
+    return neg_scores, pos_scores
+
+
+def discriminator_loss_acc(discriminator, criterion, src_sentence, fake_sentence, true_sentence,
+                           autocast=contextlib.nullcontext, positive_cache=None):
+    """BCE loss and accuracy (%) of discriminator on the negative (0) and positive (1) target sentences."""
+    with autocast():
+        disc_out_neg, disc_out_pos = score_pairs(discriminator, src_sentence, fake_sentence, src_sentence,
+                                                 true_sentence, positive_cache)
+    # BCELoss is not autocast-safe, it is computed in float32
+    disc_out = torch.cat([disc_out_neg.squeeze(1), disc_out_pos.squeeze(1)], dim=0).float()
+
+    bsz, tgt_len = true_sentence.size()
+    fake_labels = torch.zeros(bsz, tgt_len, device=disc_out.device)
+    true_labels = torch.ones(bsz, tgt_len, device=disc_out.device)
+    labels = torch.cat([fake_labels, true_labels], dim=0)
+
+    d_loss = criterion(disc_out, labels)
+    acc = torch.sum(torch.round(disc_out) == labels).float() / torch.numel(labels) * 100
+    return d_loss, acc
+
+
+class DiscriminatorServer:
+    """
+    Runs in its own process: holds the discriminator and its optimizer and serves the requests of
+    DiscriminatorClient in order, except that a score request may be served before the training requests
+    received ahead of it, as long as at most `staleness` of them are pending.
+    """
+
+    def __init__(self, discriminator, config):
+        self.device = torch.device(config["device"])
+        if self.device.type == "cuda":
+            torch.cuda.set_device(self.device)
+        self.discriminator = discriminator.to(self.device)
+        self.staleness = config["staleness"]
+        self.update_tokens = config["update_tokens"]
+        self.amp_dtype = {'none': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}[config["amp"]]
+
+        params = [p for p in self.discriminator.parameters() if p.requires_grad]
+        self.optimizer = eval("torch.optim." + config["optimizer"])(params, config["lr"]) if params else None
+        self.scaler = torch.amp.GradScaler(self.device.type, enabled=self.amp_dtype is torch.float16)
+        self.criterion = torch.nn.BCELoss()
+        self.accumulated = {"sample_size": 0, "ntokens": 0}
+
+    def autocast(self):
+        return torch.amp.autocast(self.device.type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None)
+
+    def score(self, src_sentence, trg_sentence):
+        with torch.no_grad(), self.autocast():
+            return self.discriminator(src_sentence.to(self.device), trg_sentence.to(self.device)).float().cpu()
+
+    def train_step(self, src_sentence, fake_sentence, true_sentence, ntokens):
+        """As ModelTrainer.discriminator_step, the gradients are accumulated until update_tokens tokens."""
+        if self.accumulated["sample_size"] == 0:
+            self.optimizer.zero_grad()
+        d_loss, acc = discriminator_loss_acc(
+            self.discriminator, self.criterion, src_sentence.to(self.device), fake_sentence.to(self.device),
+            true_sentence.to(self.device), autocast=self.autocast
+        )
+        # the discriminator loss is averaged over the positive and negative sentences
+        bsz = 2 * true_sentence.size(0)
+        self.scaler.scale(d_loss * bsz).backward()
+        self.accumulated["sample_size"] += bsz
+        self.accumulated["ntokens"] += ntokens
+        if self.accumulated["ntokens"] < self.update_tokens:
+            return d_loss.item(), acc.item(), False
+
+        for group in self.optimizer.param_groups:
+            for p in group["params"]:
+                if p.grad is not None:
+                    p.grad.div_(self.accumulated["sample_size"])
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        self.accumulated = {"sample_size": 0, "ntokens": 0}
+        return d_loss.item(), acc.item(), True
+
+    def handle(self, request):
+        kind, args = request[1], request[2:]
+        if kind == "score":
+            return self.score(*args)
+        if kind == "train":
+            return self.train_step(*args)
+        if kind == "mode":
+            self.discriminator.train(*args)
+            return None
+        if kind == "module":
+            # a copy, the queue would share the storage of CPU tensors
+            return copy.deepcopy(self.discriminator).cpu()
+        if kind == "sync":
+            return None
+        raise ValueError(f"Unknown discriminator request: {kind}")
+
+    def next_request(self, pending):
+        # scores may overtake at most `staleness` training requests, but nothing else
+        for i, request in enumerate(pending):
+            if request[1] == "score":
+                if i <= self.staleness:
+                    del pending[i]
+                    return request
+                break
+            if request[1] != "train":
+                break
+        return pending.popleft()
+
+    def serve(self, requests, responses):
+        pending = collections.deque()
+        while True:
+            if not pending:
+                pending.append(requests.get())
+            try:
+                while True:
+                    pending.append(requests.get_nowait())
+            except queue.Empty:
+                pass
+
+            request = self.next_request(pending)
+            if request[1] == "stop":
+                return
+            try:
+                result = self.handle(request)
+                if request[1] != "mode":
+                    responses.put((request[0], result, None))
+            except Exception:
+                responses.put((request[0], None, traceback.format_exc()))
+
+
+def _serve(discriminator, config, requests, responses):
+    torch.set_num_threads(config["num_threads"])
+    DiscriminatorServer(discriminator, config).serve(requests, responses)
+
+
+class DiscriminatorClient:
+    """
+    Stands in for the discriminator of a trainer, which runs in a DiscriminatorServer process on device:
+    calling it returns the scores, train_step sends a training batch without waiting for the update, whose
+    loss and accuracy are returned later by trained(). The scores are computed by a discriminator that misses
+    at most `staleness` of the training batches sent before them.
+    """
+
+    def __init__(self, discriminator, args, device, num_threads=None):
+        config = {
+            "device": str(device),
+            "staleness": args.discriminator_staleness,
+            "update_tokens": args.d_update_tokens,
+            "amp": args.amp,
+            "optimizer": args.d_optimizer,
+            "lr": args.d_learning_rate,
+            "num_threads": num_threads or torch.get_num_threads(),
+        }
+        ctx = mp.get_context("spawn")
+        self.requests = ctx.Queue()
+        self.responses = ctx.Queue()
+        self.process = ctx.Process(target=_serve, args=(discriminator.cpu(), config, self.requests, self.responses),
+                                   daemon=True)
+        self.process.start()
+        self.training = True
+        self.next_id = 0
+        self.results = {}
+        self.in_training = collections.OrderedDict()  # id -> meta of the training requests not returned yet
+
+    def submit(self, kind, *args):
+        request_id = self.next_id
+        self.next_id += 1
+        self.requests.put((request_id, kind) + args)
+        return request_id
+
+    def receive(self, block=True):
+        request_id, result, error = self.responses.get(block=block)
+        if error is not None:
+            raise RuntimeError(f"Discriminator server failed:\n{error}")
+        self.results[request_id] = result
+
+    def wait(self, request_id):
+        while request_id not in self.results:
+            self.receive()
+        return self.results.pop(request_id)
+
+    def __call__(self, src_sentence, trg_sentence):
+        scores = self.wait(self.submit("score", src_sentence.cpu(), trg_sentence.cpu()))
+        return scores.to(trg_sentence.device)
+
+    def train_step(self, src_sentence, fake_sentence, true_sentence, ntokens, meta=None):
+        request_id = self.submit("train", src_sentence.cpu(), fake_sentence.cpu(), true_sentence.cpu(), ntokens)
+        self.in_training[request_id] = meta
+
+    def trained(self, block=False):
+        """(meta, d_loss, acc, updated) of the finished training requests, in order; all of them if block."""
+        try:
+            while True:
+                self.receive(block=False)
+        except queue.Empty:
+            pass
+        done = []
+        for request_id in list(self.in_training):
+            if request_id not in self.results and not block:
+                break
+            d_loss, acc, updated = self.wait(request_id)
+            done.append((self.in_training.pop(request_id), d_loss, acc, updated))
+        return done
+
+    def train(self, mode=True):
+        self.training = mode
+        self.submit("mode", mode)
+        return self
+
+    def eval(self):
+        return self.train(False)
+
+    def synchronize(self):
+        """Wait until all the requests sent so far were served."""
+        self.wait(self.submit("sync"))
+
+    def module(self):
+        """A CPU copy of the served discriminator, e.g. to save it."""
+        return self.wait(self.submit("module"))
+
+    def close(self):
+        if self.process.is_alive():
+            self.submit("stop")
+            self.process.join()
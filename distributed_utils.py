@@ -0,0 +1,118 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+
+import logging
+
+import torch
+import torch.distributed
+
+
+def is_master(args):
+    return args.distributed_rank == 0
+
+
+def distributed_init(args):
+    if args.distributed_world_size == 1:
+        raise ValueError('Cannot initialize distributed with distributed_world_size=1')
+    if args.distributed_init_method is None:
+        raise ValueError('--distributed-init-method is required with distributed_world_size > 1 '
+                         '(or start the workers with multiprocessing_train.py)')
+
+    print('| distributed init (rank {}): {}'.format(
+        args.distributed_rank, args.distributed_init_method), flush=True)
+    torch.distributed.init_process_group(
+        backend=args.distributed_backend, init_method=args.distributed_init_method,
+        world_size=args.distributed_world_size, rank=args.distributed_rank)
+
+    if not is_master(args):
+        suppress_output()
+
+    return args.distributed_rank
+
+
+def suppress_output():
+    """Suppress printing and info logging on the current worker. Force printing with `force=True`."""
+    import builtins as __builtin__
+    builtin_print = __builtin__.print
+
+    def print(*args, **kwargs):
+        if 'force' in kwargs:
+            force = kwargs.pop('force')
+            if force:
+                builtin_print(*args, **kwargs)
+
+    __builtin__.print = print
+    logging.getLogger().setLevel(logging.WARNING)
+
+
+def _device():
+    # nccl only reduces cuda tensors, gloo reduces both
+    if torch.distributed.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
+def all_reduce_sum(values):
+    """Sum a list of numbers over the workers."""
+    buf = torch.tensor([float(v) for v in values], dtype=torch.float64, device=_device())
+    torch.distributed.all_reduce(buf)
+    return buf.tolist()
+
+
+def broadcast_module(module, src=0):
+    """Copy the parameters and buffers of module on worker src to all the workers."""
+    for t in list(module.parameters()) + list(module.buffers()):
+        torch.distributed.broadcast(t.data, src)
+
+
+def all_reduce_and_rescale_gradients(params, rescale_denom, buffer_size=10485760):
+    """All-reduce the gradients of params in buckets of at most buffer_size
+    elements and divide them by rescale_denom.
+
+    A parameter without gradient on a worker (e.g. on an empty batch) counts
+    as zero there; it is left without gradient only if it has none on any
+    worker, so that the optimizers skip the same parameters everywhere.
+    """
+    params = [p for p in params if p.requires_grad]
+    if len(params) == 0:
+        return
+    has_grad = all_reduce_sum([p.grad is not None for p in params])
+    params = [p for p, n in zip(params, has_grad) if n > 0]
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+
+    def all_reduce_bucket(bucket):
+        grads = [p.grad for p in bucket]
+        if len(grads) == 1:
+            torch.distributed.all_reduce(grads[0])
+            grads[0].div_(rescale_denom)
+            return
+        buf = torch.cat([g.reshape(-1) for g in grads])
+        torch.distributed.all_reduce(buf)
+        buf.div_(rescale_denom)
+        for g, reduced in zip(grads, buf.split([g.numel() for g in grads])):
+            g.copy_(reduced.view_as(g))
+
+    bucket, filled = [], 0
+    for p in params:
+        if filled + p.numel() > buffer_size and len(bucket) > 0:
+            all_reduce_bucket(bucket)
+            bucket, filled = [], 0
+        bucket.append(p)
+        filled += p.numel()
+    all_reduce_bucket(bucket)
+
+
+def all_reduce_meters(meters):
+    """Sum the AverageMeters (sum and count) over the workers, in place."""
+    keys = [k for k, m in meters.items() if m is not None]
+    totals = all_reduce_sum([meters[k].sum for k in keys] + [meters[k].count for k in keys])
+    for k, total, count in zip(keys, totals[:len(keys)], totals[len(keys):]):
+        meters[k].sum = total
+        meters[k].count = count
+        meters[k].avg = total / count if count > 0 else 0
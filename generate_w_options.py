@@ -1,4 +1,5 @@
 import argparse
+import hashlib
 import json
 
 import tqdm
@@ -96,16 +97,298 @@ import os
 from pprint import pprint
 
 import datasets
+import numpy as np
+import sacrebleu
+import torch
 from sklearn.model_selection import ParameterGrid
 
+def length_sorted_batches(partition, batch_size):
+    """Group example indices into batches of similar source length, longest first"""
+    order = np.argsort(partition.src.sizes, kind='mergesort')[::-1]
+    return [order[i: i + batch_size].tolist() for i in range(0, len(order), batch_size)]
+
+
+def collate_for_t5(partition, batch_indices, pad_token_id=0):
+    """Pad sources of the selected examples and build the attention mask"""
+    entries = [partition[ind] for ind in batch_indices]
+    sources = [entry["source"] - 1 for entry in entries]
+    targets = [entry["target"] - 1 for entry in entries]
+
+    max_len = max(src.size(0) for src in sources)
+    input_ids = torch.full((len(sources), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(sources), max_len), dtype=torch.long)
+    for i, src in enumerate(sources):
+        input_ids[i, :src.size(0)] = src
+        attention_mask[i, :src.size(0)] = 1
+    return input_ids, attention_mask, targets
+
+
+def compute_example_metrics(predictions, targets, inputs, rouge_metric):
+    # same values as calling the sacrebleu metric for every example separately, without the per call overhead
+    bleu = [sacrebleu.corpus_bleu([pred], [[trg]]).score for pred, trg in zip(predictions, targets)]
+    rouge = rouge_metric.compute(predictions=predictions, references=inputs, use_aggregator=False)
+    return [
+        {
+            "bleu": bleu[i],
+            "rouge1f1": rouge["rouge1"][i].fmeasure,
+            "rouge2f1": rouge["rouge2"][i].fmeasure,
+            "rougeLf1": rouge["rougeL"][i].fmeasure
+        } for i in range(len(predictions))
+    ]
+
+
+def encode_hidden_states(model, input_ids, attention_mask, device):
+    with torch.no_grad():
+        return model.get_encoder()(
+            input_ids=input_ids.to(device), attention_mask=attention_mask.to(device), return_dict=True
+        ).last_hidden_state
+
+
+def prepare_batches(model, tokenizer, partition, batch_size, device, cache_encoder_outputs=False, cache_gb=None):
+    """
+    Tokenize and decode the partition once for all decoding configs. When cache_encoder_outputs is set,
+    encoder hidden states are computed here as well and reused by every grid point. They are kept in host
+    memory (pinned for a cuda device), num_examples x src_len x d_model floats in total, and moved to the
+    device one batch at a time by generate_batch. With cache_gb, batches are cached until they take
+    cache_gb GB, the remaining ones are encoded again by each grid point.
+    """
+    batches = []
+    cache_bytes = 0
+    for batch_indices in length_sorted_batches(partition, batch_size):
+        input_ids, attention_mask, labels = collate_for_t5(partition, batch_indices, tokenizer.pad_token_id)
+        batch = {
+            "indices": batch_indices,
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "inputs": tokenizer.batch_decode(input_ids, skip_special_tokens=True),
+            "targets": tokenizer.batch_decode(labels, skip_special_tokens=True),
+            "encoder_hidden_states": None,
+        }
+        if cache_encoder_outputs and (cache_gb is None or cache_bytes < cache_gb * 2 ** 30):
+            hidden_states = encode_hidden_states(model, input_ids, attention_mask, device).cpu()
+            if device.type == "cuda":
+                hidden_states = hidden_states.pin_memory()
+            cache_bytes += hidden_states.numel() * hidden_states.element_size()
+            batch["encoder_hidden_states"] = hidden_states
+        batches.append(batch)
+    return batches
+
+
+def generate_batch(model, batch, g_params, device):
+    from transformers.modeling_outputs import BaseModelOutput
+
+    hidden_states = batch["encoder_hidden_states"]
+    if hidden_states is None:
+        hidden_states = encode_hidden_states(model, batch["input_ids"], batch["attention_mask"], device)
+
+    with torch.no_grad():
+        # generate expands encoder outputs for beam search in place, always pass a fresh wrapper
+        return model.generate(
+            batch["input_ids"].to(device), attention_mask=batch["attention_mask"].to(device),
+            encoder_outputs=BaseModelOutput(last_hidden_state=hidden_states.to(device, non_blocking=True)), **g_params
+        )[:, 1:].cpu()
+
+
+def config_hash(g_params, args, num_examples):
+    """Identifies a generation run, progress is only resumed for a run with the same hash"""
+    config = {
+        "g_params": g_params,
+        "ckpt_path": args.ckpt_path,
+        "data_path": args.data_path,
+        "use_test": args.use_test,
+        "batch_size": args.batch_size,  # batch composition defines the order in which examples are written
+        "num_examples": num_examples,
+    }
+    return hashlib.md5(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def load_progress(progress_name):
+    if not os.path.isfile(progress_name):
+        return None
+    with open(progress_name) as progress_source:
+        return json.loads(progress_source.read())
+
+
+def save_progress(progress_name, progress):
+    # write to a temporary file first so that an interrupted write does not corrupt the progress
+    with open(progress_name + ".tmp", "w") as progress_sink:
+        progress_sink.write(json.dumps(progress, indent=4))
+    os.replace(progress_name + ".tmp", progress_name)
+
+
+def read_results(output_name):
+    """Read generated entries back in dataset order"""
+    with open(output_name) as source:
+        source.readline()  # skip generation parameters
+        entries = [json.loads(line) for line in source]
+    return sorted(entries, key=lambda entry: entry["id"])
+
+
+def run_grid_point(model, tokenizer, batches, num_examples, g_params, output_name, args, bleu_metric, rouge_metric, device):
+    """
+    Generate outputs for one decoding config. Entries are appended to output_name in the order batches are
+    processed and flushed every args.flush_every batches, after which progress is recorded next to the output.
+    An interrupted run with the same config continues from the last flushed batch.
+    """
+    print(g_params)
+    print("\n\n\n")
+
+    progress_name = output_name[:-len(".jsonl")] + ".progress.json"
+    run_hash = config_hash(g_params, args, num_examples)
+    progress = load_progress(progress_name)
+
+    if progress is not None and progress["config_hash"] == run_hash and os.path.isfile(output_name):
+        sink = open(output_name, "r+")
+        # drop entries written after the last recorded flush
+        sink.seek(progress["output_offset"])
+        sink.truncate()
+        if not progress["finished"]:
+            print(f"Resuming {output_name} after {progress['completed_examples']} examples")
+    else:
+        sink = open(output_name, "w")
+        sink.write(f"{json.dumps(g_params)}\n")
+        sink.flush()
+        progress = {
+            "config_hash": run_hash,
+            "completed_batches": 0,
+            "completed_examples": 0,
+            "last_example": None,
+            "output_offset": sink.tell(),
+            "finished": False,
+        }
+        save_progress(progress_name, progress)
+
+    buffer = []
+    buffered_examples = 0
+    remaining = range(progress["completed_batches"], len(batches))
+    for batch_ind in tqdm.tqdm(remaining, initial=progress["completed_batches"], total=len(batches)):
+        batch = batches[batch_ind]
+        outputs = generate_batch(model, batch, g_params, device)
+
+        inps, trgs = batch["inputs"], batch["targets"]
+        preds = tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+        if args.write_to_json:
+            metrics = compute_example_metrics(preds, trgs, inps, rouge_metric)
+        else:
+            metrics = [None] * len(preds)
+
+        for ind, inp, trg, pred, example_metrics in zip(batch["indices"], inps, trgs, preds, metrics):
+            out_entry = {
+                "id": ind,
+                "input": inp,
+                "target": trg,
+                "output": pred,
+                "metrics": example_metrics
+            }
+            buffer.append(f"{json.dumps(out_entry)}\n")
+        buffered_examples += len(preds)
+
+        if (batch_ind + 1) % args.flush_every == 0 or batch_ind + 1 == len(batches):
+            sink.write("".join(buffer))
+            sink.flush()
+            os.fsync(sink.fileno())
+
+            progress["completed_batches"] = batch_ind + 1
+            progress["completed_examples"] += buffered_examples
+            progress["last_example"] = batch["indices"][-1]
+            progress["output_offset"] = sink.tell()
+            save_progress(progress_name, progress)
+
+            buffer = []
+            buffered_examples = 0
+
+    sink.close()
+
+    if not progress["finished"]:
+        progress["finished"] = True
+        save_progress(progress_name, progress)
+
+    # outputs are written in length sorted order, restore the dataset order for the final outputs
+    results = read_results(output_name)
+
+    if args.save_predictions_to_txt:
+        output_name_txt = output_name[:-5] + "txt"
+        with open(output_name_txt, 'w+') as out_txt:
+            for out_entry in results:
+                out_txt.write(out_entry["output"] + '\n')
+
+    if args.write_to_json:
+        bleu = bleu_metric.compute(
+            predictions=[out_entry["output"] for out_entry in results],
+            references=[[out_entry["target"]] for out_entry in results]
+        )
+        rouge = rouge_metric.compute(
+            predictions=[out_entry["output"] for out_entry in results],
+            references=[out_entry["input"] for out_entry in results]
+        )
+        print(f"{output_name}: Corpus BLEU: {bleu['score']:.2f}, "
+              f"ROUGE-1 F1: {rouge['rouge1'].mid.fmeasure:.4f}, "
+              f"ROUGE-2 F1: {rouge['rouge2'].mid.fmeasure:.4f}, "
+              f"ROUGE-L F1: {rouge['rougeL'].mid.fmeasure:.4f}")
+
+
+# state shared with sweep worker processes, set once per worker by _init_sweep_worker
+_sweep_state = {}
+
+
+def _init_sweep_worker(model, batches, num_examples, args, num_threads):
+    from transformers import T5Tokenizer
+
+    torch.set_num_threads(num_threads)
+    _sweep_state.update({
+        "model": model,
+        "tokenizer": T5Tokenizer.from_pretrained('t5-small'),
+        "batches": batches,
+        "num_examples": num_examples,
+        "args": args,
+        "bleu_metric": datasets.load_metric('sacrebleu'),
+        "rouge_metric": datasets.load_metric('rouge'),
+    })
+
+
+def _run_sweep_task(task):
+    g_params, output_name = task
+    run_grid_point(
+        _sweep_state["model"], _sweep_state["tokenizer"], _sweep_state["batches"], _sweep_state["num_examples"],
+        g_params, output_name, _sweep_state["args"], _sweep_state["bleu_metric"], _sweep_state["rouge_metric"],
+        torch.device("cpu")
+    )
+    return output_name
+
+
+def run_sweep(model, batches, num_examples, tasks, args, num_workers):
+    """
+    Spread grid points over a pool of CPU worker processes. Model weights and cached encoder outputs
+    are moved to shared memory, so workers do not hold their own copies.
+    """
+    import torch.multiprocessing as mp
+
+    model.share_memory()
+    for batch in batches:
+        for key in ("input_ids", "attention_mask", "encoder_hidden_states"):
+            if batch[key] is not None:
+                batch[key].share_memory_()
+
+    num_threads = max(1, torch.get_num_threads() // num_workers)
+    with mp.get_context("spawn").Pool(
+            num_workers, initializer=_init_sweep_worker, initargs=(model, batches, num_examples, args, num_threads)
+    ) as pool:
+        for output_name in pool.imap_unordered(_run_sweep_task, tasks):
+            print(f"Finished {output_name}")
+
+
 def test_T5(args):
     from transformers import T5Tokenizer, T5ForConditionalGeneration, T5Config
     from SeqT5 import SeqT5
     import data
 
+    device = torch.device(args.device if args.device is not None else ("cuda" if torch.cuda.is_available() else "cpu"))
+
     tokenizer = T5Tokenizer.from_pretrained('t5-small')
     # model = SeqT5.from_pretrained(os.path.join(args.ckpt_path, "best_gmodel.pt")).cpu()
-    model = SeqT5.from_pretrained(args.ckpt_path).cpu()
+    model = SeqT5.from_pretrained(args.ckpt_path).to(device)
+    model.eval()
 
     splits = ['test', 'valid']
     dataset = data.load_dataset(args.data_path, splits)
@@ -128,81 +411,31 @@ def test_T5(args):
             "diversity_penalty": [args.diversity_penalty]
         })
 
-    bleu_metric = datasets.load_metric('sacrebleu')
-    rouge_metric = datasets.load_metric('rouge')
-
-    metrics = {
-        "bleu": [],
-        "rouge1f1": [],
-        "rouge2f1": [],
-        "rougeLf1": []
-    }
-
-    # experiments = []
-    # outs = []
-
-
-
-    for par_ind, g_params in enumerate(generator_params):
-        output_name = f"exp_{args.note.replace(' ', '_')}_{par_ind}.jsonl"
-        # if os.path.isfile(output_name):
-        #     raise Exception("Output file exists, change experiment note")
-        with open(output_name, "w") as sink:
-            print(g_params)
-            print("\n\n\n")
-            sink.write(f"{json.dumps(g_params)}\n")
+    tasks = [
+        (g_params, f"exp_{args.note.replace(' ', '_')}_{par_ind}.jsonl")
+        for par_ind, g_params in enumerate(generator_params)
+    ]
 
-            if args.save_predictions_to_txt:
-                output_name_txt = output_name[:-5] + "txt"
-                out_txt = open(output_name_txt, 'w+')
+    # encoder outputs only depend on the model and the inputs, compute them once if several configs are decoded
+    batches = prepare_batches(
+        model, tokenizer, partition, args.batch_size, device, cache_encoder_outputs=len(tasks) > 1,
+        cache_gb=args.encoder_cache_gb
+    )
 
-            for ind, entry in tqdm.tqdm(enumerate(partition)):
-                input_ids = entry["source"] - 1
-                labels = entry["target"] - 1
-
-                outputs = model.generate(input_ids.reshape(1,-1), **g_params)[0][1:]
-
-                inp = tokenizer.decode(input_ids, skip_special_tokens=True)
-                trg = tokenizer.decode(labels, skip_special_tokens=True)
-                pred = tokenizer.decode(outputs, skip_special_tokens=True)
-
-                if args.save_predictions_to_txt:
-                    out_txt.write(pred + '\n')
-
-                if not args.write_to_json:
-                    continue
-
-                bleu = bleu_metric.compute(predictions=[pred], references=[[trg]]) # bleu["score"]
-                rouge = rouge_metric.compute(predictions=[pred], references=[inp]) # rouge["rougeL"].high.fmeasure
-
-                # metrics["bleu"].append(bleu["score"])
-                # metrics["rouge1f1"].append(rouge["rouge1"].high.fmeasure)
-                # metrics["rouge2f1"].append(rouge["rouge2"].high.fmeasure)
-                # metrics["rougeLf1"].append(rouge["rougeL"].high.fmeasure)
-
-                metrics = {
-                    "bleu": bleu["score"],
-                    "rouge1f1": rouge["rouge1"].high.fmeasure,
-                    "rouge2f1": rouge["rouge2"].high.fmeasure,
-                    "rougeLf1": rouge["rougeL"].high.fmeasure
-                }
-
-                out_entry = {
-                    "input": inp,
-                    "target": trg,
-                    "output": pred,
-                    "metrics": metrics
-                }
-
-                # print("s: ", tokenizer.decode(input_ids, skip_special_tokens=True))
-                # print("t: ", tokenizer.decode(labels, skip_special_tokens=True))
-                # print("g: ", tokenizer.decode(outputs, skip_special_tokens=True))
-                # print("")
-
-                sink.write(f"{json.dumps(out_entry)}\n")
+    num_workers = min(args.num_workers, len(tasks))
+    if num_workers > 1 and device.type == "cpu":
+        run_sweep(model, batches, len(partition), tasks, args, num_workers)
+    else:
+        bleu_metric = datasets.load_metric('sacrebleu')
+        rouge_metric = datasets.load_metric('rouge')
 
-                # if ind > 10 :
-                #     break
+        for g_params, output_name in tasks:
+            # if os.path.isfile(output_name):
+            #     raise Exception("Output file exists, change experiment note")
+            run_grid_point(
+                model, tokenizer, batches, len(partition), g_params, output_name, args, bleu_metric, rouge_metric,
+                device
+            )
 
     # references for repetition penalty https://huggingface.co/blog/how-to-generate
     # print()
@@ -233,6 +466,11 @@ if __name__ == "__main__":
     parser.add_argument("--use_parameter_grid", action='store_true')
     parser.add_argument("--save_predictions_to_txt", action='store_false')  # means will save to txt by default
     parser.add_argument("--write_to_json", action='store_false')  # means will write to json by default
+    parser.add_argument("--batch_size", default=32, type=int)  # number of examples decoded at once
+    parser.add_argument("--device", default=None)  # cuda if available by default
+    parser.add_argument("--num_workers", default=1, type=int)  # processes for decoding grid points in parallel on cpu
+    parser.add_argument("--flush_every", default=10, type=int)  # write outputs and record progress every N batches
+    parser.add_argument("--encoder_cache_gb", default=None, type=float)  # host memory bound of the cached encoder outputs
 
     args = parser.parse_args()
 
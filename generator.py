@@ -1,3 +1,5 @@
+from typing import List, Optional
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -37,6 +39,8 @@ class LSTMModel(nn.Module):
             dropout_out=args.decoder_dropout_out,
             use_cuda=self.use_cuda
         )
+        if getattr(args, 'script_decoder_step', False):
+            self.decoder.script_step()
 
     def forward(self, sample, inference=False):
         # encoder_output: (seq_len, batch, hidden_size * num_directions)
@@ -58,6 +62,45 @@ class LSTMModel(nn.Module):
         
         return decoder_out
 
+    def rollout(self, sample, temperature=1., top_k=0, top_p=1., epsilon=0.):
+        """
+        Sample a sequence of the length of the target token by token, encoding
+        the source once and stepping the decoder on its incremental state.
+        Returns (logits, tokens, modified_logits) like SeqT5.top_p_decode:
+        the unnormalized logits of the model, the sampled tokens and the log
+        probabilities they were sampled from, for importance sampling.
+        """
+        src_tokens = sample['net_input']['src_tokens']
+        bsz, seqlen = sample['net_input']['prev_output_tokens'].size()
+
+        encoder_out = self.encoder(src_tokens, sample['net_input']['src_lengths'])
+        incremental_state = {}
+
+        output_logits = []
+        modified_logits = []
+        output_tokens = []
+        # decoding starts from eos, as in prev_output_tokens
+        next_tokens = src_tokens.new(bsz, 1).fill_(self.dst_dict.eos())
+        for _ in range(seqlen):
+            # inference=True: VarLSTMDecoder decodes from the mean of the latent
+            logits = self.decoder(next_tokens, encoder_out, incremental_state, inference=True)[0][:, -1, :]
+
+            last_token_logits = logits.float() / temperature  # sampling distribution in float32 under autocast
+            last_token_logits_filtered = utils.top_k_top_p_filtering(last_token_logits, top_k=top_k, top_p=top_p)
+
+            last_token_logits = torch.log(F.softmax(last_token_logits, dim=-1) * epsilon + F.softmax(last_token_logits_filtered, dim=-1) * (1. - epsilon))
+
+            next_tokens = torch.multinomial(last_token_logits.exp(), num_samples=1)
+            output_logits.append(logits.unsqueeze(1))
+            modified_logits.append(last_token_logits.unsqueeze(1))
+            output_tokens.append(next_tokens)
+
+        output_logits = torch.cat(output_logits, dim=1)
+        modified_logits = torch.cat(modified_logits, dim=1)
+        output_tokens = torch.cat(output_tokens, dim=1)
+
+        return output_logits, output_tokens, modified_logits
+
     def get_normalized_probs(self, net_output, log_probs):
         """Get normalized probabilities (or log probs) from a net's output."""
         vocab = net_output.size(-1)
@@ -83,6 +126,8 @@ class VarLSTMModel(LSTMModel):
             dropout_out=args.decoder_dropout_out,
             use_cuda=self.use_cuda
         )
+        if getattr(args, 'script_decoder_step', False):
+            self.decoder.script_step()
 
     def forward(self, sample, inference=False):
         encoder_out = self.encoder(sample['net_input']['src_tokens'],
@@ -144,6 +189,10 @@ class LSTMEncoder(nn.Module):
 
         return x, final_hiddens, final_cells
 
+    def reorder_encoder_out(self, encoder_out, new_order):
+        """Select the batch entries given by new_order (batch is dim 1)."""
+        return tuple(out.index_select(1, new_order) for out in encoder_out)
+
     def max_positions(self):
         """Maximum input length supported by the encoder."""
         return int(1e5)  # an arbitrary large number
@@ -157,23 +206,61 @@ class AttentionLayer(nn.Module):
 
     def forward(self, input, source_hids):
         # input: bsz x input_embed_dim
-        # source_hids: srclen x bsz x output_embed_dim
+        # source_hids: bsz x srclen x output_embed_dim
 
         # x: bsz x output_embed_dim
         x = self.input_proj(input)
 
         # compute attention
-        attn_scores = (source_hids * x.unsqueeze(0)).sum(dim=2)
-        attn_scores = F.softmax(attn_scores.t(), dim=1).t()  # srclen x bsz
+        attn_scores = torch.bmm(source_hids, x.unsqueeze(2)).squeeze(2)
+        attn_scores = F.softmax(attn_scores, dim=1)  # bsz x srclen
 
         # sum weighted sources
-        x = (attn_scores.unsqueeze(2) * source_hids).sum(dim=0)
+        x = torch.bmm(attn_scores.unsqueeze(1), source_hids).squeeze(1)
 
         x = torch.tanh(self.output_proj(torch.cat((x, input), dim=1)))
         return x, attn_scores
 
 
+class DecoderStep(nn.Module):
+    """One time step of LSTMDecoder: input feeding, the LSTMCell stack and
+    attention. Can be compiled with torch.jit.script."""
+    def __init__(self, layers, attention, dropout_out):
+        super().__init__()
+        self.layers = layers
+        self.attention = attention
+        self.dropout_out = dropout_out
+
+    def forward(self, x, input_feed, latent: Optional[torch.Tensor], prev_hiddens: List[torch.Tensor],
+                prev_cells: List[torch.Tensor], source_hids):
+        # input feeding: concatenate context vector from previous time step
+        input = torch.cat((x, input_feed), dim=1)
+        if latent is not None:
+            input = torch.cat([input, latent], dim=1)
+
+        hiddens: List[torch.Tensor] = []
+        cells: List[torch.Tensor] = []
+        for i, rnn in enumerate(self.layers):
+            # recurrent cell
+            hidden, cell = rnn(input, (prev_hiddens[i], prev_cells[i]))
+
+            # hidden state becomes the input to the next layer
+            input = F.dropout(hidden, p=self.dropout_out, training=self.training)
+
+            # save state for next time step
+            hiddens.append(hidden)
+            cells.append(cell)
+
+        # apply attention using the last layer's hidden state
+        out, attn_scores = self.attention(hiddens[-1], source_hids)
+        out = F.dropout(out, p=self.dropout_out, training=self.training)
+        return out, attn_scores, hiddens, cells
+
+
 class LSTMDecoder(nn.Module):
+    # run the decoder steps through TorchScript, see script_step
+    scripted_step = False
+
     def __init__(self, dictionary, encoder_embed_dim=512, embed_dim=512,
                  out_embed_dim=512, num_layers=1, dropout_in=0.1,
                  dropout_out=0.1, use_cuda=True):
@@ -193,6 +280,31 @@ class LSTMDecoder(nn.Module):
             self.additional_fc = Linear(embed_dim, out_embed_dim)
         self.fc_out = Linear(out_embed_dim, num_embeddings, dropout=dropout_out)
 
+    @property
+    def step(self):
+        """The DecoderStep over layers and attention. It is not a submodule,
+        so its parameters are not listed twice, and it is left out of the
+        pickled state since script modules cannot be pickled."""
+        step = self.__dict__.get('_step')
+        if step is None:
+            step = DecoderStep(self.layers, self.attention, self.dropout_out)
+            if self.scripted_step:
+                step = torch.jit.script(step)
+            self.__dict__['_step'] = step
+        step.train(self.training)
+        return step
+
+    def script_step(self):
+        """Run the decoder steps through TorchScript."""
+        self.scripted_step = True
+        self.__dict__.pop('_step', None)
+        return self
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_step', None)
+        return state
+
     def create_layers(self, encoder_embed_dim, embed_dim, num_layers):
         self.layers = nn.ModuleList([
             LSTMCell(encoder_embed_dim + embed_dim if layer == 0 else embed_dim, embed_dim)
@@ -204,9 +316,7 @@ class LSTMDecoder(nn.Module):
             prev_output_tokens = prev_output_tokens[:, -1:]
         bsz, seqlen = prev_output_tokens.size()
 
-        # get outputs from encoder
-        encoder_outs, _, _ = encoder_out
-        srclen = encoder_outs.size(0)
+        source_hids = self.get_source_hids(encoder_out, incremental_state)
 
         x = self.embed_tokens(prev_output_tokens) # (bze, seqlen, embed_dim)
         x = F.dropout(x, p=self.dropout_in, training=self.training)
@@ -228,54 +338,55 @@ class LSTMDecoder(nn.Module):
             prev_cells = [encoder_cells[i] for i in range(num_layers)]
             input_feed = Variable(x.data.new(bsz, embed_dim).zero_())
 
-        attn_scores = Variable(x.data.new(srclen, seqlen, bsz).zero_())
+        step = self.step
         outs = []
+        attn_scores = []
         for j in range(seqlen):
-            # input feeding: concatenate context vector from previous time step
-            input = torch.cat((x[j, :, :], input_feed), dim=1)
-
-            for i, rnn in enumerate(self.layers):
-                # recurrent cell
-                hidden, cell = rnn(input, (prev_hiddens[i], prev_cells[i]))
-
-                # hidden state becomes the input to the next layer
-                input = F.dropout(hidden, p=self.dropout_out, training=self.training)
-
-                # save state for next time step
-                prev_hiddens[i] = hidden
-                prev_cells[i] = cell
-
-            # apply attention using the last layer's hidden state
-            out, attn_scores[:, j, :] = self.attention(hidden, encoder_outs)
-            out = F.dropout(out, p=self.dropout_out, training=self.training)
+            out, attn, prev_hiddens, prev_cells = step(
+                x[j, :, :], input_feed, None, prev_hiddens, prev_cells, source_hids)
 
             # input feeding
             input_feed = out
 
             # save final output
             outs.append(out)
+            attn_scores.append(attn)
 
         # cache previous states (no-op except during incremental generation)
         utils.set_incremental_state(
             self, incremental_state, 'cached_state', (prev_hiddens, prev_cells, input_feed))
 
-        # collect outputs across time steps
-        x = torch.cat(outs, dim=0).view(seqlen, bsz, embed_dim)
-        # T x B x C -> B x T x C
-        x = x.transpose(1, 0)
-        # srclen x tgtlen x bsz -> bsz x tgtlen x srclen
-        attn_scores = attn_scores.transpose(0, 2)
+        # collect outputs across time steps: bsz x tgtlen x embed_dim
+        x = torch.stack(outs, dim=1)
+        # bsz x tgtlen x srclen
+        attn_scores = torch.stack(attn_scores, dim=1)
 
+        # project all time steps at once
         x = self.fc_out(x)
 
         return x, attn_scores
 
 
+    def get_source_hids(self, encoder_out, incremental_state=None):
+        """
+        The encoder outputs batch first for the attention, transposed once and
+        cached during incremental generation.
+        """
+        source_hids = utils.get_incremental_state(self, incremental_state, 'source_hids')
+        if source_hids is None:
+            encoder_outs, _, _ = encoder_out
+            source_hids = encoder_outs.transpose(0, 1).contiguous()
+            utils.set_incremental_state(self, incremental_state, 'source_hids', source_hids)
+        return source_hids
+
     def max_positions(self):
         """Maximum output length supported by the decoder."""
         return int(1e5)  # an arbitrary large number
 
     def reorder_incremental_state(self, incremental_state, new_order):
+        source_hids = utils.get_incremental_state(self, incremental_state, 'source_hids')
+        if source_hids is not None:
+            utils.set_incremental_state(self, incremental_state, 'source_hids', source_hids.index_select(0, new_order))
         cached_state = utils.get_incremental_state(self, incremental_state, 'cached_state')
         if cached_state is None:
             return
@@ -337,9 +448,7 @@ class VarLSTMDecoder(LSTMDecoder):
             prev_output_tokens = prev_output_tokens[:, -1:]
         bsz, seqlen = prev_output_tokens.size()
 
-        # get outputs from encoder
-        encoder_outs, _, _ = encoder_out
-        srclen = encoder_outs.size(0)
+        source_hids = self.get_source_hids(encoder_out, incremental_state)
 
         x = self.embed_tokens(prev_output_tokens) # (bze, seqlen, embed_dim)
         x = F.dropout(x, p=self.dropout_in, training=self.training)
@@ -361,54 +470,37 @@ class VarLSTMDecoder(LSTMDecoder):
             prev_cells = [encoder_cells[i] for i in range(num_layers)]
             input_feed = Variable(x.data.new(bsz, embed_dim).zero_())
 
-        attn_scores = Variable(x.data.new(srclen, seqlen, bsz).zero_())
         outs = []
+        attn_scores = []
 
         kld = 0.
         z, mu, logvar = self.reparameterize(prev_hiddens[0])
         kld += self.compute_kld(mu, logvar)
 
-        for j in range(seqlen):
-            # input feeding: concatenate context vector from previous time step
-            input = torch.cat((x[j, :, :], input_feed), dim=1)
-
-            if inference is True:
-                input = torch.cat([input, mu], dim=1)
-            else:
-                input = torch.cat([input, z], dim=1)
+        latent = mu if inference is True else z
 
-            for i, rnn in enumerate(self.layers):
-                # recurrent cell
-                hidden, cell = rnn(input, (prev_hiddens[i], prev_cells[i]))
-
-                # hidden state becomes the input to the next layer
-                input = F.dropout(hidden, p=self.dropout_out, training=self.training)
-
-                # save state for next time step
-                prev_hiddens[i] = hidden
-                prev_cells[i] = cell
-
-            # apply attention using the last layer's hidden state
-            out, attn_scores[:, j, :] = self.attention(hidden, encoder_outs)
-            out = F.dropout(out, p=self.dropout_out, training=self.training)
+        step = self.step
+        for j in range(seqlen):
+            out, attn, prev_hiddens, prev_cells = step(
+                x[j, :, :], input_feed, latent, prev_hiddens, prev_cells, source_hids)
 
             # input feeding
             input_feed = out
 
             # save final output
             outs.append(out)
+            attn_scores.append(attn)
 
         # cache previous states (no-op except during incremental generation)
         utils.set_incremental_state(
             self, incremental_state, 'cached_state', (prev_hiddens, prev_cells, input_feed))
 
-        # collect outputs across time steps
-        x = torch.cat(outs, dim=0).view(seqlen, bsz, embed_dim)
-        # T x B x C -> B x T x C
-        x = x.transpose(1, 0)
-        # srclen x tgtlen x bsz -> bsz x tgtlen x srclen
-        attn_scores = attn_scores.transpose(0, 2)
+        # collect outputs across time steps: bsz x tgtlen x embed_dim
+        x = torch.stack(outs, dim=1)
+        # bsz x tgtlen x srclen
+        attn_scores = torch.stack(attn_scores, dim=1)
 
+        # project all time steps at once
         x = self.fc_out(x)
 
         if inference is True:
@@ -103,6 +103,27 @@ class IndexedInMemoryDataset(IndexedDataset):
         return torch.from_numpy(a)
 
 
+class IndexedMemmapDataset(IndexedDataset):
+    """Loader for TorchNet IndexedDataset, reads the data through a memory
+    map, so it can be shared with forked DataLoader workers"""
+
+    def read_data(self, path):
+        if self.data_offsets[-1] == 0:
+            # an empty file cannot be memory mapped
+            self.buffer = np.empty(0, dtype=self.dtype)
+        else:
+            self.buffer = np.memmap(path + '.bin', dtype=self.dtype, mode='r')
+
+    def __del__(self):
+        pass
+
+    def __getitem__(self, i):
+        self.check_index(i)
+        tensor_size = self.sizes[self.dim_offsets[i]:self.dim_offsets[i + 1]]
+        a = np.array(self.buffer[self.data_offsets[i]:self.data_offsets[i + 1]]).reshape(tensor_size)
+        return torch.from_numpy(a)
+
+
 class IndexedRawTextDataset(IndexedDataset):
     """Takes a text file as input and binarizes it in memory at instantiation.
     Original lines are also kept in memory"""
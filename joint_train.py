@@ -5,6 +5,7 @@ import math
 import torch
 from torch import cuda
 
+import distributed_utils
 import options
 import utils
 
@@ -29,6 +30,8 @@ options.add_optimization_args(parser)
 options.add_checkpoint_args(parser)
 options.add_generator_model_args(parser)
 options.add_discriminator_model_args(parser)
+options.add_discriminator_server_args(parser)
+options.add_actor_learner_args(parser)
 options.add_generation_args(parser)
 
 
@@ -117,11 +120,11 @@ class VarLSTMTrainer(LstmMleTrainer):
         return self.wrap_for_output(sample, logits, kld)
 
 
-if __name__ == "__main__":
-    ret = parser.parse_known_args()
-    options = ret[0]
-    if ret[1]:
-        logging.warning(f"unknown arguments: {parser.parse_known_args()[1]}")
+def main(options):
+    if options.distributed_world_size > 1 and not torch.distributed.is_initialized():
+        # one worker of a distributed run, started by hand (see multiprocessing_train.py for a single node)
+        distributed_utils.distributed_init(options)
+
     model_name = options.model_name
     assert model_name is not None
     # options.note = None
@@ -141,4 +144,12 @@ if __name__ == "__main__":
         trainer = SeqT5Bleurt(options)
     else:
         raise ValueError("Choose appropriate model")
-    trainer.train()
\ No newline at end of file
+    trainer.train()
+
+
+if __name__ == "__main__":
+    ret = parser.parse_known_args()
+    options = ret[0]
+    if ret[1]:
+        logging.warning(f"unknown arguments: {parser.parse_known_args()[1]}")
+    main(options)
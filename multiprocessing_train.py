@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+#
+# Starts --distributed-world-size workers of joint_train.py on this node, e.g.
+#   python multiprocessing_train.py --model_name gan --distributed-world-size 4 --gpuid -1 ...
+# trains with 4 CPU processes (gloo backend).
+
+import logging
+import random
+
+import torch.multiprocessing as mp
+
+import distributed_utils
+from joint_train import main, parser
+
+
+def run(rank, args):
+    args.distributed_rank = rank
+    if isinstance(args.gpuid, list) and len(args.gpuid) > 1:
+        # one GPU per worker
+        args.gpuid = [args.gpuid[rank % len(args.gpuid)]]
+    distributed_utils.distributed_init(args)
+    main(args)
+
+
+if __name__ == '__main__':
+    ret = parser.parse_known_args()
+    args = ret[0]
+    if ret[1]:
+        logging.warning(f"unknown arguments: {ret[1]}")
+
+    if args.distributed_world_size == 1:
+        main(args)
+    else:
+        if args.distributed_init_method is None:
+            port = args.distributed_port if args.distributed_port > 0 else random.randint(10000, 20000)
+            args.distributed_init_method = 'tcp://localhost:{port}'.format(port=port)
+        mp.spawn(run, args=(args,), nprocs=args.distributed_world_size)
@@ -41,11 +41,16 @@ def add_dataset_args(parser):
     return parser
 
 def add_distributed_training_args(parser):
-    parser.add_argument('--distributed-world-size', type=int, metavar='N',
-                       default=torch.cuda.device_count(),
-                       help='total number of GPUs across all nodes (default: all visible GPUs)')
+    parser.add_argument('--distributed-world-size', type=int, metavar='N', default=1,
+                       help='total number of workers (processes) across all nodes (default: 1)')
     parser.add_argument('--distributed-rank', default=0, type=int,
                        help='rank of the current worker')
+    parser.add_argument('--distributed-backend', default='gloo', type=str,
+                        help='torch.distributed backend: gloo (CPU or GPU) or nccl (GPU)')
+    parser.add_argument('--distributed-init-method', default=None, type=str,
+                        help='typically tcp://hostname:port, shared by all the workers')
+    parser.add_argument('--distributed-port', default=-1, type=int,
+                        help='port used by multiprocessing_train.py (default: random)')
     parser.add_argument("--gpuid", default=0, nargs='+', type=int,
                         help="ID of gpu device to use. Empty implies cpu usage.")
 
@@ -97,8 +102,35 @@ def add_optimization_args(parser):
     parser.add_argument('--sentence-avg', action='store_true',  # TODO check impact
                        help='normalize gradients by the number of sentences in a batch'
                             ' (default is to normalize by number of tokens)')
+    parser.add_argument('--vocab-chunk-size', default=None, type=int, metavar='N',
+                        help='compute the T5 generator losses over chunks of N vocabulary entries '
+                             'to cap peak memory (default: whole vocabulary)')
+    parser.add_argument('--g-update-tokens', default=0, type=int, metavar='N',
+                        help='accumulate the generator gradients of micro-batches until N target tokens '
+                             'were seen before each update (default: update after every batch)')
+    parser.add_argument('--d-update-tokens', default=0, type=int, metavar='N',
+                        help='accumulate the discriminator gradients of micro-batches until N target tokens '
+                             'were seen before each update (default: update after every batch)')
+    parser.add_argument('--amp', default='none', choices=['none', 'bf16', 'fp16'],
+                        help='mixed precision training: autocast the forward passes to bfloat16 (CPU or GPU) '
+                             'or float16 (GPU, with gradient scaling); the losses are computed in float32')
+    parser.add_argument('--logits-chunk-size', default=None, type=int, metavar='N',
+                        help='in T5 teacher forcing, project N target positions at a time on the vocabulary and '
+                             'never hold the full logits (default: project all positions at once)')
     parser.add_argument('--gen_sents_in_tb', "-gtb", dest="gen_sents_in_tb", default=10, type=int,
                         help="Number of sentences to write to tensorboard")
+    parser.add_argument('--ppo-epochs', default=1, type=int, metavar='N',
+                        help='PPO-style policy gradient: N updates per rollout, the N - 1 last ones on rollouts '
+                             'replayed from the replay buffer with their cached rewards')
+    parser.add_argument('--ppo-clip', default=None, type=float, metavar='EPS',
+                        help='PPO clipping of the policy gradient: no gradient for the tokens whose importance '
+                             'sampling ratio is above 1 + EPS with a positive reward, or below 1 - EPS with a '
+                             'negative one (e.g. 0.2, default: no clipping)')
+    parser.add_argument('--replay-buffer-size', default=1, type=int, metavar='N',
+                        help='with --ppo-epochs > 1, number of rollout batches kept for replay '
+                             '(default: replay the last rollout only)')
+    parser.add_argument('--replay-eviction', default='fifo', choices=['fifo', 'priority'],
+                        help='with a full replay buffer, evict the oldest rollouts or the ones with the lowest reward')
     return parser
 
 
@@ -131,6 +163,8 @@ def add_generator_model_args(parser):
                        help='unidirectional or bidirectional encoder')
     parser.add_argument('--reduce_tf_frac', action='store_true', default=False,
                         help='reduce the proportion of teacher forcing with each epoch during training')
+    parser.add_argument('--script-decoder-step', action='store_true', default=False,
+                        help='compile the LSTM decoder step with TorchScript')
     parser.add_argument('--freeze_encoder', action='store_true', default=False,
                         help='Do not update weights for T5 encoder')
     parser.add_argument('--g_ckpt_path', default=None, type=str,
@@ -144,6 +178,32 @@ def add_discriminator_model_args(parser):
                        help='the max length the discriminator can hold')
     parser.add_argument('--d-sample-size', default=5000, type=int,  # TODO need to change according to data size
                        help='how many data used to pretrain d in one epoch')
+    parser.add_argument('--disc-data-cache', default='checkpoints/discriminator/negatives', type=str,
+                       help='directory where generated negatives for discriminator training are cached')
+    parser.add_argument('--stream-disc-data', action='store_true',
+                       help='train the discriminator while the negatives of the epoch are being generated')
+    parser.add_argument('--disc-queue-size', default=1024, type=int,
+                       help='max number of streamed discriminator samples held in memory')
+    parser.add_argument('--disc-shuffle-buffer', default=256, type=int,
+                       help='number of streamed discriminator samples shuffled together (1: no shuffling)')
+    return parser
+
+def add_discriminator_server_args(parser):
+    parser.add_argument('--discriminator-server', action='store_true',
+                        help='train and run the discriminator in its own process, overlapping with the generator')
+    parser.add_argument('--discriminator-staleness', default=1, type=int, metavar='N',
+                        help='with --discriminator-server, the rewards may come from a discriminator that has not '
+                             'applied the last N training batches yet (0: same results as without the server)')
+    return parser
+
+def add_actor_learner_args(parser):
+    parser.add_argument('--actor-learner', action='store_true',
+                        help='sample the policy gradient rollouts ahead in a background actor with a copy of the '
+                             'generator; the learner corrects for the older weights by importance sampling')
+    parser.add_argument('--rollout-buffer-size', default=2, type=int, metavar='N',
+                        help='with --actor-learner, number of sampled batches waiting for the learner')
+    parser.add_argument('--actor-sync-every', default=1, type=int, metavar='N',
+                        help='with --actor-learner, copy the generator weights to the actor every N updates')
     return parser
 
 def add_generation_args(parser):
@@ -171,6 +231,16 @@ def add_generation_args(parser):
                         help='unknown word penalty: <0 produces more unks, >0 produces fewer')
     parser.add_argument('--replace-unk', nargs='?', const=True, default=None,
                         help='perform unknown replacement (optionally with alignment dictionary)')
+    parser.add_argument('--search', default='beam', choices=['beam', 'greedy', 'sampling', 'diverse_beam'],
+                        help='search strategy used for generation')
+    parser.add_argument('--sampling-topk', default=-1, type=int, metavar='PS',
+                        help='sample from the top k tokens only (with --search sampling)')
+    parser.add_argument('--sampling-temperature', default=1, type=float, metavar='N',
+                        help='temperature for sampling (with --search sampling)')
+    parser.add_argument('--diverse-beam-groups', default=1, type=int, metavar='N',
+                        help='number of groups for diverse beam search (with --search diverse_beam)')
+    parser.add_argument('--diverse-beam-strength', default=0.5, type=float, metavar='N',
+                        help='strength of the diversity penalty for diverse beam search')
     parser.add_argument('--imp_smpl_epsilon', "-epsilon", dest="imp_smpl_epsilon", default=0.1, type=float,
                         help='Epsilon parameter from ColdGANs to ensure importance sampling is valid')
 
@@ -0,0 +1,56 @@
+import random
+from collections import OrderedDict
+
+
+class ReplayBuffer:
+    """
+    Rollouts of the last policy gradient steps, at most max_batches batches, indexed by the ids of their
+    sentences: a new rollout of the same batch replaces the old one. Each entry keeps the batch, the sampled
+    tokens, their log-probabilities under the sampling distribution and the rewards, so that replaying it
+    needs neither decoding nor the discriminator. When full, the oldest batch is evicted (fifo) or the one
+    with the lowest mean reward (priority).
+    """
+
+    def __init__(self, max_batches, eviction="fifo", seed=None):
+        assert eviction in {"fifo", "priority"}
+        self.max_batches = max_batches
+        self.eviction = eviction
+        self.entries = OrderedDict()
+        # own random state: the replayed batches do not change the draws of the training objectives
+        self.random = random.Random(seed)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(ids):
+        return tuple(ids.tolist())
+
+    def add(self, sample, prediction, logprobs, reward):
+        key = self.key(sample['id'])
+        self.entries.pop(key, None)
+        if len(self.entries) >= self.max_batches:
+            self.evict()
+        self.entries[key] = {
+            "sample": {k: v for k, v in sample.items() if k != "rollout"},
+            "prediction": prediction.detach(),
+            "logprobs": logprobs.detach(),
+            "reward": reward.detach(),
+            "priority": reward.float().mean().item(),
+        }
+
+    def evict(self):
+        if self.eviction == "fifo":
+            self.entries.popitem(last=False)
+        else:
+            del self.entries[min(self.entries, key=lambda k: self.entries[k]["priority"])]
+
+    def get(self, ids):
+        """The entry of the batch of sentences ids, None if not in the buffer."""
+        return self.entries.get(self.key(ids))
+
+    def sample(self):
+        """A random entry, None if the buffer is empty."""
+        if not self.entries:
+            return None
+        return self.entries[self.random.choice(list(self.entries))]
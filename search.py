@@ -0,0 +1,163 @@
+'''
+
+This code is adapted from Facebook Fairseq-py
+Visit https://github.com/facebookresearch/fairseq-py for more information
+
+'''
+
+import torch
+
+
+class Search(object):
+    """Strategy used by SequenceGenerator to pick the candidates of a step."""
+
+    # upper bound on the number of hypotheses per sentence, None for no bound
+    max_beam_size = None
+
+    def __init__(self, dst_dict):
+        self.pad = dst_dict.pad()
+        self.unk = dst_dict.unk()
+        self.eos = dst_dict.eos()
+        self.vocab_size = len(dst_dict)
+
+    def step(self, step, lprobs, scores):
+        """Take a single search step.
+
+        Args:
+            step: the current search step, starting at 0
+            lprobs: (bsz x input_beam_size x vocab_size) the model's
+                log-probabilities over the vocabulary at the current step
+            scores: (bsz x input_beam_size x step) the cumulative scores of
+                each hypothesis up to this point
+
+        Return: A tuple of (scores, indices, beams) where:
+            scores: (bsz x output_beam_size) the cumulative scores of the
+                chosen elements; output_beam_size can be larger than
+                input_beam_size, e.g., 2*input_beam_size to account for EOS
+            indices: (bsz x output_beam_size) the token ids of the chosen
+                elements
+            beams: (bsz x output_beam_size) the hypothesis ids of the chosen
+                elements, in the range [0, input_beam_size)
+        """
+        raise NotImplementedError()
+
+
+class BeamSearch(Search):
+
+    def step(self, step, lprobs, scores):
+        bsz, beam_size, vocab_size = lprobs.size()
+
+        if step == 0:
+            # at the first step all hypotheses are equally likely, so use
+            # only the first beam
+            lprobs = lprobs[:, ::beam_size, :].contiguous()
+        else:
+            # make probs contain cumulative scores for each hypothesis
+            lprobs = lprobs + scores[:, :, step-1].unsqueeze(-1)
+
+        # take the best 2 x beam_size predictions. We'll choose the first
+        # beam_size of these which don't predict eos to continue with.
+        cand_scores, cand_indices = torch.topk(
+            lprobs.view(bsz, -1),
+            k=min(2 * beam_size, lprobs.view(bsz, -1).size(1) - 1),  # -1 so we never select pad
+        )
+        cand_beams = torch.div(cand_indices, vocab_size, rounding_mode='floor')
+        cand_indices = cand_indices.fmod(vocab_size)
+        return cand_scores, cand_indices, cand_beams
+
+
+class GreedySearch(BeamSearch):
+    """Beam search with a single hypothesis per sentence."""
+
+    max_beam_size = 1
+
+
+class Sampling(Search):
+    """Ancestral sampling, optionally restricted to the top-k tokens."""
+
+    def __init__(self, dst_dict, sampling_topk=-1, sampling_temperature=1.):
+        super().__init__(dst_dict)
+        self.sampling_topk = sampling_topk
+        self.sampling_temperature = sampling_temperature
+        # torch.Generator to draw from, e.g. when sampling in a thread next to training; default: the global one
+        self.generator = None
+
+    def sample(self, lprobs):
+        """Draw one token id per row of lprobs (N x vocab_size)."""
+        probs = torch.softmax(lprobs / self.sampling_temperature, dim=-1)
+        if self.sampling_topk > 0:
+            probs, top_indices = probs.topk(self.sampling_topk, dim=-1)
+
+        indices = torch.multinomial(probs, 1, replacement=True, generator=self.generator)
+        if self.sampling_topk > 0:
+            indices = top_indices.gather(1, indices)
+        return indices.squeeze(1)
+
+    def step(self, step, lprobs, scores):
+        bsz, beam_size, vocab_size = lprobs.size()
+
+        if step == 0:
+            # all hypotheses share the first step, draw beam_size samples
+            # from the first beam
+            lprobs = lprobs[:, ::beam_size, :].expand(bsz, beam_size, vocab_size)
+
+        cand_indices = self.sample(lprobs.reshape(bsz * beam_size, -1)).view(bsz, beam_size, 1)
+        cand_scores = lprobs.gather(2, cand_indices).squeeze(2)
+        cand_indices = cand_indices.squeeze(2)
+        if step > 0:
+            cand_scores = cand_scores + scores[:, :, step-1]
+
+        cand_beams = torch.arange(beam_size).type_as(cand_indices).repeat(bsz, 1)
+        if step == 0:
+            cand_beams.zero_()
+        return cand_scores, cand_indices, cand_beams
+
+
+class DiverseBeamSearch(Search):
+    """Diverse Beam Search.
+
+    See "Diverse Beam Search: Decoding Diverse Solutions from Neural Sequence
+    Models" for details.
+
+    We only implement the Hamming Diversity penalty here, which performed best
+    in the original paper.
+    """
+
+    def __init__(self, dst_dict, num_groups, diversity_strength):
+        super().__init__(dst_dict)
+        self.num_groups = num_groups
+        self.diversity_strength = -diversity_strength
+        self.beam = BeamSearch(dst_dict)
+
+    def step(self, step, lprobs, scores):
+        bsz, beam_size, vocab_size = lprobs.size()
+        if beam_size % self.num_groups != 0:
+            raise ValueError(
+                'DiverseBeamSearch requires the beam size to be divisible by the number of groups'
+            )
+
+        # penalize the tokens already chosen by earlier groups at this step
+        diversity_buf = lprobs.new_zeros(bsz, vocab_size)
+
+        scores_G, indices_G, beams_G = [], [], []
+        for g in range(self.num_groups):
+            lprobs_g = lprobs[:, g::self.num_groups, :]
+            scores_g = scores[:, g::self.num_groups, :] if step > 0 else None
+
+            if g > 0:
+                lprobs_g = lprobs_g + self.diversity_strength * diversity_buf.unsqueeze(1)
+
+            cand_scores, cand_indices, cand_beams = self.beam.step(step, lprobs_g, scores_g)
+            cand_beams = cand_beams * self.num_groups + g
+
+            scores_G.append(cand_scores)
+            indices_G.append(cand_indices)
+            beams_G.append(cand_beams)
+
+            diversity_buf.scatter_add_(1, cand_indices, diversity_buf.new_ones(cand_indices.size()))
+
+        # interleave the results of the groups
+        cand_scores = torch.stack(scores_G, dim=2).view(bsz, -1)
+        cand_indices = torch.stack(indices_G, dim=2).view(bsz, -1)
+        cand_beams = torch.stack(beams_G, dim=2).view(bsz, -1)
+        return cand_scores, cand_indices, cand_beams
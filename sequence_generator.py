@@ -7,13 +7,16 @@ Visit https://github.com/facebookresearch/fairseq-py for more information
 
 import math
 import torch
+import search
 import utils
 import torch.nn.functional as F
 
 class SequenceGenerator(object):
     def __init__(self, model, beam_size=1, minlen=1, maxlen=None,
                  stop_early=True, normalize_scores=True, len_penalty=1,
-                 unk_penalty=0):
+                 unk_penalty=0, search_strategy='beam', sampling_topk=-1,
+                 sampling_temperature=1., diverse_beam_groups=1,
+                 diverse_beam_strength=0.5, retain_attention=False):
         """Generates translations of a given source sentence.
 
         Args:
@@ -23,6 +26,12 @@ class SequenceGenerator(object):
                 hypotheses, even though longer hypotheses might have better
                 normalized scores.
             normalize_scores: Normalize scores by the length of the output.
+            search_strategy: One of 'beam', 'greedy', 'sampling' or
+                'diverse_beam', see search.py.
+            retain_attention: Keep the attention of the hypotheses and
+                return it with their alignment; otherwise both are None, and
+                the bsz x beam x srclen x maxlen attention buffers are not
+                allocated.
         """
         self.model = model
         self.pad = model.dst_dict.pad()
@@ -38,6 +47,18 @@ class SequenceGenerator(object):
         self.normalize_scores = normalize_scores
         self.len_penalty = len_penalty
         self.unk_penalty = unk_penalty
+        self.retain_attention = retain_attention
+
+        if search_strategy == 'beam':
+            self.search = search.BeamSearch(model.dst_dict)
+        elif search_strategy == 'greedy':
+            self.search = search.GreedySearch(model.dst_dict)
+        elif search_strategy == 'sampling':
+            self.search = search.Sampling(model.dst_dict, sampling_topk, sampling_temperature)
+        elif search_strategy == 'diverse_beam':
+            self.search = search.DiverseBeamSearch(model.dst_dict, diverse_beam_groups, diverse_beam_strength)
+        else:
+            raise ValueError(f"Unknown search strategy: {search_strategy}")
 
     def cuda(self):
         self.model.cuda()
@@ -73,18 +94,21 @@ class SequenceGenerator(object):
                 yield id, src, ref, hypos[i]
 
 
-    def generate(self, src_tokens, src_lengths, beam_size=None, maxlen=None):
+    def generate(self, src_tokens, src_lengths, beam_size=None, maxlen=None, retain_attention=None):
         """Generate a batch of translations."""
         with torch.no_grad():
-            return self._generate(src_tokens, src_lengths, beam_size, maxlen)
+            return self._generate(src_tokens, src_lengths, beam_size, maxlen, retain_attention)
 
-    def _generate(self, src_tokens, src_lengths, beam_size=None, maxlen=None):
+    def _generate(self, src_tokens, src_lengths, beam_size=None, maxlen=None, retain_attention=None):
         bsz, srclen = src_tokens.size()
         maxlen = min(maxlen, self.maxlen) if maxlen is not None else self.maxlen
+        retain_attention = self.retain_attention if retain_attention is None else retain_attention
 
         # the max beam size is the dictionary size - 1, since we never select pad
         beam_size = beam_size if beam_size is not None else self.beam_size
         beam_size = min(beam_size, self.vocab_size - 1)
+        if self.search.max_beam_size is not None:
+            beam_size = min(beam_size, self.search.max_beam_size)
 
         incremental_states = {}
         model = self.model
@@ -103,14 +127,26 @@ class SequenceGenerator(object):
         tokens = src_tokens.data.new(bsz * beam_size, maxlen + 2).fill_(self.pad)
         tokens_buf = tokens.clone()
         tokens[:, 0] = self.eos
-        attn = scores.new(bsz * beam_size, src_tokens.size(1), maxlen + 2)
-        attn_buf = attn.clone()
-
-        # list of completed sentences
-        finalized = [[] for i in range(bsz)]
-        finished = [False for i in range(bsz)]
-        worst_finalized = [{'idx': None, 'score': -math.inf} for i in range(bsz)]
-        num_remaining_sent = bsz
+        attn, attn_buf = None, None
+        if retain_attention:
+            attn = scores.new(bsz * beam_size, src_tokens.size(1), maxlen + 2)
+            attn_buf = attn.clone()
+
+        # finalized hypotheses, stored per sentence in preallocated slots
+        fin_tokens = tokens.new(bsz, beam_size, maxlen + 1).fill_(self.pad)
+        fin_pos_scores = scores.new(bsz, beam_size, maxlen + 1).fill_(0)
+        fin_attn = attn.new(bsz, beam_size, srclen, maxlen + 1).fill_(0) if retain_attention else None
+        fin_scores = scores.new(bsz, beam_size).fill_(-math.inf)
+        fin_lens = tokens.new(bsz, beam_size).fill_(0)
+        fin_count = tokens.new(bsz).fill_(0)
+        finished = torch.zeros(bsz, dtype=torch.bool, device=tokens.device)
+        num_sents = num_remaining_sent = bsz
+
+        # original sentence index of each sentence still in the batch
+        batch_map = torch.arange(0, bsz).type_as(tokens)
+
+        # hypotheses that already ended in eos and only fill up the beam
+        ignored_beams = torch.zeros(bsz, beam_size, dtype=torch.bool, device=tokens.device)
 
         # number of candidate hypos per step
         cand_size = 2 * beam_size  # 2 x beam size in case half are EOS
@@ -126,24 +162,37 @@ class SequenceGenerator(object):
                 buffers[name] = type_of.new()
             return buffers[name]
 
-        def is_finished(sent, step, unfinalized_scores=None):
+        def store_hypos(sents, slots, step, tokens_clone, pos_scores, attn_clone, eos_scores):
+            """Write hypotheses into the given (sentence, slot) positions."""
+            fin_tokens[sents, slots] = self.pad
+            fin_tokens[sents, slots, :step+1] = tokens_clone
+            fin_pos_scores[sents, slots, :step+1] = pos_scores
+            if fin_attn is not None:
+                fin_attn[sents, slots, :, :step+1] = attn_clone
+            fin_scores[sents, slots] = eos_scores
+            fin_lens[sents, slots] = step + 1
+
+        def update_finished(sents, step, unfinalized_scores=None):
             """
-            Check whether we've finished generation for a given sentence, by
+            Check whether we've finished generation for the given sentences, by
             comparing the worst score among finalized hypotheses to the best
-            possible score among unfinalized hypotheses.
+            possible score among unfinalized hypotheses. Returns the number of
+            sentences that finished at this step.
             """
-            assert len(finalized[sent]) <= beam_size
-            if len(finalized[sent]) == beam_size:
-                if self.stop_early or step == maxlen or unfinalized_scores is None:
-                    return True
+            seen = torch.zeros_like(finished)
+            seen[sents] = True
+            done = fin_count.eq(beam_size)
+            if not (self.stop_early or step == maxlen or unfinalized_scores is None):
                 # stop if the best unfinalized score is worse than the worst
                 # finalized one
-                best_unfinalized_score = unfinalized_scores[sent].max()
+                best_unfinalized_scores = fin_scores.new(num_sents).fill_(-math.inf)
+                best_unfinalized_scores[batch_map] = unfinalized_scores.view(bsz, -1).max(dim=1)[0]
                 if self.normalize_scores:
-                    best_unfinalized_score /= maxlen
-                if worst_finalized[sent]['score'] >= best_unfinalized_score:
-                    return True
-            return False
+                    best_unfinalized_scores = best_unfinalized_scores / maxlen
+                done &= fin_scores.min(dim=1)[0] >= best_unfinalized_scores
+            newly_finished = seen & done & ~finished
+            finished.logical_or_(newly_finished)
+            return int(newly_finished.sum())
 
         def finalize_hypos(step, bbsz_idx, eos_scores, unfinalized_scores=None):
             """
@@ -169,7 +218,7 @@ class SequenceGenerator(object):
             tokens_clone = tokens.index_select(0, bbsz_idx)
             tokens_clone = tokens_clone[:, 1:step+2]  # skip the first index, which is EOS
             tokens_clone[:, step] = self.eos
-            attn_clone = attn.index_select(0, bbsz_idx)[:, :, 1:step+2]
+            attn_clone = attn.index_select(0, bbsz_idx)[:, :, 1:step+2] if attn is not None else None
 
             # compute scores per token position
             pos_scores = scores.index_select(0, bbsz_idx)[:, :step+1]
@@ -179,106 +228,113 @@ class SequenceGenerator(object):
 
             # normalize sentence-level scores
             if self.normalize_scores:
-                eos_scores /= (step+1)**self.len_penalty
-
-            sents_seen = set()
-            for i, (idx, score) in enumerate(zip(bbsz_idx.tolist(), eos_scores.tolist())):
-                sent = idx // beam_size
-                sents_seen.add(sent)
-
-                def get_hypo():
-                    _, alignment = attn_clone[i].max(dim=0)
-                    return {
-                        'tokens': tokens_clone[i],
-                        'score': score,
-                        'attention': attn_clone[i],  # src_len x tgt_len
-                        'alignment': alignment,
-                        'positional_scores': pos_scores[i],
-                    }
-
-                if len(finalized[sent]) < beam_size:
-                    finalized[sent].append(get_hypo())
-                elif not self.stop_early and score > worst_finalized[sent]['score']:
-                    # replace worst hypo for this sentence with new/better one
-                    worst_idx = worst_finalized[sent]['idx']
-                    if worst_idx is not None:
-                        finalized[sent][worst_idx] = get_hypo()
-
-                    # find new worst finalized hypo for this sentence
-                    idx, s = min(enumerate(finalized[sent]), key=lambda r: r[1]['score'])
-                    worst_finalized[sent] = {
-                        'score': s['score'],
-                        'idx': idx,
-                    }
-
-            # return number of hypotheses finished this step
-            num_finished = 0
-            for sent in sents_seen:
-                # check termination conditions for this sentence
-                if not finished[sent] and is_finished(sent, step, unfinalized_scores):
-                    finished[sent] = True
-                    num_finished += 1
-            return num_finished
+                eos_scores = eos_scores / (step+1)**self.len_penalty
+
+            # rank of each hypothesis among the ones of the same sentence, in
+            # input order; hypotheses that still fit go to the next free slots
+            sents = batch_map[torch.div(bbsz_idx, beam_size, rounding_mode='floor')]
+            sorted_sents, perm = torch.sort(sents, stable=True)
+            counts = torch.bincount(sents, minlength=num_sents)
+            rank = torch.empty_like(sents)
+            starts = counts.cumsum(dim=0) - counts
+            rank[perm] = torch.arange(sents.numel()).type_as(sents) - starts[sorted_sents]
+            slots = fin_count[sents] + rank
+            accept = slots < beam_size
+            store_hypos(
+                sents[accept], slots[accept], step, tokens_clone[accept],
+                pos_scores[accept], attn_clone[accept] if attn_clone is not None else None, eos_scores[accept])
+            fin_count.add_(torch.bincount(sents[accept], minlength=num_sents))
+
+            overflow = ~accept
+            if not self.stop_early and overflow.any():
+                # pool the finalized hypotheses with the ones that did not fit
+                # and keep the best beam_size of them for each sentence
+                over_sents = sents[overflow]
+                over_slots = slots[overflow] - beam_size
+                pool_scores = fin_scores.new(num_sents, 2 * beam_size).fill_(-math.inf)
+                pool_scores[:, :beam_size] = fin_scores
+                pool_scores[over_sents, beam_size + over_slots] = eos_scores[overflow]
+                keep = pool_scores.topk(beam_size, dim=1)[1]
+
+                # only the slots taken over by a new hypothesis change
+                replaced = keep >= beam_size
+                moved_sents, moved_ranks = replaced.nonzero(as_tuple=True)
+                moved_from = keep[moved_sents, moved_ranks]
+                kept_sents, kept_ranks = (~replaced).nonzero(as_tuple=True)
+                kept_from = keep[kept_sents, kept_ranks]
+
+                # new hypotheses go to the slots that are no longer kept
+                free = torch.ones(num_sents, beam_size, dtype=torch.bool, device=tokens.device)
+                free[kept_sents, kept_from] = False
+                free_sents, free_slots = free.nonzero(as_tuple=True)
+                order = torch.argsort(moved_sents * 2 * beam_size + moved_from)
+                moved_sents, moved_from = moved_sents[order], moved_from[order]
+                assert torch.equal(free_sents, moved_sents)
+
+                # map pool positions back to rows of the overflow hypotheses
+                row = tokens.new(num_sents, beam_size).fill_(-1)
+                row[over_sents, over_slots] = overflow.nonzero(as_tuple=True)[0]
+                src_rows = row[moved_sents, moved_from - beam_size]
+                store_hypos(
+                    free_sents, free_slots, step, tokens_clone[src_rows],
+                    pos_scores[src_rows], attn_clone[src_rows] if attn_clone is not None else None,
+                    eos_scores[src_rows])
+
+            return update_finished(sents, step, unfinalized_scores)
 
         reorder_state = None
+        batch_idxs = None
         for step in range(maxlen + 1):  # one extra step for EOS marker
             # reorder decoder internal states based on the prev choice of beams
             if reorder_state is not None:
+                if batch_idxs is not None:
+                    # update beam indices to take into account removed sentences
+                    corr = batch_idxs - torch.arange(batch_idxs.numel()).type_as(batch_idxs)
+                    reorder_state.view(-1, beam_size).add_(corr.unsqueeze(-1) * beam_size)
+                    encoder_out = model.encoder.reorder_encoder_out(encoder_out, reorder_state)
                 model.decoder.reorder_incremental_state(
                     incremental_states[model], reorder_state)
 
             probs, avg_attn_scores = self._decode(
                 tokens[:, :step+1], encoder_out, incremental_states)
             if step == 0:
-                # at the first step all hypotheses are equally likely, so use
-                # only the first beam
-                probs = probs.unfold(0, 1, beam_size).squeeze(2).contiguous()
                 scores = scores.type_as(probs)
                 scores_buf = scores_buf.type_as(probs)
-            else:
-                # make probs contain cumulative scores for each hypothesis
-                probs.add_(scores[:, step-1].view(-1, 1))
             probs[:, self.pad] = -math.inf  # never select pad
             probs[:, self.unk] -= self.unk_penalty  # apply unk penalty
+            if step < self.minlen:
+                probs[:, self.eos] = -math.inf  # never end before minlen
 
             # Record attention scores
-            attn[:, :, step+1].copy_(avg_attn_scores)
+            if attn is not None:
+                attn[:, :, step+1].copy_(avg_attn_scores)
 
-            cand_scores = buffer('cand_scores', type_of=scores)
-            cand_indices = buffer('cand_indices')
-            cand_beams = buffer('cand_beams')
-            eos_bbsz_idx = buffer('eos_bbsz_idx')
-            eos_scores = buffer('eos_scores', type_of=scores)
             if step < maxlen:
-                # take the best 2 x beam_size predictions. We'll choose the first
-                # beam_size of these which don't predict eos to continue with.
-                torch.topk(
-                    probs.view(bsz, -1),
-                    k=min(cand_size, probs.view(bsz, -1).size(1) - 1),  # -1 so we never select pad
-                    out=(cand_scores, cand_indices),
+                cand_scores, cand_indices, cand_beams = self.search.step(
+                    step,
+                    probs.view(bsz, beam_size, -1),
+                    scores.view(bsz, beam_size, -1)[:, :, :step],
                 )
-                torch.floor_divide(cand_indices, self.vocab_size, out=cand_beams)
-                cand_indices.fmod_(self.vocab_size)
             else:
                 # finalize all active hypotheses once we hit maxlen
                 # pick the hypothesis with the highest prob of EOS right now
-                torch.sort(
-                    probs[:, self.eos],
-                    descending=True,
-                    out=(eos_scores, eos_bbsz_idx),
-                )
-                num_remaining_sent -= finalize_hypos(
-                    step, eos_bbsz_idx, eos_scores)
-                assert num_remaining_sent == 0
+                eos_scores = probs[:, self.eos]
+                if step > 0:
+                    eos_scores = eos_scores + scores[:, step-1]
+                eos_scores, eos_bbsz_idx = torch.sort(eos_scores, descending=True)
+                keep = ~ignored_beams.view(-1)[eos_bbsz_idx]
+                finalize_hypos(step, eos_bbsz_idx[keep], eos_scores[keep])
                 break
 
             # cand_bbsz_idx contains beam indices for the top candidate
             # hypotheses, with a range of values: [0, bsz*beam_size),
             # and dimensions: [bsz, cand_size]
-            cand_bbsz_idx = cand_beams.add_(bbsz_offsets)
+            cand_bbsz_idx = cand_beams.add(bbsz_offsets)
+            cand_ignored = ignored_beams.gather(1, cand_beams)
 
             # finalize hypotheses that end in eos
-            eos_mask = cand_indices.eq(self.eos)
+            eos_mask = cand_indices.eq(self.eos) & ~cand_ignored
+            num_finished = 0
             if step >= self.minlen:
                 # only consider eos when it's among the top beam_size indices
                 eos_bbsz_idx = torch.masked_select(
@@ -292,31 +348,65 @@ class SequenceGenerator(object):
                         mask=eos_mask[:, :beam_size],
                         # out=eos_scores,
                     )
-                    num_remaining_sent -= finalize_hypos(
+                    num_finished = finalize_hypos(
                         step, eos_bbsz_idx, eos_scores, cand_scores)
+                    num_remaining_sent -= num_finished
 
             assert num_remaining_sent >= 0
             if num_remaining_sent == 0:
                 break
             assert step < maxlen
 
+            if num_finished > 0:
+                # drop finished sentences from the batch, so that the decoder
+                # only runs on the hypotheses that are still being extended
+                new_bsz = num_remaining_sent
+                batch_idxs = (~finished[batch_map]).nonzero(as_tuple=True)[0]
+                batch_map = batch_map[batch_idxs]
+
+                eos_mask = eos_mask[batch_idxs]
+                cand_ignored = cand_ignored[batch_idxs]
+                cand_beams = cand_beams[batch_idxs]
+                bbsz_offsets = bbsz_offsets[:new_bsz]
+                cand_bbsz_idx = cand_beams.add(bbsz_offsets)
+                cand_scores = cand_scores[batch_idxs]
+                cand_indices = cand_indices[batch_idxs]
+
+                scores = scores.view(bsz, -1)[batch_idxs].view(new_bsz * beam_size, -1)
+                scores_buf = scores_buf[:new_bsz * beam_size]
+                tokens = tokens.view(bsz, -1)[batch_idxs].view(new_bsz * beam_size, -1)
+                tokens_buf = tokens_buf[:new_bsz * beam_size]
+                if attn is not None:
+                    attn = attn.view(bsz, -1)[batch_idxs].view(new_bsz * beam_size, attn.size(1), -1)
+                    attn_buf = attn_buf[:new_bsz * beam_size]
+                ignored_beams = ignored_beams[batch_idxs]
+                for buf in buffers.values():
+                    buf.resize_(0)
+                bsz = new_bsz
+            else:
+                batch_idxs = None
+
             # set active_mask so that values > cand_size indicate eos hypos
             # and values < cand_size indicate candidate active hypos.
             # After, the min values per row are the top candidate active hypos
             active_mask = buffer('active_mask')
             torch.add(
-                eos_mask.type_as(cand_offsets)*cand_size,
+                (eos_mask | cand_ignored).type_as(cand_offsets)*cand_size,
                 cand_offsets[:eos_mask.size(1)],
                 out=active_mask,
             )
 
             # get the top beam_size active hypotheses, which are just the hypos
             # with the smallest values in active_mask
-            active_hypos, _ignore = buffer('active_hypos'), buffer('_ignore')
+            active_hypos, active_values = buffer('active_hypos'), buffer('active_values')
             torch.topk(
                 active_mask, k=beam_size, dim=1, largest=False,
-                out=(_ignore, active_hypos)
+                out=(active_values, active_hypos)
             )
+            # when the search returns fewer than beam_size hypotheses that do
+            # not end in eos (e.g. sampling), ended ones fill the beam and are
+            # never finalized again
+            ignored_beams = active_values.ge(cand_size)
             active_bbsz_idx = buffer('active_bbsz_idx')
             torch.gather(
                 cand_bbsz_idx, dim=1, index=active_hypos,
@@ -349,10 +439,11 @@ class SequenceGenerator(object):
             )
 
             # copy attention for active hypotheses
-            torch.index_select(
-                attn[:, :, :step+2], dim=0, index=active_bbsz_idx,
-                out=attn_buf[:, :, :step+2],
-            )
+            if attn is not None:
+                torch.index_select(
+                    attn[:, :, :step+2], dim=0, index=active_bbsz_idx,
+                    out=attn_buf[:, :, :step+2],
+                )
 
             # swap buffers
             old_tokens = tokens
@@ -368,9 +459,25 @@ class SequenceGenerator(object):
             # reorder incremental state in decoder
             reorder_state = active_bbsz_idx
 
+        # alignment only for the retained attention
+        alignment = fin_attn.max(dim=2)[1] if fin_attn is not None else None
+
         # sort by score descending
-        for sent in range(bsz):
-            finalized[sent] = sorted(finalized[sent], key=lambda r: r['score'], reverse=True)
+        order = torch.sort(fin_scores, dim=1, descending=True, stable=True)[1]
+        fin_counts, fin_lens, fin_scores = fin_count.tolist(), fin_lens.tolist(), fin_scores.tolist()
+        finalized = []
+        for sent, sent_order in enumerate(order.tolist()):
+            hypos = []
+            for slot in sent_order[:fin_counts[sent]]:
+                length = fin_lens[sent][slot]
+                hypos.append({
+                    'tokens': fin_tokens[sent, slot, :length],
+                    'score': fin_scores[sent][slot],
+                    'attention': fin_attn[sent, slot, :, :length] if fin_attn is not None else None,  # src_len x tgt_len
+                    'alignment': alignment[sent, slot, :length] if alignment is not None else None,
+                    'positional_scores': fin_pos_scores[sent, slot, :length],
+                })
+            finalized.append(hypos)
 
         return finalized
 
@@ -13,8 +13,9 @@ import utils
 from meters import AverageMeter
 from discriminator import Discriminator
 from generator import LSTMModel
-from disc_dataloader import DatasetProcessing, prepare_training_data
-from disc_dataloader import train_dataloader, eval_dataloader
+from disc_dataloader import DatasetProcessing, NegativesCache, negatives_key, prepare_training_data
+from disc_dataloader import StreamingDatasetProcessing, generate_negatives
+from disc_dataloader import train_dataloader, eval_dataloader, stream_dataloader
 
 
 def train_d(args, dataset):
@@ -80,11 +81,17 @@ def train_d(args, dataset):
     best_dev_loss = math.inf
     lr = optimizer.param_groups[0]['lr']
 
+    # generated negatives are cached on disk for this generator checkpoint
+    # and generation settings, only the missing ones get generated
+    cache_dir = os.path.join(args.disc_data_cache, negatives_key('checkpoints/generator/best_gmodel.pt', args))
+    negatives = {split: NegativesCache(os.path.join(cache_dir, split)) for split in ('train', 'valid')}
+
     # validation set data loader (only prepare once)
-    train = prepare_training_data(args, dataset, 'train', generator, epoch_i, use_cuda)
-    valid = prepare_training_data(args, dataset, 'valid', generator, epoch_i, use_cuda)
-    data_train = DatasetProcessing(data=train, maxlen=args.fixed_max_len)
-    data_valid = DatasetProcessing(data=valid, maxlen=args.fixed_max_len)
+    if not args.stream_disc_data:
+        train = prepare_training_data(args, dataset, 'train', generator, epoch_i, use_cuda, negatives['train'])
+        data_train = DatasetProcessing(data=train)
+    valid = prepare_training_data(args, dataset, 'valid', generator, epoch_i, use_cuda, negatives['valid'])
+    data_valid = DatasetProcessing(data=valid)
 
     # main training loop
     while lr > args.min_d_lr and epoch_i <= max_epoch:
@@ -94,14 +101,21 @@ def train_d(args, dataset):
         torch.manual_seed(seed)
 
 
-        if args.sample_without_replacement > 0 and epoch_i > 1:
-            train = prepare_training_data(args, dataset, 'train', generator, epoch_i, use_cuda)
-            data_train = DatasetProcessing(data=train, maxlen=args.fixed_max_len)
-
+        if args.stream_disc_data:
+            # train on the samples as soon as their negatives are generated
+            data_train = StreamingDatasetProcessing(
+                generate_negatives(args, dataset, 'train', generator, epoch_i, use_cuda, negatives['train']),
+                dataset.splits['train'], queue_size=args.disc_queue_size,
+                shuffle_buffer=args.disc_shuffle_buffer, seed=seed)
+            train_loader = stream_dataloader(data_train, batch_size=args.joint_batch_size)
+        else:
+            if args.sample_without_replacement > 0 and epoch_i > 1:
+                train = prepare_training_data(args, dataset, 'train', generator, epoch_i, use_cuda, negatives['train'])
+                data_train = DatasetProcessing(data=train)
 
-        # discriminator training dataloader
-        train_loader = train_dataloader(data_train, batch_size=args.joint_batch_size,
-                                        seed=seed, epoch=epoch_i, sort_by_source_size=False)
+            # discriminator training dataloader
+            train_loader = train_dataloader(data_train, batch_size=args.joint_batch_size,
+                                            seed=seed, epoch=epoch_i, sort_by_source_size=False)
 
         valid_loader = eval_dataloader(data_valid, num_workers=4, batch_size=args.joint_batch_size)
 
@@ -113,30 +127,35 @@ def train_d(args, dataset):
             if val is not None:
                 val.reset()
 
-        for i, sample in enumerate(train_loader):
-            if use_cuda:
-                # wrap input tensors in cuda tensors
-                sample = utils.make_variable(sample, cuda=use_cuda)
+        try:
+            for i, sample in enumerate(train_loader):
+                if use_cuda:
+                    # wrap input tensors in cuda tensors
+                    sample = utils.make_variable(sample, cuda=use_cuda)
 
-            disc_out = discriminator(sample['src_tokens'], sample['trg_tokens'])
+                disc_out = discriminator(sample['src_tokens'], sample['trg_tokens'], sample['src_mask'], sample['trg_mask'])
 
-            loss = criterion(disc_out, sample['labels'])
-            _, prediction = F.softmax(disc_out, dim=1).topk(1)
-            acc = torch.sum(prediction == sample['labels'].unsqueeze(1)).float() / len(sample['labels'])
+                loss = criterion(disc_out, sample['labels'])
+                _, prediction = F.softmax(disc_out, dim=1).topk(1)
+                acc = torch.sum(prediction == sample['labels'].unsqueeze(1)).float() / len(sample['labels'])
 
-            logging_meters['train_acc'].update(acc.item())
-            logging_meters['train_loss'].update(loss.item())
-            logging.debug("D training loss {0:.3f}, acc {1:.3f}, avgAcc {2:.3f}, lr={3} at batch {4}: ". \
-                          format(logging_meters['train_loss'].avg, acc, logging_meters['train_acc'].avg,
-                                 optimizer.param_groups[0]['lr'], i))
+                logging_meters['train_acc'].update(acc.item())
+                logging_meters['train_loss'].update(loss.item())
+                logging.debug("D training loss {0:.3f}, acc {1:.3f}, avgAcc {2:.3f}, lr={3} at batch {4}: ". \
+                              format(logging_meters['train_loss'].avg, acc, logging_meters['train_acc'].avg,
+                                     optimizer.param_groups[0]['lr'], i))
 
-            optimizer.zero_grad()
-            loss.backward()
-            torch.nn.utils.clip_grad_norm(discriminator.parameters(), args.clip_norm)
-            optimizer.step()
+                optimizer.zero_grad()
+                loss.backward()
+                torch.nn.utils.clip_grad_norm(discriminator.parameters(), args.clip_norm)
+                optimizer.step()
 
-            # del src_tokens, trg_tokens, loss, disc_out, labels, prediction, acc
-            del disc_out, loss, prediction, acc
+                # del src_tokens, trg_tokens, loss, disc_out, labels, prediction, acc
+                del disc_out, loss, prediction, acc
+        finally:
+            if args.stream_disc_data:
+                # stops the generation thread also if training failed
+                data_train.close()
 
 
         # set validation mode
@@ -148,7 +167,7 @@ def train_d(args, dataset):
                     # wrap input tensors in cuda tensors
                     sample = utils.make_variable(sample, cuda=use_cuda)
 
-                disc_out = discriminator(sample['src_tokens'], sample['trg_tokens'])
+                disc_out = discriminator(sample['src_tokens'], sample['trg_tokens'], sample['src_mask'], sample['trg_mask'])
 
                 loss = criterion(disc_out, sample['labels'])
                 _, prediction = F.softmax(disc_out, dim=1).topk(1)
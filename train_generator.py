@@ -30,6 +30,8 @@ options.add_optimization_args(parser)
 options.add_checkpoint_args(parser)
 options.add_generator_model_args(parser)
 options.add_discriminator_model_args(parser)
+options.add_discriminator_server_args(parser)
+options.add_actor_learner_args(parser)
 options.add_generation_args(parser)
 
 def main(args):
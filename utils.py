@@ -77,3 +77,126 @@ def set_incremental_state(module, incremental_state, key, value):
         full_key = _get_full_incremental_state_key(module, key)
         incremental_state[full_key] = value
 
+
+
+def top_k_top_p_filtering(logits, top_k=0, top_p=1.0, filter_value=-float('Inf')):
+    """Filter the logits (bsz x vocab) of the tokens outside of the top k
+    and outside of the nucleus of probability top_p; same semantics as the
+    function of the same name in transformers."""
+    if top_k > 0:
+        top_k = min(top_k, logits.size(-1))
+        kth_logits = torch.topk(logits, top_k)[0][..., -1, None]
+        logits = logits.masked_fill(logits < kth_logits, filter_value)
+
+    if top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        cumulative_probs = torch.softmax(sorted_logits, dim=-1).cumsum(dim=-1)
+
+        # remove the tokens with cumulative probability above the threshold,
+        # shifted right to keep the first token above it
+        sorted_to_remove = cumulative_probs > top_p
+        sorted_to_remove[..., 1:] = sorted_to_remove[..., :-1].clone()
+        sorted_to_remove[..., 0] = False
+
+        to_remove = sorted_to_remove.scatter(1, sorted_indices, sorted_to_remove)
+        logits = logits.masked_fill(to_remove, filter_value)
+    return logits
+
+
+def chunked_logsumexp(x, chunk_size=None):
+    """logsumexp over the last dimension, computed chunk_size entries at a
+    time; unlike log_softmax it keeps no output of the size of x for the
+    backward pass. Half precision inputs are summed in float32."""
+    if chunk_size is None or chunk_size <= 0 or chunk_size >= x.size(-1):
+        return torch.logsumexp(x.float(), dim=-1)
+    return torch.logsumexp(torch.stack([
+        torch.logsumexp(chunk.float(), dim=-1) for chunk in x.split(chunk_size, dim=-1)
+    ], dim=-1), dim=-1)
+
+
+def cross_entropy(logits, target, ignore_index=-100, chunk_size=None, reduction='mean'):
+    """Cross entropy of logits (... x vocab) and target (...), like
+    F.cross_entropy on the flattened tensors, without materializing the
+    log-probabilities: only those of the target tokens are computed, and the
+    normalizer over the vocabulary is computed in chunks of chunk_size."""
+    logits = logits.reshape(-1, logits.size(-1))
+    target = target.reshape(-1)
+    ignored = target.eq(ignore_index)
+
+    target_logits = logits.gather(1, target.masked_fill(ignored, 0).unsqueeze(1)).squeeze(1).float()
+    nll = (chunked_logsumexp(logits, chunk_size) - target_logits).masked_fill(ignored, 0.)
+    if reduction == 'none':
+        return nll
+    if reduction == 'sum':
+        return nll.sum()
+    return nll.sum() / (~ignored).sum()
+
+
+class LinearCrossEntropy(torch.autograd.Function):
+    """Per-row cross entropy of hidden @ weight.t() (N x vocab) and target,
+    with the argmax of each row. The logits are computed chunk_size rows at a
+    time and recomputed in the backward pass, so at most chunk_size x vocab
+    of them are held in memory. The projection runs in the precision of
+    hidden (e.g. under autocast), the softmax in at least float32."""
+
+    @staticmethod
+    def forward(ctx, hidden, weight, target, chunk_size):
+        dtype = torch.promote_types(hidden.dtype, torch.float)
+        nll = hidden.new_empty(target.size(0), dtype=dtype)
+        lse = hidden.new_empty(target.size(0), dtype=dtype)
+        prediction = target.new_empty(target.size(0))
+        projection = weight.to(hidden.dtype)
+        for start in range(0, target.size(0), chunk_size):
+            end = start + chunk_size
+            logits = hidden[start:end].matmul(projection.t()).to(dtype)
+            lse[start:end] = torch.logsumexp(logits, dim=-1)
+            nll[start:end] = lse[start:end] - logits.gather(1, target[start:end].unsqueeze(1)).squeeze(1)
+            prediction[start:end] = logits.argmax(-1)
+        ctx.save_for_backward(hidden, weight, target, lse)
+        ctx.chunk_size = chunk_size
+        ctx.mark_non_differentiable(prediction)
+        return nll, prediction
+
+    @staticmethod
+    def backward(ctx, grad_nll, grad_prediction):
+        hidden, weight, target, lse = ctx.saved_tensors
+        grad_hidden = grad_weight = None
+        if grad_nll is None:
+            return grad_hidden, grad_weight, None, None
+        if ctx.needs_input_grad[0]:
+            grad_hidden = torch.empty_like(hidden)
+        if ctx.needs_input_grad[1]:
+            grad_weight = torch.zeros_like(weight)
+        projection = weight.to(hidden.dtype)
+        for start in range(0, target.size(0), ctx.chunk_size):
+            end = start + ctx.chunk_size
+            # d nll / d logits = softmax - onehot(target)
+            grad_logits = hidden[start:end].matmul(projection.t()).to(lse.dtype)
+            grad_logits = grad_logits.sub_(lse[start:end].unsqueeze(1)).exp_()
+            index = target[start:end].unsqueeze(1)
+            grad_logits.scatter_add_(1, index, grad_logits.new_full(index.size(), -1.))
+            grad_logits = grad_logits.mul_(grad_nll[start:end].unsqueeze(1)).to(hidden.dtype)
+            if grad_hidden is not None:
+                grad_hidden[start:end] = grad_logits.matmul(projection)
+            if grad_weight is not None:
+                grad_weight.add_(grad_logits.t().matmul(hidden[start:end]).to(weight.dtype))
+        return grad_hidden, grad_weight, None, None
+
+
+def linear_cross_entropy(hidden, weight, target, ignore_index=-100, chunk_size=1024, reduction='mean'):
+    """Cross entropy of the projection hidden @ weight.t() (... x vocab) and
+    target (...), like cross_entropy(F.linear(hidden, weight), target), without
+    ever holding the full logits: they are computed chunk_size positions at a
+    time. Returns the loss and the argmax predictions (shaped like target)."""
+    hidden = hidden.reshape(-1, hidden.size(-1))
+    flat_target = target.reshape(-1)
+    ignored = flat_target.eq(ignore_index)
+
+    nll, prediction = LinearCrossEntropy.apply(hidden, weight, flat_target.masked_fill(ignored, 0), chunk_size)
+    nll = nll.masked_fill(ignored, 0.)
+    prediction = prediction.view_as(target)
+    if reduction == 'none':
+        return nll, prediction
+    if reduction == 'sum':
+        return nll.sum(), prediction
+    return nll.sum() / (~ignored).sum(), prediction